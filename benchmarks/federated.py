@@ -0,0 +1,146 @@
+from __future__ import annotations
+from datetime import timedelta
+from pathlib import Path
+import pickle
+import threading
+from time import perf_counter, sleep
+from typing import Any, Type
+
+from benchmarks.timing import summarize
+from distributed_platform.client import FLClient
+from distributed_platform.model_update import UpdateCodec
+from distributed_platform.remote_simulation import RemoteSimulaionAgent, RemoteSimulatonManager
+from distributed_platform.server import FLServer
+from distributed_platform.utils import calc_reward
+from rl.aggregation import StreamingFedAvg
+from rl.sac import SAC
+from simulator.bfs import BuildingFacilitySimulator
+from simulator.interfaces.config import SimulatorConfig
+
+
+BENCHMARK_TAG = "benchmark"
+SERVER_START_RETRIES = 30
+UPDATE_CODECS = [
+    UpdateCodec('float32', compress=False),
+    UpdateCodec('float32'),
+    UpdateCodec('float16'),
+    UpdateCodec('int8'),
+    UpdateCodec('int8', topk_ratio=0.1),
+]
+
+
+def bench_payload(config: SimulatorConfig, steps_per_round: int) -> dict[str, Any]:
+    """1ラウンドで送受信する、pickleしたagentとcheckpointのサイズ
+    """
+    manager = RemoteSimulatonManager(config, calc_reward, summary_dir=None)
+    model = BuildingFacilitySimulator(config, calc_reward).create_rl_model(SAC, device='cpu')
+    end_dt = config.start_time + timedelta(minutes=steps_per_round)
+    agent = manager.create_agent(
+        SAC, model.get_checkpoint(), 0, train_start_dt=config.start_time, end_dt=end_dt, device='cpu')
+
+    start = perf_counter()
+    agent_payload = pickle.dumps(agent)
+    local_agent: RemoteSimulaionAgent = pickle.loads(agent_payload)
+    dataset = local_agent.dataset
+    checkpoint = local_agent.simulate_and_train(manager.env_table.slice(dataset.start, dataset.start + dataset.length))
+    checkpoint_payload = pickle.dumps(checkpoint)
+    elapsed = perf_counter() - start
+
+    # 学習後のパラメータの、送信形式ごとのサイズ
+    local_checkpoint = local_agent.model.get_checkpoint()
+    update_bytes = {
+        f"{codec.quantization}{f'_top{codec.topk_ratio}' if codec.topk_ratio else ''}{'' if codec.compress else '_raw'}":
+            len(pickle.dumps(codec.encode(local_checkpoint, local_agent.model_checkpoint, 0)))
+        for codec in UPDATE_CODECS
+    }
+
+    return dict(
+        steps_per_round=steps_per_round,
+        model_bytes=len(pickle.dumps(model)),
+        model_checkpoint_bytes=len(pickle.dumps(model.get_checkpoint())),
+        agent_bytes=len(agent_payload),
+        # 2ラウンド目以降は、エリアを送らない
+        agent_round_bytes=len(pickle.dumps(manager.create_agent(
+            SAC, None, 0, train_start_dt=config.start_time, end_dt=end_dt, include_areas=False, device='cpu'))),
+        checkpoint_bytes=len(checkpoint_payload),
+        update_bytes=update_bytes,
+        local_round_sec=elapsed,
+    )
+
+
+def bench_fl_round(
+        config_path: Path,
+        num_clients: int,
+        num_rounds: int,
+        steps_per_round: int,
+        ServerClass: Type[FLServer] = FLServer,
+        use_session: bool = False) -> dict[str, Any]:
+    """localhost上でFLServer(またはそのサブクラス)とnum_clients個のFLClientを動かした時の、1ラウンドあたりの所要時間
+
+    use_session=Trueの場合、clientはサーバとのセッションを張り続ける (AsyncFLServerとそのサブクラスのみ)
+    """
+    config = SimulatorConfig.parse_file(config_path)
+    server = _start_server(ServerClass, config, config_path, num_clients, num_rounds, steps_per_round)
+    threading.Thread(target=server.run, daemon=True).start()
+
+    latencies: list[list[float]] = [[] for _ in range(num_clients)]
+
+    def run_client(latencies: list[float]):
+        client = FLClient(use_session=use_session)
+        for _ in range(num_rounds):
+            start = perf_counter()
+            client.run_round()
+            latencies.append(perf_counter() - start)
+
+        client.close()
+
+    start = perf_counter()
+    threads = [threading.Thread(target=run_client, args=(latencies[i],)) for i in range(num_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+
+    server.selection_socket.close()
+    server.reporting_socket.close()
+
+    return dict(
+        server=ServerClass.__name__,
+        use_session=use_session,
+        num_clients=num_clients,
+        num_rounds=num_rounds,
+        steps_per_round=steps_per_round,
+        total_sec=elapsed,
+        round_latency=summarize([latency for client_latencies in latencies for latency in client_latencies]),
+        # どのフェーズがラウンドの時間を占めているか
+        timeline=server.timeline.summary(),
+    )
+
+
+def _start_server(
+        ServerClass: Type[FLServer],
+        config: SimulatorConfig,
+        config_path: Path,
+        num_clients: int,
+        num_rounds: int,
+        steps_per_round: int) -> FLServer:
+    # 直前の実行のポートが解放されるまで待つ (Experiment._start_global_serverと同様)
+    for _ in range(SERVER_START_RETRIES):
+        try:
+            return ServerClass(
+                SAC,
+                config.start_time,
+                num_rounds * steps_per_round,
+                steps_per_round,
+                num_clients,
+                StreamingFedAvg,
+                [(config_path, BENCHMARK_TAG)],
+                {BENCHMARK_TAG: calc_reward},
+                device='cpu')
+
+        except OSError as e:
+            print(f"Failed to start server: {e}\nRetry after 5 sec...", flush=True)
+            sleep(5)
+
+    raise RuntimeError("Could not start FLServer for the benchmark.")
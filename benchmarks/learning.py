@@ -0,0 +1,42 @@
+from __future__ import annotations
+from typing import Any
+
+import numpy as np
+
+from benchmarks.timing import measure
+from distributed_platform.utils import calc_reward
+from rl.sac import SAC
+from simulator.bfs import BuildingFacilitySimulator
+from simulator.interfaces.config import SimulatorConfig
+
+
+BATCH_SIZE = 256
+NUM_TRANSITIONS = 4 * BATCH_SIZE
+SELECT_ACTIONS_BATCH = 64
+
+
+def bench_sac(config: SimulatorConfig, min_time: float) -> dict[str, Any]:
+    """SACの推論(select_action)と、1回分の学習(update)のコスト
+    """
+    bfs = BuildingFacilitySimulator(config, calc_reward)
+    model: SAC = bfs.create_rl_model(SAC, device='cpu', batch_size=BATCH_SIZE)
+
+    # 学習に使えるよう、ランダムな遷移でバッファを埋めておく
+    rng = np.random.default_rng(0)
+    state_dim, action_dim = bfs.get_state_shape()[0], bfs.get_action_shape()[0]
+    model.replay_buffer.add_batch(
+        states=rng.normal(size=(NUM_TRANSITIONS, state_dim)),
+        actions=rng.uniform(-1, 1, size=(NUM_TRANSITIONS, action_dim)),
+        next_states=rng.normal(size=(NUM_TRANSITIONS, state_dim)),
+        rewards=rng.normal(size=(NUM_TRANSITIONS, 1)),
+        dones=np.zeros(NUM_TRANSITIONS))
+
+    state = bfs.get_state_array()
+    states = np.repeat(state[np.newaxis], SELECT_ACTIONS_BATCH, axis=0)
+
+    return dict(
+        batch_size=BATCH_SIZE,
+        select_action=measure(lambda: model.select_action(state), min_time),
+        **{f"select_actions_{SELECT_ACTIONS_BATCH}": measure(lambda: model.select_actions(states), min_time)},
+        update=measure(model.update, min_time),
+    )
@@ -0,0 +1,102 @@
+"""ベンチマークを実行し、結果をJSONに書き出す
+
+$ python -m benchmarks.run --out bench.json
+$ python -m benchmarks.run --only step codec --min-time 0.5
+
+コミット間で比較できるよう、結果にはコミットのハッシュや各ライブラリのバージョンも含める
+"""
+from __future__ import annotations
+import argparse
+from contextlib import redirect_stdout
+from datetime import datetime
+import io
+import json
+import os
+from pathlib import Path
+import platform
+import subprocess
+from typing import Any, Callable
+
+# FLClientはGLOBAL_HOSTNAMEのサーバに接続するので、distributed_platformを読み込む前にlocalhostにしておく
+os.environ.setdefault("GLOBAL_HOSTNAME", "localhost")
+
+import numpy as np
+import torch
+
+from benchmarks.federated import bench_fl_round, bench_payload
+from benchmarks.learning import bench_sac
+from benchmarks.simulation import bench_codec, bench_load, bench_step
+from distributed_platform.async_server import AsyncFLServer
+from distributed_platform.buffered_server import BufferedFLServer
+from distributed_platform.server import FLServer
+from simulator.interfaces.config import SimulatorConfig
+
+
+DEFAULT_CONFIG_PATH = Path("data/json/example/simulator_config.json")
+BENCHMARKS = ["step", "codec", "load", "sac", "payload", "fl_round"]
+FL_SERVERS = {"threaded": FLServer, "async": AsyncFLServer, "buffered": BufferedFLServer}
+
+
+def get_metadata() -> dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return dict(
+        commit=commit,
+        datetime=datetime.now().isoformat(),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        torch=torch.__version__,
+        machine=platform.machine(),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run benchmarks of the simulator and the distributed platform.")
+    parser.add_argument("--config", type=Path, default=DEFAULT_CONFIG_PATH)
+    parser.add_argument("--out", type=Path, default=None, help="path to write the results as JSON")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument("--min-time", type=float, default=1.0, help="minimum seconds to repeat each measurement")
+    parser.add_argument("--areas", type=int, nargs="+", default=[1, 10, 1000])
+    parser.add_argument("--steps-per-round", type=int, default=60)
+    parser.add_argument("--fl-clients", type=int, default=2)
+    parser.add_argument("--fl-rounds", type=int, default=3)
+    parser.add_argument("--fl-server", choices=list(FL_SERVERS), default="threaded")
+    parser.add_argument("--fl-session", action="store_true", help="keep a session per client (async/buffered only)")
+    parser.add_argument("--verbose", action="store_true", help="show the logs of the simulator and the FL platform")
+    args = parser.parse_args()
+
+    config = SimulatorConfig.parse_file(args.config)
+    benchmarks: dict[str, Callable[[], dict[str, Any]]] = dict(
+        step=lambda: bench_step(config, args.areas, args.min_time),
+        codec=lambda: bench_codec(config, args.min_time),
+        load=lambda: bench_load(args.config, args.min_time),
+        sac=lambda: bench_sac(config, args.min_time),
+        payload=lambda: bench_payload(config, args.steps_per_round),
+        fl_round=lambda: bench_fl_round(
+            args.config, args.fl_clients, args.fl_rounds, args.steps_per_round,
+            FL_SERVERS[args.fl_server], args.fl_session),
+    )
+
+    results = dict(metadata=get_metadata(), config=str(args.config), results={})
+    for name in args.only:
+        print(f"Running {name}...", flush=True)
+
+        if args.verbose:
+            results["results"][name] = benchmarks[name]()
+        else:
+            with redirect_stdout(io.StringIO()):
+                results["results"][name] = benchmarks[name]()
+
+        print(json.dumps(results["results"][name], indent=4), flush=True)
+
+    if args.out:
+        args.out.write_text(json.dumps(results, indent=4))
+        print(f"Wrote results to {args.out}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
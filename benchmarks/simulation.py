@@ -0,0 +1,97 @@
+from __future__ import annotations
+from pathlib import Path
+from time import perf_counter
+from typing import Any
+
+import numpy as np
+
+from benchmarks.timing import measure, scale_areas
+from distributed_platform.utils import calc_reward
+from simulator.bfs import BuildingFacilitySimulator
+from simulator.building import BuildingAction, BuildingState
+from simulator.environment import AreaEnvironment, ExternalEnvironment
+from simulator.interfaces.config import SimulatorConfig
+from simulator.interfaces.timeseries import load_csv_columns
+
+
+NUM_RANDOM_ACTIONS = 64
+
+
+def comfort_reward(state: BuildingState, action: BuildingAction) -> np.ndarray:
+    """エリア数によらず使える報酬 (distributed_platform.utils.calc_rewardの温度の項だけ)
+    """
+    area_temp = np.array([area.temperature for area in state.areas])
+    return np.array([np.exp(-0.2 * (area_temp - 25) ** 2).sum()])
+
+
+def random_actions(bfs: BuildingFacilitySimulator, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).uniform(-1, 1, size=(NUM_RANDOM_ACTIONS, *bfs.get_action_shape()))
+
+
+def bench_step(config: SimulatorConfig, num_areas_list: list[int], min_time: float) -> dict[str, Any]:
+    """エリア数ごとの、BuildingFacilitySimulator.stepのsteps/sec
+    """
+    results = {}
+    for num_areas in num_areas_list:
+        bfs = BuildingFacilitySimulator(scale_areas(config, num_areas), comfort_reward)
+        actions = random_actions(bfs)
+        cursor = 0
+
+        def step():
+            nonlocal cursor
+            if bfs.has_finished():
+                bfs.reset()
+
+            bfs.step(actions[cursor % NUM_RANDOM_ACTIONS])
+            cursor += 1
+
+        results[f"areas_{num_areas}"] = dict(
+            state_dim=bfs.get_state_shape()[0],
+            action_dim=bfs.get_action_shape()[0],
+            **measure(step, min_time),
+        )
+
+    return results
+
+
+def bench_codec(config: SimulatorConfig, min_time: float) -> dict[str, Any]:
+    """stateとactionのndarrayへの変換のスループット (オブジェクト経由と、BuildingLayout経由)
+    """
+    bfs = BuildingFacilitySimulator(config, calc_reward)
+    action = random_actions(bfs)[0]
+    bfs.step(action)
+    state = bfs.get_state()
+
+    return dict(
+        action_from_ndarray=measure(lambda: BuildingAction.from_ndarray(action, bfs.areas), min_time),
+        state_to_ndarray=measure(state.to_ndarray, min_time),
+        layout_decode_action=measure(lambda: bfs.layout.decode_action(action, bfs.areas), min_time),
+        layout_encode_state=measure(lambda: bfs.get_state_array(), min_time),
+    )
+
+
+def bench_load(config_path: Path, min_time: float) -> dict[str, Any]:
+    """configと環境変数のCSVの読み込み時間
+    """
+    config = SimulatorConfig.parse_file(config_path)
+    csv_paths = [(config.external_environment_csv_path, ExternalEnvironment)] + [
+        (area.area_environment_csv_path, AreaEnvironment)
+        for area in config.building_attributes.areas if area.area_environment_csv_path
+    ]
+
+    def load_csv_without_cache():
+        for csv_path, ModelType in csv_paths:
+            load_csv_columns(csv_path, ModelType, use_cache=False)
+
+    start = perf_counter()
+    num_rows = sum(1 for _ in config.get_env_iter())
+    env_iter_sec = perf_counter() - start
+
+    return dict(
+        num_rows=num_rows,
+        parse_file=measure(lambda: SimulatorConfig.parse_file(config_path), min_time),
+        csv_without_cache=measure(load_csv_without_cache, min_time),
+        env_table=measure(config.get_env_table, min_time),
+        # 全行をBuildingEnvironmentとして読み出す (時間がかかるので1回だけ)
+        env_iter_total_sec=env_iter_sec,
+    )
@@ -0,0 +1,49 @@
+from __future__ import annotations
+from time import perf_counter
+from typing import Any, Callable
+
+from simulator.interfaces.config import BuildingAttributes, SimulatorConfig
+
+
+def measure(func: Callable[[], Any], min_time: float, min_calls: int = 1) -> dict[str, float]:
+    """funcを、min_time秒以上かつmin_calls回以上繰り返し呼び出した時の所要時間を返す
+    """
+    calls = 0
+    start = perf_counter()
+    while True:
+        func()
+        calls += 1
+
+        elapsed = perf_counter() - start
+        if elapsed >= min_time and calls >= min_calls:
+            break
+
+    return dict(
+        calls=calls,
+        total_sec=elapsed,
+        mean_usec=elapsed / calls * 1e6,
+        per_sec=calls / elapsed,
+    )
+
+
+def summarize(samples: list[float]) -> dict[str, float]:
+    """秒単位の計測値のリストを、平均・最小・最大にまとめる
+    """
+    return dict(
+        count=len(samples),
+        mean_sec=sum(samples) / len(samples),
+        min_sec=min(samples),
+        max_sec=max(samples),
+    )
+
+
+def scale_areas(config: SimulatorConfig, num_areas: int) -> SimulatorConfig:
+    """configのエリアを順に繰り返して、num_areas個のエリアを持つconfigを作る
+    """
+    base_areas = config.building_attributes.areas
+    areas = [
+        base_areas[i % len(base_areas)].copy(update=dict(name=f"{base_areas[i % len(base_areas)].name} #{i}"))
+        for i in range(num_areas)
+    ]
+
+    return config.copy(update=dict(building_attributes=BuildingAttributes(areas=areas)))
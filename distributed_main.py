@@ -1,11 +1,15 @@
+import sys
+
 from distributed_platform.experiment import Experiment, ExperimentConfig
 from main import calc_reward
-from rl.sac import SAC, average_sac
+from rl.aggregation import StreamingFedAvg
+from rl.sac import SAC
 
 
 if __name__ == "__main__":
-    config = ExperimentConfig.parse_file("./data/json/example/experiment_config_small.json")
+    config_path = sys.argv[1] if len(sys.argv) > 1 else "./data/json/example/experiment_config_small.json"
+    config = ExperimentConfig.parse_file(config_path)
     calc_reward_dict = dict(group15=calc_reward, group20=calc_reward, group25=calc_reward)
     
-    exp = Experiment(SAC, average_sac, calc_reward_dict, config)
+    exp = Experiment(SAC, StreamingFedAvg, calc_reward_dict, config)
     exp.run()
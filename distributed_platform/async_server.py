@@ -0,0 +1,303 @@
+from __future__ import annotations
+import asyncio
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import socket
+import threading
+import time
+from typing import Any, NamedTuple, Optional
+
+from distributed_platform.server import FLServer
+from distributed_platform.session import HEARTBEAT_INTERVAL, SESSION_TIMEOUT, Channel, OneShotChannel, ServerSession
+from distributed_platform.wire import MessageStats, recv_message_async
+from distributed_platform.remote_simulation import EdgeReport, RemoteSimulaionCheckpoint
+from simulator.interfaces.model import CheckpointAggregator
+
+
+class SelectedClient(NamedTuple):
+    channel: Channel
+    client: socket._RetAddress
+    req: dict[str, Any]
+
+
+class Report(NamedTuple):
+    # clientが落ちて報告が届かなかった場合はNone
+    channel: Optional[Channel]
+    client_id: int
+
+
+class AsyncFLServer(FLServer):
+    """FLServerと同じラウンドを、1つのasyncioのイベントループ上で実行するサーバ
+
+    selectionとreportingの接続は並行して受け付け、メッセージのpickle・unpickle、checkpointの読み込み、
+    モデルの集約はworker poolで行う。そのため、ラウンドの時間は各clientの処理時間の合計ではなく、
+    最も遅いclientで決まる。
+    clientがセッション (distributed_platform.session) で接続している場合は、session_timeoutの間heartbeatが
+    届かなければ落ちたとみなし、そのclientの報告を待たずにラウンドを進める。
+    """
+
+    def __init__(
+            self, *args, max_workers: Optional[int] = None, session_timeout: float = SESSION_TIMEOUT, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.max_workers: Optional[int] = max_workers
+        self.session_timeout: float = session_timeout
+        self.sessions: set[ServerSession] = set()
+        # 現在のラウンドで学習を担当させ、まだ報告が届いていないclient
+        self.pending_report_client_ids: set[int] = set()
+        self.tag_to_selected_clients: defaultdict[str, list[SelectedClient]] = defaultdict(list)
+        # 報告を受け取ったworkerが、その場でcheckpointを足し込む
+        self.tag_to_aggregator: defaultdict[str, CheckpointAggregator] = defaultdict(self.model_aggregation)
+        self._aggregation_lock = threading.Lock()
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+
+    def _start_selection_thread(self):
+        self._loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="fl-worker")
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+
+        asyncio.run_coroutine_threadsafe(self._start_accepting(), self._loop).result()
+
+        print("Started the Global Server!", flush=True)
+
+
+    def _exec_fl_process(self):
+        asyncio.run_coroutine_threadsafe(self._exec_rounds(), self._loop).result()
+
+
+    async def _start_accepting(self):
+        # イベントループ上でのみ触るので、ここで作る
+        self._selection_updated = asyncio.Event()
+        self._reports: asyncio.Queue[Report] = asyncio.Queue()
+        self._init_client_lock = asyncio.Lock()
+
+        for sock, default_message in [(self.selection_socket, 'hello'), (self.reporting_socket, 'report')]:
+            sock.setblocking(False)
+            asyncio.create_task(self._accept_loop(sock, default_message))
+
+        asyncio.create_task(self._expire_sessions())
+
+
+    async def _accept_loop(self, sock: socket.socket, default_message: str):
+        while True:
+            conn, client = await self._loop.sock_accept(sock)
+            conn.setblocking(False)
+            asyncio.create_task(self._handle_connection(conn, client, default_message))
+
+
+    async def _handle_connection(self, conn: socket.socket, client: socket._RetAddress, default_message: str):
+        stats = MessageStats()
+        try:
+            req = await recv_message_async(conn, self._executor, stats)
+        except Exception as e:
+            print(f"Failed to receive request from {client[0]}: {e!r}", flush=True)
+            conn.close()
+            return
+
+        # ポートごとに接続する従来のclientは、reportにmessageをつけていない
+        req.setdefault('message', default_message)
+        req['received_at'], req['recv_stats'] = time.perf_counter(), stats
+
+        if req['message'] == 'session':
+            await self._serve_session(ServerSession(conn, client, self._executor))
+        else:
+            await self._handle_request(req, OneShotChannel(conn, self._executor), client)
+
+
+    async def _serve_session(self, session: ServerSession):
+        print(f"[SELECTOR] Opened session with {session.client[0]}.", flush=True)
+
+        self.sessions.add(session)
+        try:
+            await session.serve(self._handle_request)
+        finally:
+            self.sessions.discard(session)
+
+        print(f"[SELECTOR] Closed session with {self._to_session_str(session)}.", flush=True)
+        for client_id in session.client_ids:
+            await self._on_client_lost(client_id)
+
+
+    async def _expire_sessions(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+            for session in list(self.sessions):
+                if session.has_expired(self.session_timeout):
+                    print(f"No heartbeat from {self._to_session_str(session)} "
+                          f"for {self.session_timeout} sec.", flush=True)
+                    session.expire()
+
+
+    async def _handle_request(self, req: dict[str, Any], channel: Channel, client: socket._RetAddress):
+        handler = {
+            'report': self._handle_report,
+            'edge_report': self._handle_edge_report,
+        }.get(req['message'], self._handle_selection)
+
+        try:
+            await handler(req, channel, client)
+        except Exception as e:
+            # 1つのclientの失敗で、サーバ全体を止めない
+            print(f"Failed to handle request from {client[0]}: {e!r}", flush=True)
+            await channel.fail(e)
+
+
+    async def _on_client_lost(self, client_id: int):
+        """clientとのセッションが切れた場合に、そのclientを待たないようにする
+        """
+        tag = self.client_id_to_tag[client_id]
+        self.tag_to_selected_clients[tag] = [
+            selected for selected in self.tag_to_selected_clients[tag] if selected.req['client_id'] != client_id
+        ]
+
+        if client_id in self.pending_report_client_ids:
+            print(f"Lost client{client_id} before it reported.", flush=True)
+            self.pending_report_client_ids.discard(client_id)
+            await self._reports.put(Report(None, client_id))
+
+
+    async def _exec_rounds(self):
+        while self.cur_time < self.end_time:
+            await self._selection_updated.wait()
+            self._selection_updated.clear()
+
+            if any(size < self.round_client_num for size in self._get_all_queue_sizes()):
+                continue
+
+            print(f"\n\nSTART NEW ROUND (time: {self.cur_time}, tags: {list(self.tag_to_selected_clients.keys())})\n", flush=True)
+
+            await self._configuration_phase()
+            await self._reporting_phase()
+
+
+    async def _handle_selection(self, req: dict[str, Any], channel: Channel, client: socket._RetAddress):
+        if req['message'] == 'dataset':
+            await channel.reply(self._create_dataset_response(req['dataset_id']))
+            return
+
+        if req['message'] == 'model':
+            await channel.reply(self._create_model_response(req['tag'], req['version']))
+            return
+
+        await self._init_client_async(req, channel, client)
+        tag = self.client_id_to_tag[req['client_id']]
+
+        print(f"[SELECTOR] Selected {self._to_client_str(req['client_id'], client)} for the next round.", flush=True)
+        self.tag_to_selected_clients[tag].append(SelectedClient(channel, client, req))
+        self._selection_updated.set()
+
+
+    async def _init_client_async(self, req: dict[str, Any], channel: Channel, client: socket._RetAddress):
+        if req['client_id'] is None:
+            # client_idの採番が重ならないよう、1つずつ初期化する
+            async with self._init_client_lock:
+                req['client_id'] = await self._loop.run_in_executor(self._executor, self._init_client, client)
+
+        channel.bind(req['client_id'])
+
+
+    async def _configuration_phase(self):
+        print("\n### Configuration Phase ###\n", flush=True)
+
+        end_time = self.cur_time + timedelta(minutes=self.steps_per_round)
+
+        sends = []
+        for tag, selected_clients in self.tag_to_selected_clients.items():
+            selected, self.tag_to_selected_clients[tag] = \
+                selected_clients[:self.round_client_num], selected_clients[self.round_client_num:]
+
+            for channel, client, req in selected:
+                resp = self._create_agent_response(tag, req, end_time)
+                print(f"Sending global model to {self._to_client_str(req['client_id'], client)}...", flush=True)
+                self.pending_report_client_ids.add(req['client_id'])
+                sends.append(self._send_agent(tag, channel, resp))
+
+        await asyncio.gather(*sends)
+        self.cur_time = end_time
+
+
+    async def _handle_report(self, req: dict[str, Any], channel: Channel, client: socket._RetAddress):
+        client_id = req['client_id']
+
+        print(f"Got report from {self._to_client_str(client_id, client)}.", flush=True)
+
+        # 集約している間にセッションが切れても、落ちたとはみなさない
+        self.pending_report_client_ids.discard(client_id)
+        self._record_report(req)
+        await self._loop.run_in_executor(self._executor, self._aggregate_report, client_id, req['checkpoint'])
+        await self._reports.put(Report(channel, client_id))
+
+
+    async def _handle_edge_report(self, req: dict[str, Any], channel: Channel, client: socket._RetAddress):
+        report: EdgeReport = req['checkpoint']
+        client_ids = list(report.client_checkpoints)
+
+        print(f"Got reports of clients {client_ids} from {client[0]}.", flush=True)
+
+        self.pending_report_client_ids.difference_update(client_ids)
+        self._record_edge_report(req)
+        await self._loop.run_in_executor(self._executor, self._aggregate_edge_report, report)
+
+        # まとめたclientの数だけ報告として数えるが、エッジへの返信は1回だけにする
+        for i, client_id in enumerate(client_ids):
+            await self._reports.put(Report(channel if i == 0 else None, client_id))
+
+
+    def _aggregate_edge_report(self, report: EdgeReport):
+        params = self._load_edge_report(report)
+
+        with self._aggregation_lock:
+            start = time.perf_counter()
+            self.tag_to_aggregator[report.tag].add(params, report.num_samples)
+            self.timeline.record(report.model_update.base_version, 'aggregate_add', start, tag=report.tag)
+
+
+    def _aggregate_report(self, client_id: int, checkpoint: RemoteSimulaionCheckpoint):
+        params = self._load_report(client_id, checkpoint)
+        tag = self.client_id_to_tag[client_id]
+
+        with self._aggregation_lock:
+            start = time.perf_counter()
+            self.tag_to_aggregator[tag].add(params, checkpoint.num_samples)
+            self.timeline.record(checkpoint.model_update.base_version, 'aggregate_add', start, client_id, tag)
+
+
+    async def _send_agent(self, tag: str, channel: Channel, resp: dict[str, Any]):
+        start = time.perf_counter()
+        nbytes = await channel.reply(resp)
+        self.timeline.record(resp['agent'].model_version, 'send_agent', start, resp['client_id'], tag, nbytes)
+
+
+    async def _reporting_phase(self):
+        print("\n### Reporting Phase ###\n", flush=True)
+
+        reports = [await self._reports.get() for _ in range(self.round_client_num * len(self.tag_to_global_model))]
+
+        with self._aggregation_lock:
+            tag_to_aggregator, self.tag_to_aggregator = self.tag_to_aggregator, defaultdict(self.model_aggregation)
+
+        print("Updated global model with FedAvg!", flush=True)
+        await asyncio.gather(*[
+            self._loop.run_in_executor(self._executor, self._finish_aggregation, tag, aggregator)
+            for tag, aggregator in tag_to_aggregator.items()
+        ])
+
+        await asyncio.gather(*[
+            report.channel.reply({'success': True}) for report in reports if report.channel is not None
+        ])
+
+
+    def _to_session_str(self, session: ServerSession) -> str:
+        if len(session.client_ids) == 1:
+            return self._to_client_str(next(iter(session.client_ids)), session.client)
+        else:
+            return f"{session.client[0]} (clients: {sorted(session.client_ids)})"
+
+
+    def _get_all_queue_sizes(self) -> list[int]:
+        return [len(selected_clients) for selected_clients in self.tag_to_selected_clients.values()]
@@ -0,0 +1,266 @@
+from __future__ import annotations
+import asyncio
+from collections import Counter, defaultdict
+from datetime import timedelta
+import math
+import socket
+import time
+from typing import Any, NamedTuple, Optional
+
+import numpy as np
+
+from distributed_platform.async_server import AsyncFLServer, SelectedClient
+from distributed_platform.remote_simulation import RemoteSimulaionCheckpoint
+from distributed_platform.session import Channel
+from simulator.interfaces.model import ModelCheckpoint
+
+
+# round_deadlineを指定しない場合に、終了したかどうかを確認する間隔 [sec]
+POLL_INTERVAL = 1.0
+
+
+class BufferedUpdate(NamedTuple):
+    client_id: int
+    base_version: int
+    deltas: dict[str, np.ndarray]
+
+
+def staleness_weight(staleness: int, exponent: float) -> float:
+    """古いバージョンを元に学習した差分ほど、小さく重み付けする (FedBuffの 1 / sqrt(1 + staleness) を一般化したもの)
+    """
+    return (1 + staleness) ** -exponent
+
+
+def apply_buffered_updates(
+        checkpoint: ModelCheckpoint,
+        updates: list[BufferedUpdate],
+        version: int,
+        staleness_exponent: float,
+        server_learning_rate: float = 1.0) -> ModelCheckpoint:
+    """versionのcheckpointに、updatesの差分をstalenessで重み付けして平均したものを足す
+    """
+    weights = np.array([staleness_weight(version - update.base_version, staleness_exponent) for update in updates])
+    weights *= server_learning_rate / weights.sum()
+
+    result = dict(checkpoint)
+    for key in updates[0].deltas:
+        value = checkpoint[key].copy()
+        for weight, update in zip(weights, updates):
+            value += (weight * update.deltas[key]).astype(value.dtype, copy=False)
+
+        result[key] = value
+
+    return result
+
+
+class BufferedFLServer(AsyncFLServer):
+    """FedBuffのように、ラウンドで全clientを待たずに集約するサーバ
+
+    各clientはselectionされるとすぐに、自分のシミュレーションの続きのsteps_per_round分を担当する。
+    サーバは報告された差分をタグごとにためておき、buffer_size個たまるか、最初の差分が届いてからround_deadline秒経つと、
+    stalenessで重み付けして集約する。
+    同時に学習させるclientは、タグごとに buffer_size * over_selection 人までで、それ以上のclientは空きができるまで待たせる。
+    model_aggregationは使わない。
+    """
+
+    def __init__(
+            self,
+            *args,
+            buffer_size: Optional[int] = None,
+            staleness_exponent: float = 0.5,
+            max_staleness: Optional[int] = None,
+            round_deadline: Optional[float] = None,
+            over_selection: float = 1.0,
+            server_learning_rate: float = 1.0,
+            **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.buffer_size: int = buffer_size or self.round_client_num
+        if self.buffer_size < 1:
+            raise ValueError(f'buffer_size must be positive (got {self.buffer_size}).')
+        if over_selection < 1:
+            raise ValueError(f'over_selection must be at least 1 (got {over_selection}).')
+
+        self.staleness_exponent: float = staleness_exponent
+        self.max_staleness: Optional[int] = max_staleness
+        self.round_deadline: Optional[float] = round_deadline
+        self.max_active_clients: int = math.ceil(self.buffer_size * over_selection)
+        self.server_learning_rate: float = server_learning_rate
+
+        self.tag_to_active_client_num: Counter[str] = Counter()
+        self.active_client_ids: set[int] = set()
+        # セッションが切れたclient (終了の判定では待たない)
+        self.lost_client_ids: set[int] = set()
+        self.tag_to_updates: defaultdict[str, list[BufferedUpdate]] = defaultdict(list)
+        # バッファに最初の差分が入った時刻 (round_deadlineはここから測る)
+        self.tag_to_buffer_started: dict[str, float] = dict()
+        # シミュレーションをend_timeまで終えて、もう担当させないclient
+        self.finished_clients: list[SelectedClient] = list()
+
+
+    async def _exec_rounds(self):
+        while not self._has_finished():
+            try:
+                update = await asyncio.wait_for(self._reports.get(), self._get_wait_timeout())
+                tag = self.client_id_to_tag[update.client_id]
+                if not self.tag_to_updates[tag]:
+                    self.tag_to_buffer_started[tag] = time.perf_counter()
+
+                self.tag_to_updates[tag].append(update)
+
+            except asyncio.TimeoutError:
+                pass
+
+            for tag in list(self.tag_to_updates):
+                if self._should_aggregate(tag):
+                    await self._aggregate(tag)
+
+        # 残っている差分も反映してから終える
+        for tag in list(self.tag_to_updates):
+            if self.tag_to_updates[tag]:
+                await self._aggregate(tag)
+
+
+    async def _handle_selection(self, req: dict[str, Any], channel: Channel, client: socket._RetAddress):
+        if req['message'] == 'dataset':
+            await channel.reply(self._create_dataset_response(req['dataset_id']))
+            return
+
+        await self._init_client_async(req, channel, client)
+        self.lost_client_ids.discard(req['client_id'])
+
+        tag = self.client_id_to_tag[req['client_id']]
+        self.tag_to_selected_clients[tag].append(SelectedClient(channel, client, req))
+        await self._dispatch(tag)
+
+
+    async def _dispatch(self, tag: str):
+        """学習中のclientに空きがあれば、待たせているclientに続きを担当させる
+        """
+        sends = []
+        waiting = self.tag_to_selected_clients[tag]
+
+        while waiting and self.tag_to_active_client_num[tag] < self.max_active_clients:
+            channel, client, req = waiting.pop(0)
+            manager = self.managers[req['client_id']]
+
+            if manager.current_dt >= self.end_time:
+                self.finished_clients.append(SelectedClient(channel, client, req))
+                continue
+
+            end_time = min(manager.current_dt + timedelta(minutes=self.steps_per_round), self.end_time)
+            resp = self._create_agent_response(tag, req, end_time, train_start_dt=manager.current_dt)
+
+            print(f"[SELECTOR] Sending global model to {self._to_client_str(req['client_id'], client)} "
+                  f"({manager.current_dt} - {end_time})...", flush=True)
+
+            self.tag_to_active_client_num[tag] += 1
+            self.active_client_ids.add(req['client_id'])
+            sends.append(self._send_agent(tag, channel, resp))
+
+        await asyncio.gather(*sends)
+
+
+    async def _handle_report(self, req: dict[str, Any], channel: Channel, client: socket._RetAddress):
+        client_id = req['client_id']
+        tag = self.client_id_to_tag[client_id]
+        checkpoint: RemoteSimulaionCheckpoint = req['checkpoint']
+
+        base_version = checkpoint.model_update.base_version
+        staleness = self.tag_to_global_model[tag].version - base_version
+        print(f"Got report from {self._to_client_str(client_id, client)} (staleness: {staleness}).", flush=True)
+        self._record_report(req)
+
+        deltas = await self._loop.run_in_executor(self._executor, self._load_deltas, client_id, checkpoint)
+
+        # 集約を待たずに返し、次のシミュレーションを始めさせる
+        await channel.reply({'success': True})
+
+        if self.max_staleness is not None and staleness > self.max_staleness:
+            print(f"Dropped the update from client{client_id} (staleness: {staleness} > {self.max_staleness}).", flush=True)
+        else:
+            await self._reports.put(BufferedUpdate(client_id, base_version, deltas))
+
+        # 差分をキューに入れてから外すので、最後の差分を反映する前に終了と判定されることはない
+        self._deactivate(client_id)
+        await self._dispatch(tag)
+
+
+    async def _handle_edge_report(self, req: dict[str, Any], channel: Channel, client: socket._RetAddress):
+        # まとめた報告では、学習を始めたバージョンの違う差分を区別できず、stalenessで重み付けできない
+        raise ValueError("BufferedFLServer does not accept combined reports from edge aggregators or packed clients.")
+
+
+    async def _on_client_lost(self, client_id: int):
+        await super()._on_client_lost(client_id)
+
+        if client_id in self.active_client_ids:
+            print(f"Lost client{client_id} before it reported.", flush=True)
+            self.lost_client_ids.add(client_id)
+            self._deactivate(client_id)
+            await self._dispatch(self.client_id_to_tag[client_id])
+
+
+    def _deactivate(self, client_id: int):
+        if client_id in self.active_client_ids:
+            self.active_client_ids.remove(client_id)
+            self.tag_to_active_client_num[self.client_id_to_tag[client_id]] -= 1
+
+
+    def _load_deltas(self, client_id: int, checkpoint: RemoteSimulaionCheckpoint) -> dict[str, np.ndarray]:
+        self._restore_report(client_id, checkpoint)
+        self.cur_time = min(manager.current_dt for manager in self.managers)
+
+        start = time.perf_counter()
+        deltas = checkpoint.model_update.deltas()
+        self.timeline.record(
+            checkpoint.model_update.base_version, 'decode_update', start, client_id, self.client_id_to_tag[client_id])
+
+        return deltas
+
+
+    async def _aggregate(self, tag: str):
+        updates, self.tag_to_updates[tag] = self.tag_to_updates[tag], []
+        global_model = self.tag_to_global_model[tag]
+        start, round = time.perf_counter(), global_model.version
+
+        checkpoint = await self._loop.run_in_executor(
+            self._executor, apply_buffered_updates,
+            global_model.checkpoint, updates, global_model.version, self.staleness_exponent, self.server_learning_rate)
+
+        print(f"Aggregated {len(updates)} buffered updates (time: {self.cur_time}).", flush=True)
+        self._update_global_model(tag, checkpoint)
+        self.timeline.record(round, 'aggregate', start, tag=tag)
+
+
+    def _should_aggregate(self, tag: str) -> bool:
+        updates = self.tag_to_updates[tag]
+        if len(updates) >= self.buffer_size:
+            return True
+
+        return bool(updates) and self.round_deadline is not None \
+            and time.perf_counter() - self.tag_to_buffer_started[tag] >= self.round_deadline
+
+
+    def _get_wait_timeout(self) -> float:
+        if self.round_deadline is None:
+            return POLL_INTERVAL
+
+        deadlines = [
+            self.tag_to_buffer_started[tag] + self.round_deadline
+            for tag, updates in self.tag_to_updates.items() if updates
+        ]
+        return max(0., min(deadlines) - time.perf_counter()) if deadlines else POLL_INTERVAL
+
+
+    def _has_finished(self) -> bool:
+        return bool(self.managers) \
+            and all(
+                manager.current_dt >= self.end_time or client_id in self.lost_client_ids
+                for client_id, manager in enumerate(self.managers)) \
+            and not self.active_client_ids
+
+
+    def _get_all_queue_sizes(self) -> list[int]:
+        # clientは選ばれるとすぐに学習を始めるので、接続したclientの数を返す
+        return list(Counter(self.client_id_to_tag).values())
@@ -1,42 +1,298 @@
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from datetime import datetime, timedelta
 import socket
-import pickle
+import threading
 import time
 from typing import Any, Optional
 
-from distributed_platform.remote_simulation import RemoteSimulaionAgent
-from distributed_platform.utils import GLOBAL_HOSTNAME, SELECTION_PORT, REPORTING_PORT, recv_all, send_all
+from distributed_platform.dataset import DatasetStore
+from distributed_platform.remote_simulation import EdgeReport, RemoteSimulaionAgent, simulate_and_train_batch
+from distributed_platform.session import ClientSession
+from simulator.area import Area
+from simulator.batched import BatchedBuildingFacilitySimulator
+from simulator.environment import EnvironmentTable
+from simulator.interfaces.model import ModelCheckpoint, RlModel
+from distributed_platform.utils import (
+    CLIENT_BUILDINGS, DATASET_DIR, GLOBAL_HOSTNAME, SELECTION_PORT, REPORTING_PORT, USE_SESSION)
+from distributed_platform.wire import recv_message, send_message
+
+
+# PackedFLClientが、最初のagentが届いてから、同じラウンドの他のagentを待つ秒数
+BATCH_WINDOW = 0.5
 
 class FLClient:
-    def __init__(self):
+    def __init__(
+            self,
+            use_session: bool = USE_SESSION,
+            host: str = GLOBAL_HOSTNAME,
+            selection_port: int = SELECTION_PORT,
+            reporting_port: int = REPORTING_PORT):
         self.client_id: Optional[str] = None
+        self.host: str = host
+        self.selection_port: int = selection_port
+        self.reporting_port: int = reporting_port
+        # replay bufferなどを保つため、モデルはラウンドをまたいで使い回す
+        self.model: Optional[RlModel] = None
+        # 最後に受け取ったglobalモデルのパラメータとバージョン (差分はこれに対して送る)
+        self.model_checkpoint: Optional[ModelCheckpoint] = None
+        self.model_version: Optional[int] = None
+        # 最初のラウンドで受け取ったエリア (以降のラウンドでは、サーバはsnapshotだけを送る)
+        self.areas: Optional[list[Area]] = None
+        self.datasets: DatasetStore = DatasetStore(DATASET_DIR)
+        self.use_session: bool = use_session
+        self.session: Optional[ClientSession] = None
 
     def run(self):
         time.sleep(1)
 
         while True:
-            print(f"Saying hello to global..", flush=True)
-            resp = self._send_request({'message': 'hello'}, SELECTION_PORT)
-
             # TODO: 終了のお知らせを受信したらbreakする
+            try:
+                self.run_round()
+            except ConnectionError as e:
+                # 実験が終わってサーバが止まった場合など
+                print(f"Disconnected from global: {e}", flush=True)
+                break
 
-            # 最初のアクセスで発行される
-            if self.client_id is None:
-                self.client_id = resp['client_id']
 
-            # TODO: 選ばれなかった場合の処理を書く
-            # 選ばれなかった場合は、学習はしないが、bfsのステップは進めて状態は更新するといいかも
-            agent: RemoteSimulaionAgent = resp['agent']
-            checkpoint = agent.simulate_and_train()
+    def run_round(self):
+        """グローバルモデルを受け取り、ローカルで学習した結果を送り返すまでの1ラウンド分
+        """
+        print(f"Saying hello to global..", flush=True)
+        resp = self._send_request(
+            {'message': 'hello', 'model_version': self.model_version, 'has_areas': self.areas is not None},
+            self.selection_port)
+
+        # 最初のアクセスで発行される
+        if self.client_id is None:
+            self.client_id = resp['client_id']
+
+        # TODO: 選ばれなかった場合の処理を書く
+        # 選ばれなかった場合は、学習はしないが、bfsのステップは進めて状態は更新するといいかも
+        agent: RemoteSimulaionAgent = resp['agent']
+        agent.model = self.model
+        if agent.model_checkpoint is None:
+            # 既に最新のglobalモデルを持っているので、サーバは送ってこない
+            agent.model_checkpoint = self.model_checkpoint
+        if agent.areas is None:
+            agent.areas = self.areas
+
+        start = time.perf_counter()
+        env_table = self.datasets.resolve(agent.dataset, self._fetch_dataset)
+        dataset_sec = time.perf_counter() - start
+
+        checkpoint = agent.simulate_and_train(env_table)
+        checkpoint.timings['client_dataset'] = dataset_sec
+        self.model, self.model_checkpoint, self.model_version = agent.model, agent.model_checkpoint, agent.model_version
+        self.areas = agent.areas
 
-            print("Sending local model to global..", flush=True)
-            resp = self._send_request(dict(checkpoint=checkpoint), REPORTING_PORT)
+        print("Sending local model to global..", flush=True)
+        resp = self._send_request({'message': 'report', 'checkpoint': checkpoint}, self.reporting_port)
+
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+        
+
+    def _fetch_dataset(self, dataset_id: str) -> EnvironmentTable:
+        """node-localに保存されていない時系列を、サーバから受け取る
+        """
+        print(f"Fetching dataset {dataset_id} from global..", flush=True)
+        return self._send_request({'message': 'dataset', 'dataset_id': dataset_id}, self.selection_port)['env_table']
         
 
     def _send_request(self, payload: dict[str, Any], port) -> dict[str, Any]:
         payload['client_id'] = self.client_id
 
+        if self.use_session:
+            return self._get_session().request(payload)
+
+        return self._request_once(payload, port)
+
+
+    def _get_session(self) -> ClientSession:
+        # セッションが切れていたら (サーバの再起動など) 張り直す
+        if self.session is None or self.session.closed:
+            self.session = ClientSession((self.host, self.selection_port))
+
+        return self.session
+
+
+    def _request_once(self, payload: dict[str, Any], port) -> dict[str, Any]:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((GLOBAL_HOSTNAME, port))
-            send_all(pickle.dumps(payload), s)
+            s.connect((self.host, port))
+            send_message(payload, s)
+
+            return recv_message(s)
+
+
+class PackedFLClient(FLClient):
+    """1つのプロセスで、num_buildings個のビル (client_id) を担当するFLClient
+
+    ビルごとにhelloを送り、同じタグ・同じバージョンのglobalモデルで同じ区間を担当することになったビルは、
+    simulate_and_train_batchでまとめて進め、タグごとに1つのモデルで行動をまとめて推論・学習する。
+    報告はEdgeReportとしてまとめて送るので、サーバはエッジ集約サーバからの報告と同じように扱う。
+    """
+
+    def __init__(
+            self,
+            num_buildings: int = CLIENT_BUILDINGS,
+            use_session: bool = USE_SESSION,
+            host: str = GLOBAL_HOSTNAME,
+            selection_port: int = SELECTION_PORT,
+            reporting_port: int = REPORTING_PORT,
+            batch_window: float = BATCH_WINDOW):
+        super().__init__(use_session, host, selection_port, reporting_port)
+
+        self.num_buildings: int = num_buildings
+        self.batch_window: float = batch_window
+        # ビルごとのclient_id (最初のhelloの返信で発行される)
+        self.client_ids: list[Optional[int]] = [None] * num_buildings
+        # ビルごとに、最初のラウンドで受け取ったエリア
+        self.building_areas: list[Optional[list[Area]]] = [None] * num_buildings
+        # タグごとに、ラウンドをまたいで使い回すモデルと、最後に受け取ったglobalモデルのバージョンとパラメータ
+        self.tag_to_model: dict[str, RlModel] = dict()
+        self.tag_to_global_model: dict[str, tuple[int, ModelCheckpoint]] = dict()
+
+
+    def run(self):
+        time.sleep(1)
+
+        # 返信を待っているリクエストと、それが対象にしているビルのindex
+        pending: dict[Future, tuple[str, list[int]]] = {
+            self._say_hello(index): ('hello', [index]) for index in range(self.num_buildings)
+        }
+
+        while True:
+            try:
+                pending.update(self._run_ready_buildings(pending))
+            except ConnectionError as e:
+                # 実験が終わってサーバが止まった場合など
+                print(f"Disconnected from global: {e}", flush=True)
+                break
+
+
+    def _run_ready_buildings(self, pending: dict[Future, tuple[str, list[int]]]) -> dict[Future, tuple[str, list[int]]]:
+        """返信が届いたリクエストを処理し、新たに送ったリクエストを返す
+        """
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        if any(pending[future][0] == 'hello' for future in done):
+            # 同じラウンドのagentは続けて届くので、少し待ってからまとめる
+            time.sleep(self.batch_window)
+
+        sent: dict[Future, tuple[str, list[int]]] = {}
+        agents: list[tuple[int, dict[str, Any]]] = []
+        for future in [future for future in pending if future.done()]:
+            kind, indices = pending.pop(future)
+            resp = future.result()
+
+            if kind == 'hello':
+                agents.append((indices[0], resp))
+            else:
+                # 報告が受け付けられたビルは、次のラウンドに向けてhelloを送る
+                sent.update({self._say_hello(index): ('hello', [index]) for index in indices})
+
+        for (tag, *_), group in self._group_agents(agents).items():
+            # 同期的なサーバは全ビルの報告が揃うまで返信しないので、返信は待たずに次のグループに進む
+            sent[self._train_and_report(tag, group)] = ('report', [index for index, _ in group])
+
+        return sent
+
+
+    def _say_hello(self, index: int) -> Future:
+        print(f"Saying hello to global for building {index}..", flush=True)
+        # globalモデルはタグごとに1回だけ受け取るので、agentには入れさせない
+        payload = {
+            'message': 'hello',
+            'client_id': self.client_ids[index],
+            'omit_model': True,
+            'has_areas': self.building_areas[index] is not None
+        }
+
+        return self._submit(payload, self.selection_port)
+
+
+    def _group_agents(
+            self, agents: list[tuple[int, dict[str, Any]]]
+    ) -> dict[tuple[str, int, datetime, datetime, tuple], list[tuple[int, RemoteSimulaionAgent]]]:
+        """同じタグ・同じバージョンのglobalモデルで、同じ区間を学習する、エリアと設備の構成が同じビルごとにまとめる
+        """
+        groups: defaultdict[tuple[str, int, datetime, datetime, tuple], list[tuple[int, RemoteSimulaionAgent]]] = \
+            defaultdict(list)
+        for index, resp in agents:
+            self.client_ids[index] = resp['client_id']
+            agent: RemoteSimulaionAgent = resp['agent']
+            if agent.areas is None:
+                agent.areas = self.building_areas[index]
+            self.building_areas[index] = agent.areas
+
+            end_dt = agent.start_dt + timedelta(minutes=agent.dataset.length)
+            structure = BatchedBuildingFacilitySimulator.get_structure(agent.areas)
+            groups[(resp['tag'], agent.model_version, agent.train_start_dt, end_dt, structure)].append((index, agent))
+
+        return groups
+
+
+    def _train_and_report(self, tag: str, group: list[tuple[int, RemoteSimulaionAgent]]) -> Future:
+        agents = [agent for _, agent in group]
+        print(f"Training buildings {[index for index, _ in group]} (tag: {tag}) together..", flush=True)
+
+        start = time.perf_counter()
+        env_tables = [self.datasets.resolve(agent.dataset, self._fetch_dataset) for agent in agents]
+        dataset_sec = time.perf_counter() - start
+
+        global_model = self._get_global_model(tag, agents[0].model_version)
+        for agent in agents:
+            agent.model_checkpoint = global_model
+
+        model, model_update, checkpoints = simulate_and_train_batch(agents, env_tables, self.tag_to_model.get(tag))
+        self.tag_to_model[tag] = model
+
+        for checkpoint in checkpoints:
+            checkpoint.timings['client_dataset'] = dataset_sec
+
+        report = EdgeReport(
+            tag=tag,
+            model_update=model_update,
+            num_samples=sum(checkpoint.num_samples for checkpoint in checkpoints),
+            client_checkpoints={self.client_ids[index]: checkpoint for (index, _), checkpoint in zip(group, checkpoints)}
+        )
+
+        print("Sending local model to global..", flush=True)
+        return self._submit({'message': 'edge_report', 'client_id': None, 'checkpoint': report}, self.reporting_port)
+
+
+    def _get_global_model(self, tag: str, version: int) -> ModelCheckpoint:
+        if tag not in self.tag_to_global_model or self.tag_to_global_model[tag][0] != version:
+            print(f"Fetching global model (tag: {tag}, version: {version}) from global..", flush=True)
+            checkpoint = self._send_request({'message': 'model', 'tag': tag, 'version': version}, self.selection_port)
+            self.tag_to_global_model[tag] = (version, checkpoint['checkpoint'])
+
+        return self.tag_to_global_model[tag][1]
+
+
+    def _submit(self, payload: dict[str, Any], port) -> Future:
+        """返信を待たずにリクエストを送る (helloの返信を待っている間も、他のビルを進められるようにする)
+        """
+        if self.use_session:
+            return self._get_session().submit(payload)
+
+        # サーバが止まると返信は届かないので、プロセスの終了を妨げないdaemonスレッドで待つ
+        # (ThreadPoolExecutorのスレッドは、終了時に待たれてしまう)
+        future: Future = Future()
+        threading.Thread(target=self._request_into, args=(payload, port, future), daemon=True).start()
+
+        return future
+
+
+    def _request_into(self, payload: dict[str, Any], port, future: Future):
+        try:
+            future.set_result(self._request_once(payload, port))
+        except Exception as e:
+            future.set_exception(e)
+
 
-            return pickle.loads(recv_all(s))
+if __name__ == "__main__":
+    (FLClient() if CLIENT_BUILDINGS == 1 else PackedFLClient()).run()
@@ -0,0 +1,104 @@
+from __future__ import annotations
+import json
+import os
+from pathlib import Path
+import shutil
+import tempfile
+from typing import Callable, NamedTuple, Optional, Union
+
+import numpy as np
+
+from simulator.environment import EnvironmentTable
+
+
+MANIFEST_NAME = "manifest.json"
+
+
+class DatasetRef(NamedTuple):
+    """環境変数の時系列のうち、1ラウンドで使う範囲
+
+    dataset_idはEnvironmentTable.digest()で、同じ時系列であればノードによらず同じ値になる
+    """
+    dataset_id: str
+    start: int
+    length: int
+
+
+class DatasetStore:
+    """環境変数の時系列を、dataset_idごとにnode-localなディレクトリに保存しておくもの
+
+    保存した時系列はメモリマップして読み込むので、ラウンドごとにサーバから受け取ったりCSVをパースしたりしなくてよい
+    """
+
+    def __init__(self, root: Union[str, Path]):
+        self.root: Path = Path(root)
+        self._tables: dict[str, EnvironmentTable] = {}
+
+
+    def resolve(self, ref: DatasetRef, fetch: Callable[[str], EnvironmentTable]) -> EnvironmentTable:
+        """refの範囲の時系列を返す (保存されていなければ、fetchで取得して保存する)
+        """
+        table = self.load(ref.dataset_id)
+        if table is None:
+            table = fetch(ref.dataset_id)
+            self.save(ref.dataset_id, table)
+
+        if ref.start < 0 or ref.start + ref.length > len(table):
+            raise ValueError(
+                f'Range [{ref.start}, {ref.start + ref.length}) is out of dataset {ref.dataset_id} (length: {len(table)}).')
+
+        return table.slice(ref.start, ref.start + ref.length)
+
+
+    def load(self, dataset_id: str) -> Optional[EnvironmentTable]:
+        if dataset_id in self._tables:
+            return self._tables[dataset_id]
+
+        path = self.root / dataset_id
+        if not (path / MANIFEST_NAME).exists():
+            return None
+
+        manifest = json.loads((path / MANIFEST_NAME).read_text())
+        table = EnvironmentTable(
+            external=np.load(path / "external.npy", mmap_mode='r'),
+            areas=[
+                np.load(path / f"area_{i}.npy", mmap_mode='r') if has_env else None
+                for i, has_env in enumerate(manifest['areas'])
+            ]
+        )
+
+        self._tables[dataset_id] = table
+        return table
+
+
+    def save(self, dataset_id: str, table: EnvironmentTable):
+        if (digest := table.digest()) != dataset_id:
+            raise ValueError(f'Dataset {dataset_id} does not match its content (digest: {digest}).')
+
+        self._tables[dataset_id] = table
+        path = self.root / dataset_id
+        if path.exists():
+            return
+
+        # 同じノードの他のclientと同時に書き込んでも、書き込み途中のものが読まれないように、
+        # 呼び出しごとに別の一時ディレクトリに書き込んでから置き換える
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_path = Path(tempfile.mkdtemp(dir=self.root, prefix=f"{dataset_id}.", suffix=".tmp"))
+        try:
+            # mkdtempは作成者しか読めないので、他のclientからも読めるようにしておく
+            tmp_path.chmod(0o755)
+            np.save(tmp_path / "external.npy", table.external)
+            for i, area in enumerate(table.areas):
+                if area is not None:
+                    np.save(tmp_path / f"area_{i}.npy", area)
+
+            (tmp_path / MANIFEST_NAME).write_text(json.dumps(dict(areas=[area is not None for area in table.areas])))
+            os.replace(tmp_path, path)
+
+        except OSError as e:
+            # 他のclientが先に置き換えた場合は、同じ内容が保存されているので失敗ではない
+            if not (path / MANIFEST_NAME).exists():
+                print(f"Failed to save dataset {dataset_id}: {e}", flush=True)
+
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
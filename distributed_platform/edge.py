@@ -0,0 +1,230 @@
+"""ノードごとに1つ動かし、同じノードのFLClientとglobalサーバの間を中継するエッジ集約サーバ
+
+clientはglobalサーバの代わりにエッジへ接続し、エッジはhello・datasetのリクエストをそのままglobalサーバへ送る。
+helloにはomit_modelをつけてagentにglobalモデルを入れさせず、globalモデルはバージョンごとに1回だけ
+{'message': 'model'} でglobalサーバから受け取って、同じノードのclientにはエッジから配る。
+報告は同じタグ・同じバージョンのglobalモデルで学習したclientの分が揃うまでエッジで待ち、パラメータをサンプル数で
+重み付けして平均してから、1つのEdgeReportとしてglobalサーバに送る。globalサーバはそれをまとめたclientの数だけの
+報告として数え、合計のサンプル数で重み付けして集約するので、集約の結果は全clientを直接集約した場合と変わらない
+(globalサーバの集約もサンプル数で重み付けしている場合)。
+"""
+from __future__ import annotations
+from concurrent.futures import Future
+from dataclasses import dataclass, field, replace
+import socket
+import threading
+from typing import Any, Callable, Optional
+
+from distributed_platform.model_update import MAX_KEPT_VERSIONS, ModelUpdate, UpdateCodec
+from distributed_platform.remote_simulation import EdgeReport, RemoteSimulaionAgent, RemoteSimulaionCheckpoint
+from distributed_platform.session import ClientSession
+from distributed_platform.utils import (
+    EDGE_REPORTING_PORT, EDGE_SELECTION_PORT, GLOBAL_HOSTNAME, REPORTING_PORT, SELECTION_PORT, USE_SESSION)
+from distributed_platform.wire import recv_message, send_message
+from rl.aggregation import StreamingFedAvg
+from simulator.interfaces.model import ModelCheckpoint
+
+
+@dataclass
+class EdgeGroup:
+    """同じタグ・同じバージョンのglobalモデルを受け取った、このノードのclientたちの報告
+    """
+    # agentを中継したclient (全員の報告が揃ったらglobalサーバに送る)
+    assigned_client_ids: set[int] = field(default_factory=set)
+    aggregator: StreamingFedAvg = field(default_factory=StreamingFedAvg)
+    num_samples: int = 0
+    client_checkpoints: dict[int, RemoteSimulaionCheckpoint] = field(default_factory=dict)
+    # globalサーバからの返信を、報告したclientに返すための接続
+    connections: list[socket.socket] = field(default_factory=list)
+
+
+class EdgeAggregator:
+    def __init__(
+            self,
+            global_host: str = GLOBAL_HOSTNAME,
+            global_selection_port: int = SELECTION_PORT,
+            global_reporting_port: int = REPORTING_PORT,
+            selection_port: int = EDGE_SELECTION_PORT,
+            reporting_port: int = EDGE_REPORTING_PORT,
+            use_session: bool = USE_SESSION):
+        self.global_host: str = global_host
+        self.global_selection_port: int = global_selection_port
+        self.global_reporting_port: int = global_reporting_port
+        # Trueの場合、globalサーバとは1つのセッションを張り、このノードの全clientのリクエストをそこで送る
+        self.use_session: bool = use_session
+        self.session: Optional[ClientSession] = None
+
+        self.selection_socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.selection_socket.bind(('0.0.0.0', selection_port))
+        self.selection_socket.listen()
+
+        self.reporting_socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.reporting_socket.bind(('0.0.0.0', reporting_port))
+        self.reporting_socket.listen()
+
+        self.client_id_to_tag: dict[int, str] = dict()
+        # (タグ, バージョン) ごとの、globalサーバから受け取ったパラメータ (直近のいくつかのバージョンだけ残しておく)
+        self.models: dict[tuple[str, int], Future[ModelCheckpoint]] = dict()
+        self.tag_to_codec: dict[str, UpdateCodec] = dict()
+        self.groups: dict[tuple[str, int], EdgeGroup] = dict()
+        self._lock = threading.Lock()
+
+
+    def run(self):
+        self.start()
+        threading.Event().wait()
+
+
+    def start(self):
+        for sock, handler in [(self.selection_socket, self._handle_selection), (self.reporting_socket, self._handle_report)]:
+            threading.Thread(target=self._accept_loop, args=(sock, handler), daemon=True).start()
+
+        print(f"Started the Edge Aggregator for {self.global_host}!", flush=True)
+
+
+    def _accept_loop(self, sock: socket.socket, handler: Callable[[socket.socket], None]):
+        while True:
+            conn, client = sock.accept()
+            threading.Thread(target=self._handle_safely, args=(handler, conn, client), daemon=True).start()
+
+
+    def _handle_safely(self, handler: Callable[[socket.socket], None], conn: socket.socket, client: socket._RetAddress):
+        try:
+            handler(conn)
+        except Exception as e:
+            # 1つのclientの失敗で、エッジ全体を止めない
+            print(f"Failed to handle request from {client[0]}: {e!r}", flush=True)
+            conn.close()
+
+
+    def _handle_selection(self, conn: socket.socket):
+        req = recv_message(conn)
+        if req['message'] == 'dataset':
+            self._reply(self._forward(req, self.global_selection_port), conn)
+            return
+
+        if req['message'] == 'model':
+            # 複数のビルを担当するPackedFLClientは、globalモデルを別に受け取る
+            self._reply(dict(checkpoint=self._get_model(req['tag'], req['version'])), conn)
+            return
+
+        resp = self._forward(dict(req, omit_model=True), self.global_selection_port)
+
+        client_id, tag = resp['client_id'], resp['tag']
+        agent: RemoteSimulaionAgent = resp['agent']
+
+        with self._lock:
+            self.client_id_to_tag[client_id] = tag
+            self.tag_to_codec[tag] = agent.update_codec
+            self.groups.setdefault((tag, agent.model_version), EdgeGroup()).assigned_client_ids.add(client_id)
+
+        # 既にそのバージョンを持っているclientと、別に受け取るclientには、エッジからも送らない
+        if not req.get('omit_model', False) and req.get('model_version') != agent.model_version:
+            agent.model_checkpoint = self._get_model(tag, agent.model_version)
+        print(f"Relayed global model (tag: {tag}, version: {agent.model_version}) to client{client_id}.", flush=True)
+        self._reply(resp, conn)
+
+
+    def _handle_report(self, conn: socket.socket):
+        req = recv_message(conn)
+
+        if req['message'] == 'edge_report':
+            # PackedFLClientが、複数のビルの報告をまとめて送ってきたもの
+            report: EdgeReport = req['checkpoint']
+            update, num_samples, client_checkpoints = report.model_update, report.num_samples, report.client_checkpoints
+            tag = report.tag
+        else:
+            checkpoint: RemoteSimulaionCheckpoint = req['checkpoint']
+            update, num_samples = checkpoint.model_update, checkpoint.num_samples
+            # パラメータ以外 (シミュレータの状態や履歴) は、clientごとにそのままglobalサーバへ送る
+            client_checkpoints = {
+                req['client_id']: replace(checkpoint, model_update=ModelUpdate(update.base_version, {}))
+            }
+            tag = self.client_id_to_tag[req['client_id']]
+
+        version = update.base_version
+        key = (tag, version)
+        params = update.apply_to(self._get_model(tag, version))
+
+        with self._lock:
+            group = self.groups[key]
+            group.aggregator.add(params, num_samples)
+            group.num_samples += num_samples
+            group.client_checkpoints.update(client_checkpoints)
+            group.connections.append(conn)
+
+            if len(group.client_checkpoints) < len(group.assigned_client_ids):
+                return
+            del self.groups[key]
+
+        self._forward_group(tag, version, group)
+
+
+    def _forward_group(self, tag: str, version: int, group: EdgeGroup):
+        """報告が揃ったグループのパラメータの平均を、1つの報告としてglobalサーバに送り、返信を各clientに返す
+        """
+        report = EdgeReport(
+            tag=tag,
+            model_update=self.tag_to_codec[tag].encode(group.aggregator.result(), self._get_model(tag, version), version),
+            num_samples=group.num_samples,
+            client_checkpoints=group.client_checkpoints
+        )
+
+        print(f"Sending reports of clients {list(group.client_checkpoints)} (tag: {tag}) to global..", flush=True)
+        resp = self._forward({'message': 'edge_report', 'client_id': None, 'checkpoint': report}, self.global_reporting_port)
+
+        for conn in group.connections:
+            self._reply(resp, conn)
+
+
+    def _get_model(self, tag: str, version: int) -> ModelCheckpoint:
+        """globalモデルのパラメータを返す (同じバージョンを同時に求められても、globalサーバからは1回だけ受け取る)
+        """
+        key = (tag, version)
+        with self._lock:
+            future = self.models.get(key)
+            is_fetching = future is None
+            if is_fetching:
+                future = self.models[key] = Future()
+                for old_key in [(t, v) for t, v in self.models if t == tag and v <= version - MAX_KEPT_VERSIONS]:
+                    del self.models[old_key]
+
+        if is_fetching:
+            try:
+                print(f"Fetching global model (tag: {tag}, version: {version}) from global..", flush=True)
+                req = {'message': 'model', 'client_id': None, 'tag': tag, 'version': version}
+                future.set_result(self._forward(req, self.global_selection_port)['checkpoint'])
+            except Exception as e:
+                # 次に求められた時に受け取り直す
+                with self._lock:
+                    self.models.pop(key, None)
+                future.set_exception(e)
+
+        return future.result()
+
+
+    def _reply(self, resp: dict[str, Any], conn: socket.socket):
+        try:
+            send_message(resp, conn)
+        finally:
+            conn.close()
+
+
+    def _forward(self, payload: dict[str, Any], port: int) -> dict[str, Any]:
+        if self.use_session:
+            with self._lock:
+                # セッションが切れていたら (サーバの再起動など) 張り直す
+                if self.session is None or self.session.closed:
+                    self.session = ClientSession((self.global_host, self.global_selection_port))
+                session = self.session
+
+            return session.request(payload)
+
+        with socket.create_connection((self.global_host, port)) as s:
+            send_message(payload, s)
+
+            return recv_message(s)
+
+
+if __name__ == "__main__":
+    EdgeAggregator().run()
@@ -2,15 +2,18 @@ from datetime import datetime
 import os
 from pathlib import Path
 import time
-from typing import Callable, Type, TypeVar
-import docker
-from itertools import cycle, islice
+from typing import Any, Callable, Literal, Optional, Type, TypeVar
 import numpy as np
 from pydantic import BaseModel, DirectoryPath, stricturl, validator
 
+from distributed_platform.async_server import AsyncFLServer
+from distributed_platform.buffered_server import BufferedFLServer
+from distributed_platform.launcher import ClientLauncher, DockerLauncher, EdgePorts, ProcessLauncher, ThreadLauncher
+from distributed_platform.session import HEARTBEAT_INTERVAL, SESSION_TIMEOUT
+from distributed_platform.model_update import UpdateCodec
 from distributed_platform.server import CalcReward, FLServer
 from simulator.building import BuildingAction, BuildingState
-from simulator.interfaces.model import RlModel
+from simulator.interfaces.model import CheckpointAggregator, RlModel
 
 # Dockerのホストurl
 # 参考： https://docs.docker.jp/engine/reference/commandline/dockerd.html#daemon-socket-option
@@ -20,19 +23,111 @@ class ExperimentConfig(BaseModel):
     global_node_ip: str
     selection_port: int
     reporting_port: int
-    local_node_urls: list[DockerDaemonUrl]
+    local_node_urls: list[DockerDaemonUrl] = []
+    # clientをどこで起動するか (dockerはlocal_node_urlsのノードのコンテナ、processとthreadはこのマシン上)
+    launcher: Literal['docker', 'process', 'thread'] = 'docker'
+    # launcherがprocessの場合の、各clientのtorchのスレッド数 (NoneならCPU数をclient数で割った数)
+    client_threads: Optional[int] = None
     total_client_num: int
     round_client_num: int
     start_time: datetime
     steps_per_round: int
     total_steps: int
     model_tag_to_config_dir_path: dict[str, DirectoryPath]
+    # 学習開始前の区間を、モデルを使わずにfast_forwardで進める際の方策 (Noneならモデルで行動を選ぶ)
+    warmup_policy: Optional[Literal['hold', 'thermostat']] = None
+    record_warmup_history: bool = True
+    # TensorBoardに書き込む際に、何stepごとに平均・最小・最大にまとめるか
+    metrics_downsample: int = 1
+    # clientから送るパラメータの差分の形式 (distributed_platform.model_update.UpdateCodec)
+    update_quantization: Literal['float32', 'float16', 'int8'] = 'float32'
+    update_topk_ratio: Optional[float] = None
+    update_compression: bool = True
+    # asyncの場合は、selectionとreportingを1つのイベントループで並行に処理するAsyncFLServerを、
+    # bufferedの場合は、ラウンドで全clientを待たずに集約するBufferedFLServer (FedBuff) を使う
+    server_type: Literal['threaded', 'async', 'buffered'] = 'threaded'
+    # AsyncFLServerで、unpickleや集約を行うworkerの数 (Noneの場合はThreadPoolExecutorのデフォルト)
+    server_workers: Optional[int] = None
+    # 以下はBufferedFLServerの設定
+    # 何個の差分がたまったら集約するか (Noneの場合はround_client_num)
+    buffer_size: Optional[int] = None
+    # 差分を (1 + staleness) ** -staleness_exponent で重み付けする
+    staleness_exponent: float = 0.5
+    # これより古いバージョンを元にした差分は捨てる
+    max_staleness: Optional[int] = None
+    # 最初の差分が届いてから、buffer_size個たまらなくても集約するまでの秒数
+    round_deadline: Optional[float] = None
+    # 同時に学習させるclientの数の、buffer_sizeに対する倍率
+    over_selection: float = 1.0
+    # clientがリクエストごとに接続せず、サーバとのセッションを張り続けるか (threaded以外のserver_typeのみ)
+    persistent_sessions: bool = False
+    # セッションのheartbeatがこの秒数届かなければ、clientが落ちたとみなす
+    session_timeout: float = SESSION_TIMEOUT
+    # ノードごとにエッジ集約サーバを起動し、同じノードのclientの報告をまとめてからglobalサーバに送るか
+    # (launcherがprocess・threadの場合は、このマシンを1つのノードとする。server_typeがbufferedの場合は使えない)
+    edge_aggregation: bool = False
+    # エッジがclientからの接続を受け付けるポート
+    edge_selection_port: int = 11115
+    edge_reporting_port: int = 11116
+    # 1つのclientプロセスが担当するビルの数 (2以上の場合は、同じラウンドのビルをまとめて進めて1つのモデルで学習する)
+    client_buildings: int = 1
     
     @validator('reporting_port')
     def check_port_conflict(cls, value, values):
         if value == values['selection_port']:
             raise ValueError(f'`selection_port` and `reporting_port` cannot have the same value ({value}).')
         return value
+
+    @validator('launcher')
+    def check_local_node_urls(cls, value, values):
+        if value == 'docker' and not values.get('local_node_urls'):
+            raise ValueError('`local_node_urls` must not be empty when `launcher` is "docker".')
+        return value
+
+    @validator('update_topk_ratio')
+    def check_topk_ratio(cls, value):
+        if value is not None and not 0 < value <= 1:
+            raise ValueError(f'`update_topk_ratio` must be in (0, 1] (got {value}).')
+        return value
+
+    @validator('persistent_sessions')
+    def check_session_support(cls, value, values):
+        if value and values.get('server_type') == 'threaded':
+            raise ValueError('`persistent_sessions` requires `server_type` to be "async" or "buffered".')
+        return value
+
+    @validator('session_timeout')
+    def check_session_timeout(cls, value):
+        if value <= HEARTBEAT_INTERVAL:
+            raise ValueError(f'`session_timeout` must be longer than the heartbeat interval ({HEARTBEAT_INTERVAL} sec).')
+        return value
+
+    @validator('edge_aggregation')
+    def check_edge_support(cls, value, values):
+        if value and values.get('server_type') == 'buffered':
+            raise ValueError('`edge_aggregation` cannot be used when `server_type` is "buffered".')
+        return value
+
+    @validator('edge_reporting_port')
+    def check_edge_port_conflict(cls, value, values):
+        ports = [values.get('selection_port'), values.get('reporting_port'), values.get('edge_selection_port')]
+        if values.get('edge_aggregation') and value in ports:
+            raise ValueError(f'Ports of the edge aggregator conflict with other ports ({value}).')
+        return value
+
+    @validator('client_buildings')
+    def check_client_buildings(cls, value, values):
+        if value < 1:
+            raise ValueError(f'`client_buildings` must be at least 1 (got {value}).')
+        if value > 1 and values.get('server_type') == 'buffered':
+            raise ValueError('`client_buildings` must be 1 when `server_type` is "buffered".')
+        return value
+
+    @validator('over_selection')
+    def check_over_selection(cls, value):
+        if value < 1:
+            raise ValueError(f'`over_selection` must be at least 1 (got {value}).')
+        return value
     
     def get_config_paths_with_tag(self) -> list[tuple[Path, str]]:
         result = []
@@ -46,7 +141,7 @@ class ExperimentConfig(BaseModel):
 M = TypeVar('M', bound=RlModel)
 class Experiment:
     def __init__(
-            self, ModelClass: Type[M], model_aggregation: Callable[[list[M]], M], 
+            self, ModelClass: Type[M], model_aggregation: Callable[[], CheckpointAggregator], 
             tag_to_calc_reward: dict[str, CalcReward], config: ExperimentConfig):
             
         print(f"Expermient Configuration: {config.json(indent=4, separators=(',', ': '))}", flush=True)
@@ -55,87 +150,97 @@ class Experiment:
         self.model_aggregation = model_aggregation
         self.tag_to_calc_reward = tag_to_calc_reward
 
+        self.launcher: ClientLauncher = self._create_launcher(config)
+
         self.env: dict[str, str] = {
-            "GLOBAL_HOSTNAME": config.global_node_ip,
+            "GLOBAL_HOSTNAME": self.launcher.global_hostname or config.global_node_ip,
             "SELECTION_PORT": str(config.selection_port),
             "REPORTING_PORT": str(config.reporting_port),
+            "FL_SESSION": "1" if config.persistent_sessions else "0",
+            "CLIENT_BUILDINGS": str(config.client_buildings),
         }
 
         os.environ.update(self.env)
 
-        self.docker_clients: dict[str, docker.DockerClient] = {
-            str(url): docker.DockerClient(base_url=url) for url in config.local_node_urls
-        }
-
+        self.selection_port: int = config.selection_port
+        self.reporting_port: int = config.reporting_port
         self.total_client_num: int = config.total_client_num
         self.round_client_num: int = config.round_client_num
 
         self.start_time: datetime = config.start_time
         self.steps_per_round: int = config.steps_per_round
         self.total_steps: int = config.total_steps
+        self.warmup_policy: Optional[str] = config.warmup_policy
+        self.record_warmup_history: bool = config.record_warmup_history
+        self.metrics_downsample: int = config.metrics_downsample
+        self.update_codec: UpdateCodec = UpdateCodec(
+            quantization=config.update_quantization,
+            topk_ratio=config.update_topk_ratio,
+            compress=config.update_compression)
+
+        self.server_type: str = config.server_type
+        self.server_workers: Optional[int] = config.server_workers
+        self.session_timeout: float = config.session_timeout
+        self.buffered_server_kwargs: dict[str, Any] = dict(
+            buffer_size=config.buffer_size,
+            staleness_exponent=config.staleness_exponent,
+            max_staleness=config.max_staleness,
+            round_deadline=config.round_deadline,
+            over_selection=config.over_selection)
+
+        self.edge_ports: Optional[EdgePorts] = \
+            EdgePorts(config.edge_selection_port, config.edge_reporting_port) if config.edge_aggregation else None
 
         self.config_paths_with_tag: list[tuple[Path, str]] = config.get_config_paths_with_tag()
 
-        self._build_local_containers()
+        self.launcher.prepare()
     
 
     def run(self):
         server: FLServer = self._start_global_server()
 
         server._start_selection_thread()
-        self._start_local_containers()
 
-        server._wait_for_clients(self.total_client_num)
+        try:
+            # エッジが起動できなかった場合なども、起動済みのclientを止めてから終える
+            self.launcher.start(self.total_client_num, self.env, self.edge_ports)
+            server._wait_for_clients(self.total_client_num)
 
-        start_time: float = time.perf_counter()
-        server._exec_fl_proccess()
-        elapsed_time: float = time.perf_counter() - start_time
+            start_time: float = time.perf_counter()
+            server._exec_fl_process()
+            elapsed_time: float = time.perf_counter() - start_time
 
-        print(f"Elapsed time: {elapsed_time}", flush=True)
+            print(f"Elapsed time: {elapsed_time}", flush=True)
 
-    
-    def _build_local_containers(self):
-        self._stop_local_containers()
-        for url, cli in self.docker_clients.items():
-            """
-            最初 docker.errors.DockerException: Install paramiko package to enable ssh:// support
-            が出たが、言われた通り conda install -c anaconda paramiko したら回避できた
-            """
-            cli.images.build(path='.', tag='bfs/local:latest', rm=True)
-
-            print(f"Build done for {url}", flush=True)
+        finally:
+            self.launcher.stop()
+            server.write_timeline()
+            server.close_metrics()
 
-    
 
-    def _start_local_containers(self):
-        for cli in islice(cycle(self.docker_clients.values()), self.total_client_num):
-            cli.containers.run(
-                image="bfs/local", 
-                command="python -c 'from distributed_platform.client import FLClient; FLClient().run()'",  
-                environment=self.env,
-                detach=True)
-        
-        print(f"Started {self.total_client_num} local containers using hosts: {list(self.docker_clients.keys())}", flush=True)
+    @staticmethod
+    def _create_launcher(config: ExperimentConfig) -> ClientLauncher:
+        if config.launcher == 'process':
+            return ProcessLauncher(config.client_threads)
+        elif config.launcher == 'thread':
+            return ThreadLauncher()
+        else:
+            return DockerLauncher(config.local_node_urls)
 
     
-    def _stop_local_containers(self):
-        for url, cli in self.docker_clients.items():
-            containers = cli.containers.list()
-            if len(containers) > 0:
-                print(f"Found {len(containers)} dangling local containers found on {url}.", flush=True)
-                print(f"Trying to stop them...", flush=True)
-                for container in cli.containers.list():
-                    container.kill()
-                
-                print(f"Stopped all local containers on {url}", flush=True)
-            else:
-                print(f"No dangling local containers found on {url}", flush=True)
-    
-    
     def _start_global_server(self) -> FLServer:
+        if self.server_type == 'async':
+            ServerClass, server_kwargs = AsyncFLServer, dict(
+                max_workers=self.server_workers, session_timeout=self.session_timeout)
+        elif self.server_type == 'buffered':
+            ServerClass, server_kwargs = BufferedFLServer, dict(
+                max_workers=self.server_workers, session_timeout=self.session_timeout, **self.buffered_server_kwargs)
+        else:
+            ServerClass, server_kwargs = FLServer, dict()
+
         while True:
             try:
-                return FLServer(
+                return ServerClass(
                     self.ModelClass, 
                     self.start_time, 
                     self.total_steps, 
@@ -144,6 +249,13 @@ class Experiment:
                     self.model_aggregation,
                     self.config_paths_with_tag,
                     self.tag_to_calc_reward,
+                    warmup_policy=self.warmup_policy,
+                    record_warmup_history=self.record_warmup_history,
+                    metrics_downsample=self.metrics_downsample,
+                    update_codec=self.update_codec,
+                    selection_port=self.selection_port,
+                    reporting_port=self.reporting_port,
+                    **server_kwargs,
                     device='cpu')
 
             except OSError as e:
@@ -0,0 +1,281 @@
+"""Experimentで、FLClientをどこでどう起動するか
+
+DockerLauncher: 各ノードのDockerデーモンでコンテナを起動する (クラスタでの実行)
+ProcessLauncher: 同じマシン上のプロセスとして起動する
+ThreadLauncher: サーバと同じプロセスのスレッドとして起動する
+どれもFLClientとして同じようにサーバに接続するので、サーバやRemoteSimulaionAgentのやりとりは変わらない。
+edge_portsを渡した場合は、ノードごとにエッジ集約サーバ (distributed_platform.edge) も起動し、
+そのノードのclientはglobalサーバの代わりにエッジへ接続する。
+envのCLIENT_BUILDINGSが2以上の場合は、その数のビルを1つのPackedFLClientにまとめて起動する。
+"""
+from __future__ import annotations
+from abc import ABC, abstractmethod
+from itertools import cycle
+import multiprocessing
+import multiprocessing.synchronize
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, NamedTuple, Optional
+from urllib.parse import urlparse
+
+import docker
+
+if TYPE_CHECKING:
+    from distributed_platform.client import FLClient, PackedFLClient
+    from distributed_platform.edge import EdgeAggregator
+
+
+# clientが環境変数の時系列を保存しておく、各ノードとコンテナ上のディレクトリ
+NODE_DATASET_DIR = "/tmp/building-facility-simulator/datasets"
+CONTAINER_DATASET_DIR = "/datasets"
+# ノードのホスト名がurlからわからないDockerデーモン (unix://など) で、コンテナからホストを指す名前
+DOCKER_HOST_GATEWAY = "host.docker.internal"
+# エッジ集約サーバがポートを開くのを待つ時間の上限と、その間に確認する間隔 [sec]
+EDGE_START_TIMEOUT = 60.
+EDGE_POLL_INTERVAL = 0.5
+
+
+class EdgePorts(NamedTuple):
+    """エッジ集約サーバが、同じノードのclientからの接続を受け付けるポート
+    """
+    selection_port: int
+    reporting_port: int
+
+
+class ClientLauncher(ABC):
+    # clientから見たサーバのホスト名 (Noneの場合はExperimentConfig.global_node_ipを使う)
+    global_hostname: Optional[str] = None
+
+    def prepare(self):
+        """サーバを立ち上げる前に済ませておく準備 (イメージのビルドなど)
+        """
+        pass
+
+    @abstractmethod
+    def start(self, num_clients: int, env: dict[str, str], edge_ports: Optional[EdgePorts] = None):
+        """envを環境変数として、num_clients個のビルを担当するFLClient (edge_portsを渡した場合はノードごとのエッジも) を起動する
+        """
+        pass
+
+    def stop(self):
+        pass
+
+
+class DockerLauncher(ClientLauncher):
+    def __init__(self, urls: list[str]):
+        self.docker_clients: dict[str, docker.DockerClient] = {
+            str(url): docker.DockerClient(base_url=url) for url in urls
+        }
+
+
+    def prepare(self):
+        self.stop()
+        for url, cli in self.docker_clients.items():
+            """
+            最初 docker.errors.DockerException: Install paramiko package to enable ssh:// support
+            が出たが、言われた通り conda install -c anaconda paramiko したら回避できた
+            """
+            cli.images.build(path='.', tag='bfs/local:latest', rm=True)
+
+            print(f"Build done for {url}", flush=True)
+
+
+    def start(self, num_clients: int, env: dict[str, str], edge_ports: Optional[EdgePorts] = None):
+        url_to_client_env: dict[str, dict[str, str]] = {url: env for url in self.docker_clients}
+        if edge_ports is not None:
+            for url, cli in self.docker_clients.items():
+                self._start_edge(url, cli, env, edge_ports)
+                url_to_client_env[url] = _edge_client_env(env, urlparse(url).hostname or DOCKER_HOST_GATEWAY, edge_ports)
+
+            print(f"Started edge aggregators on hosts: {list(self.docker_clients.keys())}", flush=True)
+
+        building_counts = _split_buildings(num_clients, env)
+        for (url, cli), num_buildings in zip(cycle(self.docker_clients.items()), building_counts):
+            cli.containers.run(
+                image="bfs/local",
+                command="python -m distributed_platform.client",
+                environment=dict(
+                    url_to_client_env[url], BFS_DATASET_DIR=CONTAINER_DATASET_DIR, CLIENT_BUILDINGS=str(num_buildings)),
+                # 環境変数の時系列は、同じノードのコンテナ間で共有する
+                volumes={NODE_DATASET_DIR: dict(bind=CONTAINER_DATASET_DIR, mode='rw')},
+                extra_hosts={DOCKER_HOST_GATEWAY: "host-gateway"},
+                detach=True)
+
+        print(f"Started {len(building_counts)} local containers for {num_clients} buildings "
+              f"using hosts: {list(self.docker_clients.keys())}", flush=True)
+
+
+    def _start_edge(self, url: str, cli: docker.DockerClient, env: dict[str, str], edge_ports: EdgePorts):
+        # clientのコンテナからはノードのポートで接続するので、同じ番号で公開する
+        container = cli.containers.run(
+            image="bfs/local",
+            command="python -m distributed_platform.edge",
+            environment=dict(
+                env, EDGE_SELECTION_PORT=str(edge_ports.selection_port), EDGE_REPORTING_PORT=str(edge_ports.reporting_port)),
+            ports={f"{port}/tcp": port for port in edge_ports},
+            detach=True)
+
+        # clientが接続する前に、エッジがポートを開くのを待つ (ポートが使われているなどで落ちた場合は待たない)
+        deadline = time.perf_counter() + EDGE_START_TIMEOUT
+        while b"Started the Edge Aggregator" not in container.logs():
+            container.reload()
+            if container.status in ('exited', 'dead'):
+                raise RuntimeError(
+                    f"Edge aggregator on {url} exited before it started:\n{container.logs().decode(errors='replace')}")
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f"Edge aggregator on {url} did not start within {EDGE_START_TIMEOUT} sec.")
+
+            time.sleep(EDGE_POLL_INTERVAL)
+
+
+    def stop(self):
+        for url, cli in self.docker_clients.items():
+            containers = cli.containers.list()
+            if len(containers) > 0:
+                print(f"Found {len(containers)} dangling local containers found on {url}.", flush=True)
+                print(f"Trying to stop them...", flush=True)
+                for container in cli.containers.list():
+                    container.kill()
+
+                print(f"Stopped all local containers on {url}", flush=True)
+            else:
+                print(f"No dangling local containers found on {url}", flush=True)
+
+
+class ProcessLauncher(ClientLauncher):
+    """FLClientを、このマシン上の別プロセスとして起動する
+
+    各プロセスのtorchのスレッド数は、threads_per_client (省略時はCPU数をclient数で割った数) にする
+    """
+    global_hostname = "localhost"
+
+    def __init__(self, threads_per_client: Optional[int] = None):
+        self.threads_per_client: Optional[int] = threads_per_client
+        self.processes: list[multiprocessing.Process] = []
+
+
+    def start(self, num_clients: int, env: dict[str, str], edge_ports: Optional[EdgePorts] = None):
+        building_counts = _split_buildings(num_clients, env)
+        num_threads = self.threads_per_client or max(1, (os.cpu_count() or 1) // len(building_counts))
+        # fork後のtorchはスレッドの状態を引き継げないので、spawnで起動する
+        context = multiprocessing.get_context('spawn')
+
+        if edge_ports is not None:
+            # このマシンを1つのノードとして、エッジを1つ起動する
+            ready = context.Event()
+            process = context.Process(target=_run_edge_process, args=(env, edge_ports, ready), daemon=True)
+            process.start()
+            self.processes.append(process)
+
+            _wait_for_edge_process(process, ready)
+            env = _edge_client_env(env, "localhost", edge_ports)
+            print("Started an edge aggregator process.", flush=True)
+
+        for num_buildings in building_counts:
+            process = context.Process(target=_run_client_process, args=(env, num_buildings, num_threads), daemon=True)
+            process.start()
+            self.processes.append(process)
+
+        print(f"Started {len(building_counts)} client processes for {num_clients} buildings "
+              f"({num_threads} threads each).", flush=True)
+
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+
+        self.processes = []
+
+
+class ThreadLauncher(ClientLauncher):
+    """FLClientを、サーバと同じプロセスのスレッドとして起動する (プロファイラでサーバとまとめて見たい場合など)
+
+    スレッドは止められないので、daemonとして起動し、プロセスの終了とともに終わらせる
+    """
+    global_hostname = "localhost"
+
+    def start(self, num_clients: int, env: dict[str, str], edge_ports: Optional[EdgePorts] = None):
+        if edge_ports is not None:
+            _create_edge(env, edge_ports).start()
+            env = _edge_client_env(env, "localhost", edge_ports)
+
+        building_counts = _split_buildings(num_clients, env)
+        for num_buildings in building_counts:
+            threading.Thread(target=_create_client(env, num_buildings).run, daemon=True).start()
+
+        print(f"Started {len(building_counts)} client threads for {num_clients} buildings.", flush=True)
+
+
+def _edge_client_env(env: dict[str, str], edge_host: str, edge_ports: EdgePorts) -> dict[str, str]:
+    """エッジに接続するclientの環境変数 (セッションはエッジとglobalサーバの間でだけ張る)
+    """
+    return dict(
+        env,
+        GLOBAL_HOSTNAME=edge_host,
+        SELECTION_PORT=str(edge_ports.selection_port),
+        REPORTING_PORT=str(edge_ports.reporting_port),
+        FL_SESSION="0")
+
+
+def _split_buildings(num_clients: int, env: dict[str, str]) -> list[int]:
+    """num_clients個のビルを、CLIENT_BUILDINGS個ずつFLClientにまとめた場合の、各FLClientのビルの数
+    """
+    per_client = int(env.get("CLIENT_BUILDINGS", '1'))
+    return [min(per_client, num_clients - i) for i in range(0, num_clients, per_client)]
+
+
+def _create_client(env: dict[str, str], num_buildings: int = 1) -> FLClient:
+    # spawnした子プロセスでも、起動したスクリプトがdistributed_platform.utilsを先に読み込んでいることがあり、
+    # utilsの定数には環境変数が反映されていないので、envから直接設定する
+    from distributed_platform.client import FLClient, PackedFLClient
+
+    kwargs = dict(
+        use_session=env.get("FL_SESSION") == '1',
+        host=env["GLOBAL_HOSTNAME"],
+        selection_port=int(env["SELECTION_PORT"]),
+        reporting_port=int(env["REPORTING_PORT"]))
+
+    return FLClient(**kwargs) if num_buildings == 1 else PackedFLClient(num_buildings, **kwargs)
+
+
+def _create_edge(env: dict[str, str], edge_ports: EdgePorts) -> EdgeAggregator:
+    from distributed_platform.edge import EdgeAggregator
+
+    return EdgeAggregator(
+        global_host=env["GLOBAL_HOSTNAME"],
+        global_selection_port=int(env["SELECTION_PORT"]),
+        global_reporting_port=int(env["REPORTING_PORT"]),
+        selection_port=edge_ports.selection_port,
+        reporting_port=edge_ports.reporting_port,
+        use_session=env.get("FL_SESSION") == '1')
+
+
+def _wait_for_edge_process(process: multiprocessing.Process, ready: multiprocessing.synchronize.Event):
+    """エッジのプロセスがポートを開くのを待つ (ポートが使われているなどで落ちた場合は待たない)
+    """
+    deadline = time.perf_counter() + EDGE_START_TIMEOUT
+    while not ready.wait(EDGE_POLL_INTERVAL):
+        if not process.is_alive():
+            raise RuntimeError(f"Edge aggregator process exited before it started (exit code: {process.exitcode}).")
+        if time.perf_counter() > deadline:
+            raise TimeoutError(f"Edge aggregator process did not start within {EDGE_START_TIMEOUT} sec.")
+
+
+def _run_edge_process(env: dict[str, str], edge_ports: EdgePorts, ready: multiprocessing.synchronize.Event):
+    os.environ.update(env)
+
+    _create_edge(env, edge_ports).start()
+    ready.set()
+    threading.Event().wait()
+
+
+def _run_client_process(env: dict[str, str], num_buildings: int, num_threads: int):
+    os.environ.update(env)
+
+    import torch
+
+    torch.set_num_threads(num_threads)
+    _create_client(env, num_buildings).run()
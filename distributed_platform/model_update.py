@@ -0,0 +1,180 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Literal, NamedTuple, Optional
+import zlib
+
+import numpy as np
+
+from simulator.interfaces.model import ModelCheckpoint
+
+
+Quantization = Literal['float32', 'float16', 'int8']
+QUANTIZATIONS = ('float32', 'float16', 'int8')
+
+# 遅れてきたclientの差分も復元できるよう、サーバはglobalモデルの直近のバージョンをいくつか残しておく
+MAX_KEPT_VERSIONS = 4
+INT8_MAX = 127
+
+
+class EncodedTensor(NamedTuple):
+    """1つのパラメータの差分を、量子化・疎化・圧縮したもの
+    """
+    shape: tuple[int, ...]
+    # 量子化後の型 (浮動小数点数でないパラメータは差分を取らず、元の型のままの値を入れる)
+    dtype: str
+    data: bytes
+    compressed: bool
+    # int8の場合の、1あたりの値
+    scale: float = 1.0
+    # top-kで疎化した場合の、値を持つ要素のflatなindex (uint32, 昇順)
+    indices: Optional[bytes] = None
+    is_delta: bool = True
+
+
+    def decode(self) -> np.ndarray:
+        values = np.frombuffer(self._decompress(self.data), dtype=self.dtype)
+        if values.dtype == np.int8:
+            values = values.astype(np.float32) * np.float32(self.scale)
+
+        if self.indices is None:
+            return values.reshape(self.shape)
+
+        result = np.zeros(int(np.prod(self.shape)), dtype=values.dtype)
+        result[np.frombuffer(self._decompress(self.indices), dtype=np.uint32)] = values
+        return result.reshape(self.shape)
+
+
+    def _decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data) if self.compressed else data
+
+
+@dataclass
+class ModelUpdate:
+    """clientが学習したパラメータの、base_versionのglobalモデルからの差分
+    """
+    base_version: int
+    tensors: dict[str, EncodedTensor]
+
+
+    def apply_to(self, base: ModelCheckpoint) -> ModelCheckpoint:
+        """base_versionのパラメータに差分を足して、clientのパラメータを復元する
+        """
+        checkpoint = {}
+        for key, base_value in base.items():
+            encoded = self.tensors[key]
+            value = encoded.decode()
+
+            if encoded.is_delta:
+                checkpoint[key] = (base_value + value).astype(base_value.dtype, copy=False)
+            else:
+                checkpoint[key] = value.copy()
+
+        return checkpoint
+
+
+    def deltas(self) -> dict[str, np.ndarray]:
+        """浮動小数点数のパラメータの、base_versionからの差分を返す (FedBuffのように、差分のまま集約する場合に使う)
+        """
+        return {key: encoded.decode() for key, encoded in self.tensors.items() if encoded.is_delta}
+
+
+    @property
+    def nbytes(self) -> int:
+        return sum(len(t.data) + (len(t.indices) if t.indices is not None else 0) for t in self.tensors.values())
+
+
+@dataclass(frozen=True)
+class UpdateCodec:
+    """clientからサーバに送るパラメータの差分の形式
+
+    quantization: 差分の値の型 (int8はパラメータごとに最大値で正規化する)
+    topk_ratio: 指定した場合は、絶対値が大きい順にこの割合の要素だけを送る
+    compress: 量子化・疎化したバイト列を、さらにzlibで可逆圧縮するかどうか
+    """
+    quantization: Quantization = 'float32'
+    topk_ratio: Optional[float] = None
+    compress: bool = True
+    compression_level: int = 1
+
+
+    def __post_init__(self):
+        if self.quantization not in QUANTIZATIONS:
+            raise ValueError(f'Unknown quantization: {self.quantization} (must be in {QUANTIZATIONS}).')
+
+        if self.topk_ratio is not None and not 0 < self.topk_ratio <= 1:
+            raise ValueError(f'topk_ratio must be in (0, 1] (got {self.topk_ratio}).')
+
+
+    def encode(self, checkpoint: ModelCheckpoint, base: ModelCheckpoint, base_version: int) -> ModelUpdate:
+        """checkpointのbaseからの差分を、ModelUpdateにする
+        """
+        return ModelUpdate(
+            base_version=base_version,
+            tensors={key: self._encode_tensor(value, base[key]) for key, value in checkpoint.items()}
+        )
+
+
+    def _encode_tensor(self, value: np.ndarray, base: np.ndarray) -> EncodedTensor:
+        if not np.issubdtype(value.dtype, np.floating):
+            return EncodedTensor(
+                value.shape, value.dtype.str, self._compress(np.ascontiguousarray(value)), self.compress, is_delta=False)
+
+        delta = (value - base).ravel()
+        indices = None
+
+        if self.topk_ratio is not None and self.topk_ratio < 1:
+            k = max(1, int(np.ceil(delta.size * self.topk_ratio)))
+            topk = np.sort(np.argpartition(np.abs(delta), -k)[-k:]).astype(np.uint32)
+            delta = delta[topk]
+            indices = self._compress(topk)
+
+        scale = 1.0
+        if self.quantization == 'int8':
+            max_abs = float(np.abs(delta).max(initial=0.0))
+            scale = max_abs / INT8_MAX if max_abs > 0 else 1.0
+            delta = np.rint(delta / scale).astype(np.int8)
+        else:
+            delta = delta.astype(self.quantization)
+
+        return EncodedTensor(value.shape, delta.dtype.str, self._compress(delta), self.compress, scale, indices)
+
+
+    def _compress(self, array: np.ndarray) -> bytes:
+        data = array.tobytes()
+        return zlib.compress(data, self.compression_level) if self.compress else data
+
+
+class VersionedCheckpoint:
+    """サーバが持つglobalモデルのパラメータを、バージョンをつけて管理するもの
+    """
+
+    def __init__(self, checkpoint: ModelCheckpoint, max_versions: int = MAX_KEPT_VERSIONS):
+        self.version: int = 0
+        self.max_versions: int = max_versions
+        self._checkpoints: dict[int, ModelCheckpoint] = {0: checkpoint}
+
+
+    @property
+    def checkpoint(self) -> ModelCheckpoint:
+        return self._checkpoints[self.version]
+
+
+    def get(self, version: int) -> ModelCheckpoint:
+        if version not in self._checkpoints:
+            raise ValueError(f'Version {version} of the global model is no longer kept (current: {self.version}).')
+
+        return self._checkpoints[version]
+
+
+    def apply(self, update: ModelUpdate) -> ModelCheckpoint:
+        return update.apply_to(self.get(update.base_version))
+
+
+    def update(self, checkpoint: ModelCheckpoint) -> int:
+        """新しいバージョンとしてcheckpointを追加し、そのバージョンを返す
+        """
+        self.version += 1
+        self._checkpoints[self.version] = checkpoint
+        self._checkpoints.pop(self.version - self.max_versions, None)
+
+        return self.version
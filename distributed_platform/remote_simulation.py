@@ -1,115 +1,319 @@
 from __future__ import annotations
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
 from itertools import islice
-from typing import Callable, Iterator, NamedTuple, Optional
+from time import perf_counter
+from typing import Any, Callable, Iterator, NamedTuple, Optional, Type, Union
 
 import numpy as np
 from torch.utils.tensorboard import SummaryWriter
 
+from distributed_platform.dataset import DatasetRef
+from distributed_platform.model_update import ModelUpdate, UpdateCodec
 from simulator.area import Area, AreaState
+from simulator.batched import BatchedBuildingFacilitySimulator
 from simulator.bfs import BuildingFacilitySimulator
 from simulator.building import BuildingAction, BuildingState
-from simulator.environment import BuildingEnvironment
+from simulator.environment import BuildingEnvironment, EnvironmentTable
 from simulator.interfaces.config import SimulatorConfig
-from simulator.interfaces.model import RlModel
+from simulator.interfaces.model import ModelCheckpoint, RlModel
+from simulator.metrics import MetricsLogger
+from simulator.policies import WARMUP_POLICIES
+from simulator.recorder import TrajectoryRecorder
+from simulator.reward import CalcReward, VectorizedReward
 
 
 class RemoteSimulatonManager:
     def __init__(
             self, 
             config: SimulatorConfig, 
-            calc_reward: Callable[[BuildingState, BuildingAction], np.ndarray],
-            summary_dir: Optional[str]):
+            calc_reward: Union[CalcReward, VectorizedReward],
+            summary_dir: Optional[str],
+            metrics_downsample: int = 1):
         bfs = BuildingFacilitySimulator(config=config, calc_reward=calc_reward)
 
-        self.env_iter: Iterator[BuildingEnvironment] = bfs.env_iter
+        self.bfs: BuildingFacilitySimulator = bfs
+        self.env_table: EnvironmentTable = bfs.env_table
         self.areas: list[Area] = bfs.areas
         self.start_dt: datetime = bfs.start_time
         self.current_dt: datetime = bfs.start_time
-        self.calc_reward: Callable[[BuildingState, BuildingAction], np.ndarray] = bfs.calc_reward
-        self.summary_writer: Optional[SummaryWriter] = SummaryWriter(summary_dir) if summary_dir else None
+        self.calc_reward: Union[CalcReward, VectorizedReward] = bfs.calc_reward
+        # clientはこのidで、環境変数の時系列をnode-localに保存しておく
+        self.dataset_id: str = self.env_table.digest()
+        # load_checkpointでの書き込みが、reportingを止めないようにバックグラウンドで書き込む
+        self.summary_writer: Optional[MetricsLogger] = MetricsLogger(
+            SummaryWriter(summary_dir), 
+            downsample=metrics_downsample, 
+            aggregations=('mean', 'min', 'max')
+        ) if summary_dir else None
 
-    def create_agent(self, model: RlModel, train_start_dt: datetime, end_dt: datetime):
+    def create_agent(
+            self, 
+            ModelClass: Type[RlModel],
+            model_checkpoint: Optional[ModelCheckpoint],
+            model_version: int,
+            train_start_dt: datetime, 
+            end_dt: datetime, 
+            warmup_policy: Optional[str] = None, 
+            record_warmup_history: bool = True,
+            update_codec: UpdateCodec = UpdateCodec(),
+            include_areas: bool = True,
+            **model_constructor_kwargs):
+        """include_areasがFalseの場合は、clientが前のラウンドで受け取ったエリアを使い回すので、agentに入れない
+        """
+        start_step = int((self.current_dt - self.start_dt).total_seconds()) // 60
         total_steps = int((end_dt - self.current_dt).total_seconds()) // 60
 
-        bfs = BuildingFacilitySimulator._from_models(
-            areas=self.areas,
-            envs=list(islice(self.env_iter, total_steps)),
+        return RemoteSimulaionAgent(
+            snapshot=self.bfs.snapshot(),
+            areas=self.areas if include_areas else None,
             calc_reward=self.calc_reward,
-            start_time=self.current_dt
-        )
-
-        return RemoteSimulaionAgent(bfs=bfs, model=model, train_start_dt=train_start_dt)
+            start_dt=self.current_dt,
+            dataset=DatasetRef(self.dataset_id, start_step, total_steps),
+            ModelClass=ModelClass,
+            model_constructor_kwargs=model_constructor_kwargs,
+            model_checkpoint=model_checkpoint,
+            model_version=model_version,
+            train_start_dt=train_start_dt, 
+            warmup_policy=warmup_policy, 
+            record_warmup_history=record_warmup_history,
+            update_codec=update_codec)
 
     def load_checkpoint(self, checkpoint: RemoteSimulaionCheckpoint):
         assert self.current_dt < checkpoint.current_dt
-        self.areas = checkpoint.areas
+        # self.areasはself.bfs.areasと同じオブジェクトなので、その場で更新される
+        self.bfs.restore(checkpoint.snapshot)
+        self.bfs.seek(checkpoint.current_dt)
         self.current_dt = checkpoint.current_dt
 
+    def write_metrics(self, checkpoint: RemoteSimulaionCheckpoint):
+        if self.summary_writer:
+            checkpoint.write_to_tensorboard(self.summary_writer, self.areas)
+
+    def close(self):
+        """バックグラウンドでの書き込みを終えて、summary_writerを閉じる (以降のwrite_metricsは何もしない)
+        """
         if self.summary_writer:
-            checkpoint.write_to_tensorboard(self.summary_writer)
+            self.summary_writer.close()
+            self.summary_writer = None
 
 
 @dataclass
 class RemoteSimulaionAgent:
-    bfs: BuildingFacilitySimulator
-    model: RlModel
+    # エリア・設備の内部状態は固定長のsnapshotで送り、clientはareasをその時点に戻してから始める
+    snapshot: bytes
+    # エリア・設備のオブジェクトはclientごとに最初のラウンドでだけ送り、以降はclientが持っているものを使い回す
+    areas: Optional[list[Area]]
+    calc_reward: Union[CalcReward, VectorizedReward]
+    start_dt: datetime
+    # 環境変数の時系列そのものは送らず、clientがnode-localに保存したものから読み込む
+    dataset: DatasetRef
+    ModelClass: Type[RlModel]
+    model_constructor_kwargs: dict[str, Any]
+    # global共有するパラメータだけを送り、replay bufferなどはclientのモデルに残す
+    # clientが既にmodel_versionのパラメータを持っている場合はNoneにして、送るのを省略する
+    model_checkpoint: Optional[ModelCheckpoint]
+    model_version: int
     train_start_dt: datetime
+    # train_start_dtまでの区間をfast_forwardで進める際の方策 (simulator.policies.WARMUP_POLICIESのキー)
+    # Noneの場合は、学習時と同じくモデルで行動を選びながら進める
+    warmup_policy: Optional[str] = None
+    record_warmup_history: bool = True
+    update_codec: UpdateCodec = UpdateCodec()
+    # clientで前のラウンドから使い回すモデル (Noneの場合は、simulate_and_trainで作る)
+    model: Optional[RlModel] = None
+    bfs: Optional[BuildingFacilitySimulator] = None
 
-    def simulate_and_train(self) -> RemoteSimulaionCheckpoint:
-        history: list[RemoteSimulationHistory] = []
+    def simulate_and_train(self, env_table: EnvironmentTable) -> RemoteSimulaionCheckpoint:
+        """env_tableには、datasetの範囲の環境変数の時系列を渡す (DatasetStore.resolveで取得できる)
+        """
+        timings: dict[str, float] = {}
+        start = perf_counter()
 
-        print(f"Resume simulation from {self.bfs.get_current_datetime()}", flush=True)
+        history = self._create_simulator(env_table)
 
-        while self.bfs.get_current_datetime() < self.train_start_dt:
-            history.append(self._simulate_1step(False))
+        if self.model is None:
+            self.model = self.bfs.create_rl_model(self.ModelClass, **self.model_constructor_kwargs)
+        self.model.load_checkpoint(self.model_checkpoint)
+        start = _lap(timings, 'client_setup', start)
 
-        print(f"Start training from {self.bfs.get_current_datetime()}.", flush=True)
+        self._warm_up(history)
+        train_start_step = self.bfs.env_step
+        start = _lap(timings, 'client_warmup', start)
 
         while not self.bfs.has_finished():
-            history.append(self._simulate_1step())
+            self._simulate_1step(history)
+        start = _lap(timings, 'client_train', start)
+
+        model_update = self.update_codec.encode(self.model.get_checkpoint(), self.model_checkpoint, self.model_version)
+        snapshot = self.bfs.snapshot()
+        _lap(timings, 'client_encode', start)
         
         return RemoteSimulaionCheckpoint(
-            model=self.model,
-            areas=self.bfs.areas,
+            model_update=model_update,
+            snapshot=snapshot,
             current_dt=self.bfs.get_current_datetime(),
-            history=history
+            history=history,
+            num_samples=self.bfs.env_step - train_start_step,
+            timings=timings
         )
 
-    def _simulate_1step(self, train_model: bool = True) -> RemoteSimulationHistory:
 
-        _, action, reward = self.bfs.step_with_model(self.model, train_model)
-        building_action = BuildingAction.from_ndarray(action, self.bfs.areas)
+    def _create_simulator(self, env_table: EnvironmentTable) -> TrajectoryRecorder:
+        """担当する区間のシミュレータを作り、その区間の履歴を記録するTrajectoryRecorderを返す
+        """
+        assert self.model_checkpoint is not None, \
+            "model_checkpoint must be set to the parameters of model_version before simulation."
+        assert self.areas is not None, "areas must be set to the ones received in the previous round before simulation."
+        assert len(env_table) == self.dataset.length, \
+            f"Length of env_table mismatch. ({len(env_table)} != {self.dataset.length})"
 
-        return RemoteSimulationHistory(
-            steps=self.bfs.cur_steps,
-            state=self.bfs.get_state(),
-            reward=reward,
-            action=building_action
+        self.bfs = BuildingFacilitySimulator._from_models(
+            areas=self.areas,
+            env_table=env_table,
+            calc_reward=self.calc_reward,
+            start_time=self.start_dt,
+            snapshot=self.snapshot
         )
 
+        return TrajectoryRecorder(self.bfs.layout, capacity=len(self.bfs.env_table) - self.bfs.env_step)
+
+
+    def _warm_up(self, history: TrajectoryRecorder):
+        """train_start_dtまで、学習せずにシミュレーションを進める
+        """
+        print(f"Resume simulation from {self.bfs.get_current_datetime()}", flush=True)
+
+        if self.warmup_policy is None:
+            while self.bfs.get_current_datetime() < self.train_start_dt:
+                self._simulate_1step(history, False)
+        else:
+            self.bfs.fast_forward(
+                self.train_start_dt, 
+                action=WARMUP_POLICIES[self.warmup_policy](self.bfs.layout),
+                on_step=(
+                    lambda bfs: history.record(bfs.cur_steps, bfs.get_state_array())
+                ) if self.record_warmup_history else None)
+
+        print(f"Start training from {self.bfs.get_current_datetime()}.", flush=True)
+
+    def _simulate_1step(self, history: TrajectoryRecorder, train_model: bool = True):
+        result = self.bfs.step_with_model(self.model, train_model)
+        history.record(result.steps, result.state_array, result.action_array, result.reward)
+
 
 @dataclass
 class RemoteSimulaionCheckpoint:
-    model: RlModel
-    areas: list[Area]
+    model_update: ModelUpdate
+    snapshot: bytes
     current_dt: datetime
-    history: list[RemoteSimulationHistory]
+    # pickleすると1つの連続したndarrayになる
+    history: TrajectoryRecorder
+    # モデルを学習させたstep数 (FedAvgの重みに使う)
+    num_samples: int
+    # clientでの各フェーズの所要時間 [sec] (distributed_platform.timeline.RoundTimelineに記録する)
+    timings: dict[str, float] = field(default_factory=dict)
 
 
-    def write_to_tensorboard(self, writer: SummaryWriter):
-        for history in self.history:
-            writer.add_scalar("reward", history.reward, history.steps)
+    def write_to_tensorboard(self, writer: MetricsLogger, areas: list[Area]):
+        steps = self.history['step']
+
+        # fast_forwardで進めたstepの報酬はNaNになっている
+        reward = self.history['reward'][:, 0]
+        has_reward = ~np.isnan(reward)
+        writer.add_scalars("reward", reward[has_reward], steps[has_reward])
+
+        temperature = self.history['area_temperature']
+        power_consumption = self.history['area_power_consumption']
+        for area_idx, area in enumerate(areas):
+            writer.add_scalars(f"temperature_{area.name}", temperature[:, area_idx], steps)
+            writer.add_scalars(f"power_consumption_{area.name}", power_consumption[:, area_idx], steps)
+
+
+@dataclass
+class EdgeReport:
+    """同じタグの複数のclientの報告を、1つのパラメータの差分にまとめたもの
+
+    エッジ集約サーバ (distributed_platform.edge) と、複数のビルを担当するPackedFLClientが送る
+    """
+    tag: str
+    # clientのパラメータをサンプル数で重み付けして平均したものの、base_versionからの差分
+    model_update: ModelUpdate
+    num_samples: int
+    # clientごとの報告 (パラメータの差分は除き、シミュレータの状態などだけを残す)
+    client_checkpoints: dict[int, RemoteSimulaionCheckpoint]
+
+
+def simulate_and_train_batch(
+        agents: list[RemoteSimulaionAgent],
+        env_tables: list[EnvironmentTable],
+        model: Optional[RlModel] = None
+) -> tuple[RlModel, ModelUpdate, list[RemoteSimulaionCheckpoint]]:
+    """同じバージョンのglobalモデルで同じ区間を担当する複数のagentのビルを、まとめて進めて1つのモデルで学習する
+
+    学習する区間はBatchedBuildingFacilitySimulatorで全ビルを同時に進め、行動はmodelでまとめて推論する。
+    modelはclientがタグごとに使い回すもの (Noneの場合は作る) で、学習したモデルとそのパラメータの差分、
+    各ビルの報告 (パラメータの差分は含めない) を返す。
+    """
+    first = agents[0]
+    if len({BatchedBuildingFacilitySimulator.get_structure(agent.areas) for agent in agents}) != 1:
+        raise ValueError("All buildings must have the same areas and facilities to be simulated in a batch.")
+
+    timings: dict[str, float] = {}
+    start = perf_counter()
+
+    histories = [agent._create_simulator(env_table) for agent, env_table in zip(agents, env_tables)]
+    if model is None:
+        model = first.bfs.create_rl_model(first.ModelClass, **first.model_constructor_kwargs)
+    model.load_checkpoint(first.model_checkpoint)
+    start = _lap(timings, 'client_setup', start)
+
+    for agent, history in zip(agents, histories):
+        # warmup_policyがNoneの場合は、学習時と同じモデルで行動を選ぶ
+        agent.model = model
+        agent._warm_up(history)
+
+    if len({agent.bfs.cur_steps for agent in agents}) != 1:
+        raise ValueError("All buildings must start training from the same step to be simulated in a batch.")
+    batched = BatchedBuildingFacilitySimulator([agent.bfs for agent in agents])
+    train_start_step = batched.cur_steps
+    start = _lap(timings, 'client_warmup', start)
+
+    while not batched.has_finished():
+        states = batched.get_state_array()
+        actions = model.select_actions(states)
+        result = batched.step(actions)
+        model.add_batch_to_buffer(states, actions, result.state_array, result.reward)
+
+        for history, state, action, reward in zip(histories, result.state_array, actions, result.reward):
+            history.record(batched.cur_steps, state, action, reward)
+
+    # スナップショットは元のシミュレータのArea/Facilityから作るので、SoAの状態を書き戻す
+    batched.sync_to_simulators()
+    start = _lap(timings, 'client_train', start)
+
+    model_update = first.update_codec.encode(model.get_checkpoint(), first.model_checkpoint, first.model_version)
+    snapshots = [agent.bfs.snapshot() for agent in agents]
+    _lap(timings, 'client_encode', start)
+
+    # 各フェーズは全ビルでまとめて行うので、どのビルの所要時間もその全体の時間にする
+    checkpoints = [
+        RemoteSimulaionCheckpoint(
+            model_update=ModelUpdate(first.model_version, {}),
+            snapshot=snapshot,
+            current_dt=agent.bfs.get_current_datetime(),
+            history=history,
+            num_samples=batched.cur_steps - train_start_step,
+            timings=dict(timings)
+        )
+        for agent, history, snapshot in zip(agents, histories, snapshots)
+    ]
 
-            for area, area_state, area_action in zip(self.areas, history.state.areas, history.action.areas):
+    return model, model_update, checkpoints
 
-                writer.add_scalar(f"temperature_{area.name}", area_state.temperature, history.steps)
-                writer.add_scalar(f"power_consumption_{area.name}", area_state.power_consumption, history.steps)
 
+def _lap(timings: dict[str, float], phase: str, start: float) -> float:
+    now = perf_counter()
+    timings[phase] = now - start
 
-class RemoteSimulationHistory(NamedTuple):
-    steps: int
-    state: BuildingState
-    reward: np.ndarray
-    action: BuildingAction
+    return now
@@ -4,27 +4,28 @@ from datetime import datetime, timedelta
 from pathlib import Path
 from random import shuffle
 import socket
-import pickle
 import threading
 from queue import Queue
 import time
-from typing import Any, Callable, Optional, Type, TypeVar
+from typing import Any, Callable, Optional, Type, TypeVar, Union
 
 import numpy as np
 
-from distributed_platform.remote_simulation import RemoteSimulaionCheckpoint, RemoteSimulatonManager
-from distributed_platform.utils import SELECTION_PORT, REPORTING_PORT, recv_all, send_all
+from distributed_platform.model_update import UpdateCodec, VersionedCheckpoint
+from distributed_platform.remote_simulation import EdgeReport, RemoteSimulaionCheckpoint, RemoteSimulatonManager
+from distributed_platform.timeline import RoundTimeline
+from distributed_platform.utils import SELECTION_PORT, REPORTING_PORT
+from distributed_platform.wire import MessageStats, recv_message, send_message
 from simulator.bfs import BuildingFacilitySimulator
 from simulator.building import BuildingAction, BuildingState
+from simulator.environment import EnvironmentTable
 from simulator.interfaces.config import SimulatorConfig
-from simulator.interfaces.model import RlModel
+from simulator.interfaces.model import CheckpointAggregator, ModelCheckpoint, RlModel
+from simulator.reward import CalcReward, VectorizedReward
 
-CalcReward = Callable[[BuildingState, BuildingAction], np.ndarray]
 M = TypeVar('M', bound=RlModel)
 
 class FLServer():
-    # TODO: サーバを建てるportを指定できるようにすることで、
-    #     : ModelClassごとに複数建てられるようにすれば良さそう
     def __init__(
             self, 
             ModelClass: Type[M],
@@ -32,42 +33,61 @@ class FLServer():
             total_steps: int, 
             steps_per_round: int, 
             round_client_num: int, 
-            model_aggregation: Callable[[list[M]], M],
+            model_aggregation: Callable[[], CheckpointAggregator],
             config_paths_with_tag: list[tuple[Path, str]],
-            tag_to_calc_reward: dict[str, CalcReward],
+            tag_to_calc_reward: dict[str, Union[CalcReward, VectorizedReward]],
+            warmup_policy: Optional[str] = None,
+            record_warmup_history: bool = True,
+            metrics_downsample: int = 1,
+            update_codec: UpdateCodec = UpdateCodec(),
+            selection_port: int = SELECTION_PORT,
+            reporting_port: int = REPORTING_PORT,
             **model_constructor_kwargs):
 
         self.ModelClass: Type[M] = ModelClass
         self.model_constructor_kwargs: dict[str, Any] = model_constructor_kwargs
         
         self.experiment_id = str(datetime.now())
+        self.log_dir: Path = Path(f"./logs/distributed-platform-on-cluster/{self.experiment_id}")
+        self.timeline: RoundTimeline = RoundTimeline()
         self.cur_time: datetime = start_time
         self.end_time: datetime = start_time + timedelta(minutes=total_steps)
         self.steps_per_round: int = steps_per_round
         self.round_client_num: int = round_client_num
-        self.model_aggregation: Callable[[list[M]], M] = model_aggregation
+        # ラウンド・タグごとに作り、届いたcheckpointから順に足し込む (全clientのcheckpointを持っておかなくてよい)
+        self.model_aggregation: Callable[[], CheckpointAggregator] = model_aggregation
 
         self.managers: list[RemoteSimulatonManager] = list()
         self.client_id_to_tag: list[str] = list()
         self.config_paths_with_tag: deque[tuple[Path, str]] = deque(config_paths_with_tag)
         shuffle(self.config_paths_with_tag)
         self.tag_to_selected_client_queue: defaultdict[str, Queue[tuple[socket.socket, socket._RetAddress, dict]]] = defaultdict(Queue)
-        self.tag_to_global_model: dict[str, Optional[M]] = dict()
+        self.tag_to_global_model: dict[str, VersionedCheckpoint] = dict()
+        # clientのnode-localに保存されていない時系列を送るため、dataset_idから引けるようにしておく
+        self.dataset_id_to_env_table: dict[str, EnvironmentTable] = dict()
 
         self.selection_socket: socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.selection_socket.bind(('0.0.0.0', SELECTION_PORT))
+        self.selection_socket.bind(('0.0.0.0', selection_port))
         self.selection_socket.listen()
 
         self.reporting_socket: socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.reporting_socket.bind(('0.0.0.0', REPORTING_PORT))
+        self.reporting_socket.bind(('0.0.0.0', reporting_port))
         self.reporting_socket.listen()
 
         self.tag_to_calc_reward = tag_to_calc_reward
 
+        self.warmup_policy: Optional[str] = warmup_policy
+        self.record_warmup_history: bool = record_warmup_history
+        self.metrics_downsample: int = metrics_downsample
+        self.update_codec: UpdateCodec = update_codec
+
 
     def run(self):
         self._start_selection_thread()
-        self._exec_fl_process()
+        try:
+            self._exec_fl_process()
+        finally:
+            self.close_metrics()
     
 
     def _start_selection_thread(self):
@@ -76,7 +96,7 @@ class FLServer():
         print("Started the Global Server!", flush=True)
     
 
-    def _exec_fl_proccess(self):
+    def _exec_fl_process(self):
         while self.cur_time < self.end_time:
             time.sleep(0.1)
 
@@ -90,10 +110,27 @@ class FLServer():
 
 
     def selection_phase(self):
-        while self.cur_time < self.end_time:
+        # 最後のラウンドでも、clientが時系列を受け取りに来るので、サーバが止まるまで受け付ける
+        while True:
             (connection, client) = self.selection_socket.accept()
                 
-            req = pickle.loads(recv_all(connection))
+            req = recv_message(connection)
+            req['received_at'] = time.perf_counter()
+            if req['message'] == 'dataset':
+                self._send_dataset(connection, req['dataset_id'])
+                continue
+
+            if req['message'] == 'model':
+                send_message(self._create_model_response(req['tag'], req['version']), connection)
+                connection.close()
+                continue
+
+            if req['message'] == 'session':
+                # セッションはAsyncFLServerとそのサブクラスのみが対応している
+                print(f"[SELECTOR] Rejected session from {client[0]} (use AsyncFLServer for sessions).", flush=True)
+                connection.close()
+                continue
+
             req['client_id'] = req['client_id'] if req['client_id'] != None else self._init_client(client)
             tag = self.client_id_to_tag[req['client_id']]
 
@@ -109,22 +146,13 @@ class FLServer():
         for _ in range(self.round_client_num):
             for tag in set(self.client_id_to_tag):
                 conn, client, req = self.tag_to_selected_client_queue[tag].get()
-
-                client_id: int = req['client_id']
+                resp = self._create_agent_response(tag, req, end_time)
                 
-                # TODO: 選択しなかった場合は、何分後にretryしてねという情報を入れる
-                resp = dict(
-                    client_id=client_id,
-                    agent=self.managers[client_id].create_agent(
-                        model=self.tag_to_global_model[tag], 
-                        train_start_dt=self.cur_time, 
-                        end_dt=end_time
-                    )
-                )
+                print(f"Sending global model to {self._to_client_str(req['client_id'], client)}...", flush=True)
                 
-                print(f"Sending global model to {self._to_client_str(client_id, client)}...", flush=True)
-                
-                send_all(pickle.dumps(resp), conn)
+                start = time.perf_counter()
+                nbytes = send_message(resp, conn)
+                self.timeline.record(resp['agent'].model_version, 'send_agent', start, req['client_id'], tag, nbytes)
         
         self.cur_time = end_time
     
@@ -135,34 +163,205 @@ class FLServer():
         # TODO: 遅すぎるクライアントへの対応
 
         connections = []
-        tag_to_models: defaultdict[str, list[RlModel]] = defaultdict(list)
+        tag_to_aggregator: defaultdict[str, CheckpointAggregator] = defaultdict(self.model_aggregation)
 
-        for _ in range(self.round_client_num * len(self.tag_to_global_model)):
+        # エッジ集約サーバからの報告は、まとめたclientの数だけ数える
+        reported_client_num = 0
+        while reported_client_num < self.round_client_num * len(self.tag_to_global_model):
             (connection, client) = self.reporting_socket.accept()
                 
-            req = pickle.loads(recv_all(connection))
-
-            client_id = req['client_id']
-            tag = self.client_id_to_tag[client_id]
-
-            print(f"Got report from {self._to_client_str(client_id, client)}.", flush=True)
-
-            checkpoint: RemoteSimulaionCheckpoint = req['checkpoint']
-            self.managers[client_id].load_checkpoint(checkpoint)
-            
+            stats = MessageStats()
+            req = recv_message(connection, stats)
+            req['recv_stats'] = stats
             connections.append(connection)
-            tag_to_models[tag].append(checkpoint.model)
+
+            if req['message'] == 'edge_report':
+                report: EdgeReport = req['checkpoint']
+                print(f"Got reports of clients {list(report.client_checkpoints)} from {client[0]}.", flush=True)
+
+                client_id, tag, num_samples = None, report.tag, report.num_samples
+                self._record_edge_report(req)
+                params = self._load_edge_report(report)
+                reported_client_num += len(report.client_checkpoints)
+            else:
+                client_id = req['client_id']
+                tag = self.client_id_to_tag[client_id]
+                print(f"Got report from {self._to_client_str(client_id, client)}.", flush=True)
+
+                checkpoint: RemoteSimulaionCheckpoint = req['checkpoint']
+                num_samples = checkpoint.num_samples
+                self._record_report(req)
+                params = self._load_report(client_id, checkpoint)
+                reported_client_num += 1
+
+            start = time.perf_counter()
+            tag_to_aggregator[tag].add(params, num_samples)
+            self.timeline.record(self.tag_to_global_model[tag].version, 'aggregate_add', start, client_id, tag)
         
         print("Updated global model with FedAvg!", flush=True)
-        for tag, models in tag_to_models.items():
-            self.tag_to_global_model[tag] = self.model_aggregation(models)
-            print(f"Aggregated into global model for tag: {tag}!", flush=True)
+        for tag, aggregator in tag_to_aggregator.items():
+            self._finish_aggregation(tag, aggregator)
 
         for conn in connections:
-            send_all(pickle.dumps({'success': True}), conn)
+            send_message({'success': True}, conn)
             conn.close()
     
 
+    def _create_agent_response(
+            self, tag: str, req: dict[str, Any], end_time: datetime, train_start_dt: Optional[datetime] = None
+    ) -> dict[str, Any]:
+        """selectionで受け取ったreqに対して、train_start_dt(省略時はcur_time)からend_timeまでを担当するagentを返す
+        """
+        client_id: int = req['client_id']
+        global_model = self.tag_to_global_model[tag]
+        # 既に最新のglobalモデルを持っているclientと、別に受け取るエッジ集約サーバには、パラメータを送らない
+        has_latest_model = req.get('omit_model', False) or req.get('model_version') == global_model.version
+
+        start = self.timeline.record(global_model.version, 'selection_wait', req['received_at'], client_id, tag)
+
+        # TODO: 選択しなかった場合は、何分後にretryしてねという情報を入れる
+        resp = dict(
+            client_id=client_id,
+            # エッジ集約サーバが、タグごとにglobalモデルを持っておくのに使う
+            tag=tag,
+            agent=self.managers[client_id].create_agent(
+                ModelClass=self.ModelClass,
+                model_checkpoint=None if has_latest_model else global_model.checkpoint, 
+                model_version=global_model.version,
+                train_start_dt=train_start_dt or self.cur_time, 
+                end_dt=end_time,
+                warmup_policy=self.warmup_policy,
+                record_warmup_history=self.record_warmup_history,
+                update_codec=self.update_codec,
+                # 既にエリアを持っているclientには、snapshotだけを送る
+                include_areas=not req.get('has_areas', False),
+                **self.model_constructor_kwargs
+            )
+        )
+        self.timeline.record(global_model.version, 'create_agent', start, client_id, tag)
+
+        return resp
+
+
+    def _load_report(self, client_id: int, checkpoint: RemoteSimulaionCheckpoint) -> ModelCheckpoint:
+        """clientの報告でシミュレータの状態を更新し、clientが学習したパラメータを返す
+        """
+        tag = self.client_id_to_tag[client_id]
+        self._restore_report(client_id, checkpoint)
+
+        # clientが受け取ったバージョンのパラメータに、差分を足して復元する
+        start = time.perf_counter()
+        params = self.tag_to_global_model[tag].apply(checkpoint.model_update)
+        self.timeline.record(checkpoint.model_update.base_version, 'decode_update', start, client_id, tag)
+
+        return params
+
+
+    def _load_edge_report(self, report: EdgeReport) -> ModelCheckpoint:
+        """エッジ集約サーバがまとめた報告で各clientのシミュレータの状態を更新し、エッジで平均したパラメータを返す
+        """
+        for client_id, checkpoint in report.client_checkpoints.items():
+            self._restore_report(client_id, checkpoint)
+
+        start = time.perf_counter()
+        params = self.tag_to_global_model[report.tag].apply(report.model_update)
+        self.timeline.record(report.model_update.base_version, 'decode_update', start, tag=report.tag)
+
+        return params
+
+
+    def _restore_report(self, client_id: int, checkpoint: RemoteSimulaionCheckpoint):
+        """clientの報告でシミュレータの状態を更新し、TensorBoardに書き込む
+        """
+        round, tag = checkpoint.model_update.base_version, self.client_id_to_tag[client_id]
+        manager = self.managers[client_id]
+
+        start = time.perf_counter()
+        manager.load_checkpoint(checkpoint)
+        start = self.timeline.record(round, 'load_checkpoint', start, client_id, tag)
+
+        manager.write_metrics(checkpoint)
+        self.timeline.record(round, 'tensorboard', start, client_id, tag)
+
+
+    def _record_report(self, req: dict[str, Any]):
+        """報告の受信と、clientでの各フェーズの所要時間を記録する
+        """
+        client_id: int = req['client_id']
+        checkpoint: RemoteSimulaionCheckpoint = req['checkpoint']
+        stats: MessageStats = req['recv_stats']
+        round, tag = checkpoint.model_update.base_version, self.client_id_to_tag[client_id]
+
+        self.timeline.record(round, 'report_recv', stats.started_at, client_id, tag, stats.nbytes, stats.recv_sec)
+        self.timeline.record(
+            round, 'report_unpickle', stats.started_at + stats.recv_sec, client_id, tag, duration=stats.unpickle_sec)
+        self.timeline.record_client(round, client_id, tag, checkpoint.timings)
+
+
+    def _record_edge_report(self, req: dict[str, Any]):
+        """エッジ集約サーバからの報告の受信 (client_idはNone) と、まとめられた各clientでの所要時間を記録する
+        """
+        report: EdgeReport = req['checkpoint']
+        stats: MessageStats = req['recv_stats']
+        round, tag = report.model_update.base_version, report.tag
+
+        self.timeline.record(round, 'report_recv', stats.started_at, tag=tag, nbytes=stats.nbytes, duration=stats.recv_sec)
+        self.timeline.record(
+            round, 'report_unpickle', stats.started_at + stats.recv_sec, tag=tag, duration=stats.unpickle_sec)
+        for client_id, checkpoint in report.client_checkpoints.items():
+            self.timeline.record_client(round, client_id, tag, checkpoint.timings)
+
+
+    def _finish_aggregation(self, tag: str, aggregator: CheckpointAggregator):
+        start = time.perf_counter()
+        round = self.tag_to_global_model[tag].version
+        self._update_global_model(tag, aggregator.result())
+        self.timeline.record(round, 'aggregate', start, tag=tag)
+
+
+    def write_timeline(self):
+        """各ラウンドのタイムラインを、log_dirにJSONとCSVで書き出す
+        """
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        self.timeline.write_json(self.log_dir / "timeline.json")
+        self.timeline.write_csv(self.log_dir / "timeline.csv")
+
+        print(f"Wrote the round timeline to {self.log_dir}.", flush=True)
+
+
+    def close_metrics(self):
+        """各clientのtensorboardへの書き込みを終えて閉じる (書き込みのスレッドはdaemonなので、閉じないと残りが失われる)
+        """
+        for manager in self.managers:
+            manager.close()
+
+
+    def _update_global_model(self, tag: str, checkpoint: ModelCheckpoint):
+        version = self.tag_to_global_model[tag].update(checkpoint)
+        print(f"Aggregated into global model for tag: {tag} (version: {version})!", flush=True)
+
+
+    def _send_dataset(self, conn: socket.socket, dataset_id: str):
+        send_message(self._create_dataset_response(dataset_id), conn)
+        conn.close()
+
+
+    def _create_model_response(self, tag: str, version: int) -> dict[str, Any]:
+        print(f"[SELECTOR] Sending global model (tag: {tag}, version: {version})...", flush=True)
+        return dict(checkpoint=self.tag_to_global_model[tag].get(version))
+
+
+    def _create_dataset_response(self, dataset_id: str) -> dict[str, Any]:
+        env_table = self.dataset_id_to_env_table[dataset_id]
+        print(f"[SELECTOR] Sending dataset {dataset_id} ({len(env_table)} steps)...", flush=True)
+
+        # メモリマップされた列も、out-of-bandで送れるようにndarrayにする
+        return dict(env_table=EnvironmentTable(
+            external=np.asarray(env_table.external),
+            areas=[None if area is None else np.asarray(area) for area in env_table.areas]
+        ))
+    
+
     def _wait_for_clients(self, client_num: int):
         print(f"Waiting for {client_num} clients to respond...", flush=True)
         
@@ -181,16 +380,19 @@ class FLServer():
         self.client_id_to_tag.append(tag)
         
         config = SimulatorConfig.parse_file(config_path)
-        self.managers.append(
-            RemoteSimulatonManager(
-                config=config,
-                calc_reward=self.tag_to_calc_reward[tag],
-                summary_dir=f"./logs/distributed-platform-on-cluster/{self.experiment_id}/{tag}/{config_path.stem}"
-            ))
+        manager = RemoteSimulatonManager(
+            config=config,
+            calc_reward=self.tag_to_calc_reward[tag],
+            summary_dir=str(self.log_dir / tag / config_path.stem),
+            metrics_downsample=self.metrics_downsample
+        )
+        self.managers.append(manager)
+        self.dataset_id_to_env_table[manager.dataset_id] = manager.env_table
 
         if tag not in self.tag_to_global_model:
-            self.tag_to_global_model[tag] = BuildingFacilitySimulator(config, self.tag_to_calc_reward[tag])\
-                .create_rl_model(self.ModelClass, **self.model_constructor_kwargs)
+            self.tag_to_global_model[tag] = VersionedCheckpoint(
+                BuildingFacilitySimulator(config, self.tag_to_calc_reward[tag])
+                .create_rl_model(self.ModelClass, **self.model_constructor_kwargs).get_checkpoint())
 
         print(f"- Initialized simulator for {self._to_client_str(client_id, client)} (tag: {tag}) using {config_path}.", flush=True)
 
@@ -0,0 +1,223 @@
+"""FLClientとFLServerの間に張り続ける、多重化された接続 (セッション)
+
+clientは最初にselectionのポートへ {'message': 'session'} を送り、以降のhello・dataset・reportを全てこの接続で送る。
+各リクエストにはrequest_idをつけ、サーバは返信にreply_toとして同じ値を入れるので、複数のリクエストを同時に送れる。
+helloへの返信 (次に担当する区間) は、サーバがそのclientを選んだ時点で送られてくるので、ラウンドごとに接続し直さなくてよい。
+clientはheartbeat_intervalごとにheartbeatを送り、サーバはsession_timeoutの間何も届かなければ、clientが落ちたとみなす。
+"""
+from __future__ import annotations
+import asyncio
+from concurrent.futures import Executor, Future
+import itertools
+import socket
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional, Protocol
+
+from distributed_platform.wire import MessageStats, recv_message, recv_message_async, send_message, send_message_async
+
+
+HEARTBEAT_INTERVAL = 5.0
+SESSION_TIMEOUT = 30.0
+
+
+class Channel(Protocol):
+    """サーバが1つのリクエストに返信するための経路
+    """
+    async def reply(self, payload: dict[str, Any]) -> int:
+        """payloadを返信し、送ったバイト数を返す
+        """
+        ...
+
+    async def fail(self, error: Exception):
+        ...
+
+    def bind(self, client_id: int):
+        ...
+
+
+class OneShotChannel:
+    """リクエストごとに接続する従来のclientへの返信 (返信したら接続を閉じる)
+    """
+
+    def __init__(self, conn: socket.socket, executor: Optional[Executor] = None):
+        self.conn: socket.socket = conn
+        self.executor: Optional[Executor] = executor
+
+
+    async def reply(self, payload: dict[str, Any]) -> int:
+        try:
+            return await send_message_async(payload, self.conn, self.executor)
+        finally:
+            self.conn.close()
+
+
+    async def fail(self, error: Exception):
+        self.conn.close()
+
+
+    def bind(self, client_id: int):
+        pass
+
+
+class SessionChannel:
+    """セッション上のリクエストへの返信
+    """
+
+    def __init__(self, session: ServerSession, request_id: int):
+        self.session: ServerSession = session
+        self.request_id: int = request_id
+
+
+    async def reply(self, payload: dict[str, Any]) -> int:
+        return await self.session.send(dict(payload, reply_to=self.request_id))
+
+
+    async def fail(self, error: Exception):
+        await self.session.send(dict(error=repr(error), reply_to=self.request_id))
+
+
+    def bind(self, client_id: int):
+        self.session.client_ids.add(client_id)
+
+
+class ServerSession:
+    """サーバ側で1つのclientとのセッションを管理するもの (イベントループ上で使う)
+    """
+
+    def __init__(self, conn: socket.socket, client: socket._RetAddress, executor: Optional[Executor] = None):
+        self.conn: socket.socket = conn
+        self.client: socket._RetAddress = client
+        self.executor: Optional[Executor] = executor
+        # helloを処理するまではわからない (エッジ集約サーバは、同じノードの複数のclientのリクエストを送ってくる)
+        self.client_ids: set[int] = set()
+        self.last_seen: float = time.monotonic()
+        self._send_lock = asyncio.Lock()
+
+
+    async def serve(self, handler: Callable[[dict[str, Any], Channel, socket._RetAddress], Awaitable[None]]):
+        """接続が閉じるまでリクエストを受け取り、それぞれhandlerで並行に処理する
+        """
+        try:
+            while True:
+                stats = MessageStats()
+                req = await recv_message_async(self.conn, self.executor, stats)
+                self.last_seen = time.monotonic()
+
+                if req['message'] != 'heartbeat':
+                    # サーバのタイムラインに記録するため、受信した時刻と受信にかかった時間を入れておく
+                    req['received_at'], req['recv_stats'] = time.perf_counter(), stats
+                    asyncio.create_task(handler(req, SessionChannel(self, req['request_id']), self.client))
+
+        except (ConnectionError, OSError):
+            pass
+
+        finally:
+            self.conn.close()
+
+
+    async def send(self, payload: dict[str, Any]) -> int:
+        # 複数のリクエストへの返信が、途中で混ざらないようにする
+        async with self._send_lock:
+            return await send_message_async(payload, self.conn, self.executor)
+
+
+    def has_expired(self, timeout: float) -> bool:
+        return time.monotonic() - self.last_seen > timeout
+
+
+    def expire(self):
+        """serveの受信を終わらせる (ソケットはserveの中で閉じる)
+        """
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class ClientSession:
+    """client側のセッション (スレッドから使う)
+
+    受信用のスレッドが返信をrequest_idごとのFutureに振り分け、heartbeat用のスレッドが定期的にheartbeatを送る
+    """
+
+    def __init__(self, address: tuple[str, int], heartbeat_interval: float = HEARTBEAT_INTERVAL):
+        self.conn: socket.socket = socket.create_connection(address)
+        self._request_ids = itertools.count()
+        self._pending: dict[int, Future] = {}
+        self._pending_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._closed = threading.Event()
+
+        self._send({'message': 'session'})
+        threading.Thread(target=self._recv_loop, daemon=True).start()
+        threading.Thread(target=self._heartbeat_loop, args=(heartbeat_interval,), daemon=True).start()
+
+
+    @property
+    def closed(self) -> bool:
+        return self._closed.is_set()
+
+
+    def request(self, payload: dict[str, Any]) -> dict[str, Any]:
+        """payloadを送り、返信が届くまで待つ
+        """
+        return self.submit(payload).result()
+
+
+    def submit(self, payload: dict[str, Any]) -> Future:
+        request_id = next(self._request_ids)
+        future: Future = Future()
+
+        with self._pending_lock:
+            if self.closed:
+                raise ConnectionError("Session is already closed.")
+            self._pending[request_id] = future
+
+        self._send(dict(payload, request_id=request_id))
+        return future
+
+
+    def close(self):
+        self._closed.set()
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+    def _send(self, payload: dict[str, Any]):
+        with self._send_lock:
+            send_message(payload, self.conn)
+
+
+    def _recv_loop(self):
+        try:
+            while True:
+                resp = recv_message(self.conn)
+                with self._pending_lock:
+                    future = self._pending.pop(resp.pop('reply_to'))
+
+                if 'error' in resp:
+                    future.set_exception(RuntimeError(f"Server failed to handle the request: {resp['error']}"))
+                else:
+                    future.set_result(resp)
+
+        except (ConnectionError, OSError) as e:
+            with self._pending_lock:
+                self._closed.set()
+                pending, self._pending = self._pending, {}
+
+            for future in pending.values():
+                future.set_exception(ConnectionError(f"Session closed: {e}"))
+
+        finally:
+            self.conn.close()
+
+
+    def _heartbeat_loop(self, interval: float):
+        while not self._closed.wait(interval):
+            try:
+                self._send({'message': 'heartbeat'})
+            except OSError:
+                return
@@ -0,0 +1,100 @@
+from __future__ import annotations
+from collections import defaultdict
+import csv
+import json
+from pathlib import Path
+import threading
+from time import perf_counter
+from typing import NamedTuple, Optional
+
+
+class TimelineEvent(NamedTuple):
+    # そのフェーズで扱ったglobalモデルのバージョン (同期的なサーバではラウンドの番号と同じ)
+    round: int
+    client_id: Optional[int]
+    tag: Optional[str]
+    phase: str
+    # サーバを起動してからの経過時間 (clientで計測したフェーズは、サーバと時計が違うのでNone)
+    start_sec: Optional[float]
+    duration_sec: float
+    nbytes: Optional[int] = None
+
+
+class RoundTimeline:
+    """FLのラウンド・clientごとに、各フェーズにかかった時間を記録するもの
+
+    サーバで計測するフェーズ:
+        selection_wait: helloを受け取ってから、agentを作り始めるまで
+        create_agent: agent (シミュレータのスナップショットとglobalモデル) を作る時間
+        send_agent: agentのpickleと送信 (nbytesは送ったバイト数)
+        report_recv, report_unpickle: 報告の受信とunpickle (nbytesは受け取ったバイト数)
+        load_checkpoint, tensorboard: 報告でシミュレータの状態を更新し、TensorBoardに書き込む時間
+        decode_update: パラメータの差分の復元
+        aggregate_add: 集約に1つのcheckpointを足す時間
+        aggregate: タグごとの集約の仕上げ (client_idはNone)
+    clientで計測し、報告に含めて送られてくるフェーズは "client_" で始まる
+    """
+
+    def __init__(self):
+        self.origin: float = perf_counter()
+        self.events: list[TimelineEvent] = []
+        # サーバの複数のスレッドから記録される
+        self._lock = threading.Lock()
+
+
+    def record(
+            self,
+            round: int,
+            phase: str,
+            start: float,
+            client_id: Optional[int] = None,
+            tag: Optional[str] = None,
+            nbytes: Optional[int] = None,
+            duration: Optional[float] = None) -> float:
+        """start (perf_counter) からの経過時間、またはdurationをphaseとして記録し、終了時刻を返す
+        """
+        end = perf_counter() if duration is None else start + duration
+        with self._lock:
+            self.events.append(
+                TimelineEvent(round, client_id, tag, phase, start - self.origin, end - start, nbytes))
+
+        return end
+
+
+    def record_client(self, round: int, client_id: int, tag: str, timings: dict[str, float]):
+        """clientで計測したフェーズの所要時間を記録する
+        """
+        with self._lock:
+            self.events.extend(
+                TimelineEvent(round, client_id, tag, phase, None, duration) for phase, duration in timings.items())
+
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """フェーズごとの合計・平均時間 (合計の大きい順)
+        """
+        phase_to_durations: defaultdict[str, list[float]] = defaultdict(list)
+        with self._lock:
+            for event in self.events:
+                phase_to_durations[event.phase].append(event.duration_sec)
+
+        return {
+            phase: dict(total_sec=sum(durations), mean_sec=sum(durations) / len(durations), count=len(durations))
+            for phase, durations in sorted(phase_to_durations.items(), key=lambda item: -sum(item[1]))
+        }
+
+
+    def write_json(self, path: Path):
+        with self._lock:
+            events = [event._asdict() for event in self.events]
+
+        Path(path).write_text(json.dumps(dict(summary=self.summary(), events=events), indent=4))
+
+
+    def write_csv(self, path: Path):
+        with self._lock:
+            events = list(self.events)
+
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(TimelineEvent._fields)
+            writer.writerows(events)
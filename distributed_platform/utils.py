@@ -3,26 +3,18 @@ import numpy as np
 
 from simulator.building import BuildingAction, BuildingState
 
-BUFF_SIZE = 65536
 GLOBAL_HOSTNAME = os.environ.get("GLOBAL_HOSTNAME", 'global')
 SELECTION_PORT = int(os.environ.get("SELECTION_PORT", '11113'))
 REPORTING_PORT = int(os.environ.get("REPORTING_PORT", '11114'))
-
-def recv_all(conn):
-    data_len = int.from_bytes(conn.recv(4), 'little')
-
-    data = bytearray()
-    while data_len > 0:
-        packet = conn.recv(BUFF_SIZE)
-        data += packet
-        data_len -= len(packet)
-    
-    return data
-
-
-def send_all(data, conn):
-    conn.send(len(data).to_bytes(4, 'little'))
-    conn.sendall(data)
+# エッジ集約サーバ (distributed_platform.edge) が、同じノードのclientからの接続を受け付けるポート
+EDGE_SELECTION_PORT = int(os.environ.get("EDGE_SELECTION_PORT", '11115'))
+EDGE_REPORTING_PORT = int(os.environ.get("EDGE_REPORTING_PORT", '11116'))
+# 1の場合、clientはリクエストごとに接続せず、サーバとのセッションを張り続ける (distributed_platform.session)
+USE_SESSION = os.environ.get("FL_SESSION", '0') == '1'
+# 1つのclientプロセスが担当するビルの数 (2以上の場合はPackedFLClientを使う)
+CLIENT_BUILDINGS = int(os.environ.get("CLIENT_BUILDINGS", '1'))
+# clientが環境変数の時系列を保存しておくディレクトリ (同じノードのコンテナ間で共有する)
+DATASET_DIR = os.environ.get("BFS_DATASET_DIR", os.path.expanduser("~/.cache/building-facility-simulator/datasets"))
 
 
 def calc_reward(state: BuildingState, action: BuildingAction) -> np.ndarray:
@@ -0,0 +1,243 @@
+"""FLServerとFLClientの間でやりとりするメッセージの形式
+
+1つのメッセージは、以下のフレームからなる (整数は全て8byteのリトルエンディアン)
+
+    [バッファの数 N][pickleの長さ][バッファ1の長さ]...[バッファNの長さ][pickle][バッファ1]...[バッファN]
+
+pickleはprotocol 5で作り、ndarrayやtorch.Tensorの中身はpickleに含めず、out-of-bandのバッファとしてそのまま送る。
+受信側は全フレーム分の領域を1度だけ確保し、recv_intoで直接書き込むので、余計なコピーが発生しない。
+"""
+from __future__ import annotations
+import asyncio
+from concurrent.futures import Executor
+from dataclasses import dataclass
+import io
+import pickle
+import socket
+from time import perf_counter
+from typing import Any, Optional
+
+import numpy as np
+import torch
+from torch import nn
+
+
+LENGTH_BYTES = 8
+# 受信したndarrayやTensorがアラインされるよう、各バッファの先頭をこの倍数に揃える
+BUFFER_ALIGNMENT = 64
+
+
+class _Pickler(pickle.Pickler):
+    """torch.Tensorを、ndarrayとしてout-of-bandで送るPickler
+    """
+
+    def reducer_override(self, obj: Any) -> Any:
+        if type(obj) not in (torch.Tensor, nn.Parameter) or not _is_plain_tensor(obj):
+            return NotImplemented
+
+        return _rebuild_tensor, (_to_ndarray(obj), obj.requires_grad, type(obj) is nn.Parameter)
+
+
+@dataclass
+class MessageStats:
+    """受信したメッセージの大きさと、受信・unpickleにかかった時間
+    """
+    # 最初のフレームが届いた時刻 (perf_counter)
+    started_at: float = 0.
+    nbytes: int = 0
+    recv_sec: float = 0.
+    unpickle_sec: float = 0.
+
+
+def _is_plain_tensor(tensor: torch.Tensor) -> bool:
+    """ストレージを他のTensorと共有していない、CPU上の連続したTensorかどうか
+
+    それ以外のTensorは、ストレージの共有などを保つため、torchのpickleで送る
+    """
+    return (
+        tensor.device.type == 'cpu'
+        and tensor.layout == torch.strided
+        and tensor.dtype not in (torch.bfloat16, torch.complex32)
+        and tensor._base is None
+        and tensor.storage_offset() == 0
+        and tensor.is_contiguous()
+        and _storage_nbytes(tensor) == tensor.numel() * tensor.element_size()
+    )
+
+
+def _storage_nbytes(tensor: torch.Tensor) -> int:
+    if hasattr(tensor, 'untyped_storage'):
+        return tensor.untyped_storage().nbytes()
+
+    # torch 2.0より前は、型付きのstorageしかない
+    return tensor.storage().size() * tensor.element_size()
+
+
+def _to_ndarray(tensor: torch.Tensor) -> np.ndarray:
+    tensor = tensor.detach()
+
+    # torch 1.10以降では、共役・符号反転が遅延されたTensorがあるので、numpyに渡す前に実体化する
+    if hasattr(tensor, 'resolve_neg'):
+        tensor = tensor.resolve_conj().resolve_neg()
+
+    return tensor.numpy()
+
+
+def _rebuild_tensor(array: np.ndarray, requires_grad: bool, is_parameter: bool) -> torch.Tensor:
+    tensor = torch.from_numpy(array)
+
+    if is_parameter:
+        return nn.Parameter(tensor, requires_grad=requires_grad)
+
+    return tensor.requires_grad_(requires_grad)
+
+
+def dumps(obj: Any) -> tuple[bytes, list[memoryview]]:
+    """objをpickleと、out-of-bandのバッファのリストに変換する
+    """
+    buffers: list[pickle.PickleBuffer] = []
+    with io.BytesIO() as f:
+        _Pickler(f, protocol=5, buffer_callback=buffers.append).dump(obj)
+        payload = f.getvalue()
+
+    return payload, [buffer.raw() for buffer in buffers]
+
+
+def loads(payload: bytes, buffers: list[memoryview]) -> Any:
+    return pickle.loads(payload, buffers=buffers)
+
+
+def send_message(obj: Any, conn: socket.socket) -> int:
+    """objを1つのメッセージとして送り、送ったバイト数を返す
+    """
+    payload, buffers = dumps(obj)
+    header = _encode_header(payload, buffers)
+    conn.sendall(header + payload)
+
+    for buffer in buffers:
+        conn.sendall(buffer)
+
+    return len(header) + len(payload) + sum(buffer.nbytes for buffer in buffers)
+
+
+def recv_message(conn: socket.socket, stats: Optional[MessageStats] = None) -> Any:
+    """send_messageで送られたメッセージを受け取り、元のオブジェクトに戻す
+
+    statsを渡すと、受信・unpickleにかかった時間を書き込む (最初のフレームが届くまでの待ち時間は含めない)
+    """
+    num_buffers = _recv_length(conn)
+    started_at = perf_counter()
+
+    header = bytearray(LENGTH_BYTES * (num_buffers + 1))
+    recv_into_exactly(conn, memoryview(header))
+
+    frames = _allocate_frames(header)
+    for frame in frames:
+        recv_into_exactly(conn, frame)
+
+    return _loads_with_stats(frames, header, started_at, perf_counter(), stats)
+
+
+async def send_message_async(obj: Any, conn: socket.socket, executor: Optional[Executor] = None) -> int:
+    """send_messageのasyncio版 (connはノンブロッキングにしておく)
+
+    pickleはexecutorで行い、イベントループを止めない
+    """
+    loop = asyncio.get_running_loop()
+    payload, buffers = await loop.run_in_executor(executor, dumps, obj)
+    header = _encode_header(payload, buffers)
+    await loop.sock_sendall(conn, header + payload)
+
+    for buffer in buffers:
+        await loop.sock_sendall(conn, buffer)
+
+    return len(header) + len(payload) + sum(buffer.nbytes for buffer in buffers)
+
+
+async def recv_message_async(
+        conn: socket.socket, executor: Optional[Executor] = None, stats: Optional[MessageStats] = None) -> Any:
+    """recv_messageのasyncio版 (connはノンブロッキングにしておく)
+
+    受信はイベントループ上で行い、unpickleはexecutorで行う
+    """
+    loop = asyncio.get_running_loop()
+    length = bytearray(LENGTH_BYTES)
+    await _recv_into_exactly_async(loop, conn, memoryview(length))
+    started_at = perf_counter()
+
+    header = bytearray(LENGTH_BYTES * (int.from_bytes(length, 'little') + 1))
+    await _recv_into_exactly_async(loop, conn, memoryview(header))
+
+    frames = _allocate_frames(header)
+    for frame in frames:
+        await _recv_into_exactly_async(loop, conn, frame)
+
+    return await loop.run_in_executor(executor, _loads_with_stats, frames, header, started_at, perf_counter(), stats)
+
+
+def _loads_with_stats(
+        frames: list[memoryview],
+        header: bytearray,
+        started_at: float,
+        received_at: float,
+        stats: Optional[MessageStats]) -> Any:
+    unpickle_start = perf_counter()
+    obj = loads(frames[0], frames[1:])
+
+    if stats is not None:
+        stats.started_at = started_at
+        stats.nbytes = LENGTH_BYTES + len(header) + sum(frame.nbytes for frame in frames)
+        stats.recv_sec = received_at - started_at
+        stats.unpickle_sec = perf_counter() - unpickle_start
+
+    return obj
+
+
+def recv_into_exactly(conn: socket.socket, buffer: memoryview):
+    """bufferが埋まるまで受信する
+    """
+    received = 0
+    while received < buffer.nbytes:
+        n = conn.recv_into(buffer[received:])
+        if n == 0:
+            raise ConnectionError(f"Connection closed after receiving {received}/{buffer.nbytes} bytes.")
+
+        received += n
+
+
+async def _recv_into_exactly_async(loop: asyncio.AbstractEventLoop, conn: socket.socket, buffer: memoryview):
+    received = 0
+    while received < buffer.nbytes:
+        n = await loop.sock_recv_into(conn, buffer[received:])
+        if n == 0:
+            raise ConnectionError(f"Connection closed after receiving {received}/{buffer.nbytes} bytes.")
+
+        received += n
+
+
+def _recv_length(conn: socket.socket) -> int:
+    buffer = bytearray(LENGTH_BYTES)
+    recv_into_exactly(conn, memoryview(buffer))
+
+    return int.from_bytes(buffer, 'little')
+
+
+def _encode_header(payload: bytes, buffers: list[memoryview]) -> bytes:
+    lengths = [len(buffers), len(payload)] + [buffer.nbytes for buffer in buffers]
+    return b''.join(length.to_bytes(LENGTH_BYTES, 'little') for length in lengths)
+
+
+def _allocate_frames(header: bytearray) -> list[memoryview]:
+    """headerの長さのフレームを受信する領域を、1度にまとめて確保する
+    """
+    lengths = np.frombuffer(header, dtype='<u8').tolist()
+
+    offsets = []
+    total = 0
+    for length in lengths:
+        total = -(-total // BUFFER_ALIGNMENT) * BUFFER_ALIGNMENT
+        offsets.append(total)
+        total += length
+
+    data = memoryview(np.empty(total, dtype=np.uint8))
+    return [data[offset:offset + length] for offset, length in zip(offsets, lengths)]
@@ -1,36 +1,43 @@
 import glob
+import os
 import numpy as np
 from torch.utils.tensorboard import SummaryWriter
 
+from simulator.batched import BatchedBuildingFacilitySimulator
 from simulator.bfs import BuildingFacilitySimulator
 from rl import sac
 from simulator.building import BuildingAction, BuildingState
 from simulator.interfaces.config import SimulatorConfig
+from simulator import profiling
+from simulator.layout import LayoutIndex
+from simulator.metrics import MetricsLogger
+from simulator.reward import vectorized_reward
+from simulator.rollout import StepResult
 
 
-def write_to_tensorboard(bfs: BuildingFacilitySimulator, action_arr: np.ndarray, reward: float):
-    state = bfs.get_state()
-    action = BuildingAction.from_ndarray(action_arr, bfs.areas)
+def write_to_tensorboard(result: StepResult):
+    state, action, steps = result.state, result.action, result.steps
         
-    writer.add_scalar("reward", reward, bfs.cur_steps)
-
-    writer.add_scalar("set_temperature_area1", action.areas[1].facilities[0].set_temperature, bfs.cur_steps)
-    writer.add_scalar("set_temperature_area2", action.areas[2].facilities[0].set_temperature, bfs.cur_steps)
-    writer.add_scalar("set_temperature_area3", action.areas[3].facilities[0].set_temperature, bfs.cur_steps)
-    writer.add_scalar("temperature_area1", state.areas[1].temperature, bfs.cur_steps)
-    writer.add_scalar("temperature_area2", state.areas[2].temperature, bfs.cur_steps)
-    writer.add_scalar("temperature_area3", state.areas[3].temperature, bfs.cur_steps)
+    writer.add_scalar("reward", result.reward[0], steps)
+
+    writer.add_scalar("set_temperature_area1", action.areas[1].facilities[0].set_temperature, steps)
+    writer.add_scalar("set_temperature_area2", action.areas[2].facilities[0].set_temperature, steps)
+    writer.add_scalar("set_temperature_area3", action.areas[3].facilities[0].set_temperature, steps)
+    writer.add_scalar("temperature_area1", state.areas[1].temperature, steps)
+    writer.add_scalar("temperature_area2", state.areas[2].temperature, steps)
+    writer.add_scalar("temperature_area3", state.areas[3].temperature, steps)
     
     mode_dict = {
         'charge': 1,
         'stand_by': 0,
         'discharge': -1
     }
-    writer.add_scalar('charge_mode_per_time', mode_dict[action.areas[4].facilities[0].mode.value], bfs.cur_steps)
-    writer.add_scalar('charge_ratio', state.areas[4].facilities[0].charge_ratio, bfs_list[0].cur_steps)
+    writer.add_scalar('charge_mode_per_time', mode_dict[action.areas[4].facilities[0].mode.value], steps)
+    writer.add_scalar('charge_ratio', state.areas[4].facilities[0].charge_ratio, steps)
 
 
-def calc_reward(state: BuildingState, action: BuildingAction) -> np.ndarray:
+@vectorized_reward
+def calc_reward(states: np.ndarray, actions: np.ndarray, index: LayoutIndex) -> np.ndarray:
     LAMBDA1 = 0.2
     LAMBDA2 = 0.1
     LAMBDA3 = 0.01
@@ -39,20 +46,22 @@ def calc_reward(state: BuildingState, action: BuildingAction) -> np.ndarray:
     T_MIN = 20
     T_TARGET = 25
 
-    # area_temp = np.array([area.temperature for area in state.areas])
-    area_temp = state.areas[1].temperature
+    # area_temp = states[..., index.area_temperature]
+    area_temp = states[..., index.area_temperature[1:2]]
     
-    reward = np.exp(-LAMBDA1 * (area_temp - T_TARGET) ** 2).sum()
-    # reward += - LAMBDA2 * (np.where((T_MIN - area_temp) < 0, 0, (T_MIN - area_temp)).sum())
-    # reward += - LAMBDA2 * (np.where((area_temp - T_MAX) < 0, 0, (area_temp - T_MAX)).sum())
-    # reward += - LAMBDA3 * state.electric_price_unit * state.power_balance
-    # reward += LAMBDA4 * state.areas[4].facilities[0].charge_ratio
+    reward = np.exp(-LAMBDA1 * (area_temp - T_TARGET) ** 2).sum(axis=-1)
+    # reward += - LAMBDA2 * (np.where((T_MIN - area_temp) < 0, 0, (T_MIN - area_temp)).sum(axis=-1))
+    # reward += - LAMBDA2 * (np.where((area_temp - T_MAX) < 0, 0, (area_temp - T_MAX)).sum(axis=-1))
+    # reward += - LAMBDA3 * states[..., index.electric_price_unit] * states[..., index.power_balance]
+    # reward += LAMBDA4 * states[..., index.es_charge_ratio[0]]
 
-    return np.array([reward])
+    return reward[..., np.newaxis]
 
 
 if __name__ == "__main__":
-    writer = SummaryWriter(log_dir="./logs/3federated_only_area1")
+    # シミュレーションを止めないよう、10stepごとに集約してバックグラウンドで書き込む
+    writer = MetricsLogger(
+        SummaryWriter(log_dir="./logs/3federated_only_area1"), downsample=10, aggregations=('mean', 'min', 'max'))
     bfs_list = [
         BuildingFacilitySimulator(
             config=SimulatorConfig.parse_file(json_path),
@@ -61,21 +70,36 @@ if __name__ == "__main__":
     ]
 
     agents = [bfs.create_rl_model(sac.SAC, device='cpu') for bfs in bfs_list]
+    batched_bfs = BatchedBuildingFacilitySimulator(bfs_list)
+
+    # BFS_PROFILEにパスを指定した場合は、シミュレーションの各フェーズの時間をJSONに書き出す
+    profile_path = os.environ.get("BFS_PROFILE")
+    profiler = profiling.enable() if profile_path else None
+
+    try:
+        while not batched_bfs.has_finished():
+            for _ in range(60 * 24):
+                if batched_bfs.has_finished():
+                    break
 
-    while True:
-        for _ in range(60 * 24):
-            for i, (bfs, model) in enumerate(zip(bfs_list, agents)):
-                if bfs.has_finished():
-                    continue
+                states = batched_bfs.get_state_array()
+                actions = np.stack([model.select_action(state) for model, state in zip(agents, states)])
+                result = batched_bfs.step(actions)
 
-                state, action, reward = bfs.step_with_model(model)
+                for model, state, action, next_state, reward in zip(agents, states, actions, result.state_array, result.reward):
+                    model.add_to_buffer(state, action, next_state, reward)
 
-                if i == 0:
-                    write_to_tensorboard(bfs, action, reward[0])
-                    
-                    if bfs.cur_steps % 60 == 0:
-                        bfs.print_cur_state()
+                write_to_tensorboard(batched_bfs.get_last_result(0))
+
+                if batched_bfs.cur_steps % 60 == 0:
+                    batched_bfs.print_cur_state(0)
             
-        sac.average_sac(agents)
+            sac.average_sac(agents)
+
+            print("merged models!")
 
-        print("merged models!")
+            if profiler:
+                profiler.write_json(profile_path)
+    finally:
+        # 書き込みのスレッドはdaemonなので、閉じて残りを書き込んでから終える
+        writer.close()
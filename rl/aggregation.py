@@ -0,0 +1,98 @@
+from __future__ import annotations
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from simulator.interfaces.model import ModelCheckpoint
+
+
+class FlatLayout(NamedTuple):
+    """checkpointの浮動小数点数のパラメータを、1つの連続したベクトルに並べる際の配置
+    """
+    keys: tuple[str, ...]
+    shapes: tuple[tuple[int, ...], ...]
+    dtypes: tuple[np.dtype, ...]
+    # keys[i]のパラメータは、ベクトルの[offsets[i], offsets[i + 1])に入る
+    offsets: tuple[int, ...]
+
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint: ModelCheckpoint) -> FlatLayout:
+        keys = tuple(key for key, value in checkpoint.items() if np.issubdtype(value.dtype, np.floating))
+        sizes = [checkpoint[key].size for key in keys]
+
+        return cls(
+            keys=keys,
+            shapes=tuple(checkpoint[key].shape for key in keys),
+            dtypes=tuple(checkpoint[key].dtype for key in keys),
+            offsets=tuple(np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)]).tolist())
+        )
+
+
+    @property
+    def size(self) -> int:
+        return self.offsets[-1]
+
+
+    def unflatten(self, vector: np.ndarray, scale: float = 1.) -> ModelCheckpoint:
+        """vectorをscale倍して、元の形・型のパラメータに戻す
+        """
+        return {
+            key: (vector[start:end] * scale).reshape(shape).astype(dtype)
+            for key, shape, dtype, start, end in zip(self.keys, self.shapes, self.dtypes, self.offsets, self.offsets[1:])
+        }
+
+
+class StreamingFedAvg:
+    """受け取ったcheckpointをその場で重み付き和に足し込んでいく、FedAvgの集約
+
+    パラメータは1本のfloat64のベクトルにまとめて持つので、clientの数によらず、メモリはモデル数個分で済む。
+    sample_weighted=Trueの場合は、各clientが学習したサンプル数で重み付けする。
+    浮動小数点数でないパラメータは平均できないので、最後に受け取った値を使う。
+    """
+
+    def __init__(self, sample_weighted: bool = True):
+        self.sample_weighted: bool = sample_weighted
+        self.layout: Optional[FlatLayout] = None
+        self.total_weight: float = 0.
+        self._sum: Optional[np.ndarray] = None
+        self._others: ModelCheckpoint = {}
+
+
+    def add(self, checkpoint: ModelCheckpoint, num_samples: int = 1):
+        weight = float(num_samples) if self.sample_weighted else 1.
+        if weight < 0:
+            raise ValueError(f'num_samples must not be negative (got {num_samples}).')
+
+        if self.layout is None:
+            self.layout = FlatLayout.from_checkpoint(checkpoint)
+            self._sum = np.zeros(self.layout.size, dtype=np.float64)
+
+        for key, start, end in zip(self.layout.keys, self.layout.offsets, self.layout.offsets[1:]):
+            # パラメータごとに足し込むので、一時的に確保するのも最大のパラメータ1つ分だけ
+            self._sum[start:end] += weight * checkpoint[key].ravel()
+
+        self._others.update({key: value for key, value in checkpoint.items() if key not in self.layout.keys})
+        self.total_weight += weight
+
+
+    def result(self) -> ModelCheckpoint:
+        if self.layout is None:
+            raise ValueError('No checkpoint has been added.')
+        if self.total_weight <= 0:
+            raise ValueError('Total weight of the added checkpoints must be positive.')
+
+        checkpoint = self.layout.unflatten(self._sum, 1. / self.total_weight)
+        checkpoint.update(self._others)
+
+        return checkpoint
+
+
+def average_checkpoints(checkpoints: list[ModelCheckpoint]) -> ModelCheckpoint:
+    """checkpointsを同じ重みで平均する
+    """
+    aggregator = StreamingFedAvg(sample_weighted=False)
+    for checkpoint in checkpoints:
+        aggregator.add(checkpoint)
+
+    return aggregator.result()
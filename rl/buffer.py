@@ -19,14 +19,30 @@ class ReplayBuffer:
             (buff_size, *state_shape), dtype=torch.float, device=device)
 
     def add(self, state, action, next_state, reward, done):
-        self.states[self._p].copy_(torch.from_numpy(state))
+        # stepの結果の状態は書き込み不可のndarrayなので、from_numpyではなくコピーして渡す
+        self.states[self._p].copy_(torch.tensor(state))
         self.actions[self._p].copy_(torch.from_numpy(action))
         self.rewards[self._p] = float(reward)
         self.terminals[self._p] = float(done)
-        self.next_states[self._p].copy_(torch.from_numpy(next_state))
+        self.next_states[self._p].copy_(torch.tensor(next_state))
         self._p = (self._p + 1) % self.buff_size
         self.n = min(self.n + 1, self.buff_size)
 
+    def add_batch(self, states, actions, next_states, rewards, dones):
+        # バッファより多い場合は、後ろのものだけが残る
+        states, actions, next_states, rewards, dones = (
+            arr[-self.buff_size:] for arr in (states, actions, next_states, rewards, dones))
+
+        num = len(states)
+        idxes = torch.from_numpy((self._p + np.arange(num)) % self.buff_size)
+        self.states[idxes] = torch.as_tensor(states, dtype=torch.float, device=self.states.device)
+        self.actions[idxes] = torch.as_tensor(actions, dtype=torch.float, device=self.actions.device)
+        self.rewards[idxes] = torch.as_tensor(rewards, dtype=torch.float, device=self.rewards.device).reshape(num, 1)
+        self.terminals[idxes] = torch.as_tensor(dones, dtype=torch.float, device=self.terminals.device).reshape(num, 1)
+        self.next_states[idxes] = torch.as_tensor(next_states, dtype=torch.float, device=self.next_states.device)
+        self._p = (self._p + num) % self.buff_size
+        self.n = min(self.n + num, self.buff_size)
+
     def sample_buffer(self, batch_size):
         idxes = np.random.randint(low=0, high=self.n, size=batch_size)
         return (
@@ -1,4 +1,3 @@
-from collections import defaultdict
 import torch
 import torch.nn as nn
 import numpy as np
@@ -7,7 +6,8 @@ from time import time
 from abc import ABC, abstractmethod
 
 from rl import buffer
-from simulator.interfaces.model import RlModel
+from rl.aggregation import average_checkpoints
+from simulator.interfaces.model import ModelCheckpoint, RlModel
 
 
 def caluculate_log_pi(log_stds, noises, actions):
@@ -28,25 +28,10 @@ def reparameterize(means, log_stds):
     return actions, log_pis
 
 
-def average_models(local_models):
-    state_dict_stacked = defaultdict(list)
-
-    for local_model in local_models:
-        for key, value in local_model.state_dict().items():
-            state_dict_stacked[key].append(value)
-
-    global_state_dict = dict()
-    for key in state_dict_stacked.keys():
-        global_state_dict[key] = torch.mean((torch.stack(state_dict_stacked[key])), dim=0)
-    
-    for local_model in local_models:
-        local_model.load_state_dict(global_state_dict)
-
-
 def average_sac(local_sacs):
-    average_models([local_sac.actor for local_sac in local_sacs])
-    average_models([local_sac.critic for local_sac in local_sacs])
-    average_models([local_sac.critic_target for local_sac in local_sacs])
+    global_checkpoint = average_checkpoints([local_sac.get_checkpoint() for local_sac in local_sacs])
+    for local_sac in local_sacs:
+        local_sac.load_checkpoint(global_checkpoint)
 
     return local_sacs[0]
 
@@ -130,6 +115,9 @@ class Algorithm(ABC):
 
 
 class SAC(Algorithm, RlModel):
+    # global共有するネットワーク (optimizerとreplay_bufferは各clientに残す)
+    SHARED_MODULES = ('actor', 'critic', 'critic_target')
+
     def __init__(self, state_shape, action_shape,  device,  seed=0,
                  batch_size=256, gamma=0.99, lr=3e-4, alpha=0.2, buff_size=10**4, start_steps=2*10**3, tau=5e-3, reward_scale=1.0):
 
@@ -217,3 +205,33 @@ class SAC(Algorithm, RlModel):
     def add_to_buffer(self, state: np.ndarray, action: np.ndarray, next_state: np.ndarray, reward: np.ndarray):
         self.replay_buffer.add(state, action, next_state, reward, done=False)
         self.update()
+
+    def get_checkpoint(self) -> ModelCheckpoint:
+        return {
+            f"{name}.{key}": value.detach().cpu().numpy().copy()
+            for name in self.SHARED_MODULES
+            for key, value in getattr(self, name).state_dict().items()
+        }
+
+    def load_checkpoint(self, checkpoint: ModelCheckpoint):
+        for name in self.SHARED_MODULES:
+            module: nn.Module = getattr(self, name)
+            module.load_state_dict({
+                key: torch.from_numpy(checkpoint[f"{name}.{key}"]) for key in module.state_dict().keys()
+            })
+
+    def select_actions(self, states: np.ndarray) -> np.ndarray:
+        if len(self.replay_buffer) > 0:
+            states = torch.tensor(states, dtype=torch.float, device=self.device)
+            with torch.no_grad():
+                actions, _ = self.actor.sample(states)
+            return actions.cpu().numpy()
+        else:
+            return np.random.uniform(low=-1, high=1, size=(len(states), *self.action_shape))
+
+    def add_batch_to_buffer(
+            self, states: np.ndarray, actions: np.ndarray, next_states: np.ndarray, rewards: np.ndarray):
+        # add_to_bufferと同じく、追加した遷移1つにつき1回学習する
+        self.replay_buffer.add_batch(states, actions, next_states, rewards, dones=np.zeros(len(states)))
+        for _ in range(len(states)):
+            self.update()
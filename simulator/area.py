@@ -1,9 +1,11 @@
 from __future__ import annotations
 from dataclasses import dataclass
+from time import perf_counter
 from typing import NamedTuple, Optional, TypeVar
 
 import numpy as np
 
+from simulator import profiling
 from simulator.facility import Facility
 from simulator.environment import ExternalEnvironment, AreaEnvironment
 from simulator.facility.facility_base import FacilityAction, FacilityActionFactory, FacilityState
@@ -29,28 +31,40 @@ class Area:
 
     def update(
         self, 
-        action: AreaAction,
+        action: Optional[AreaAction],
         ext_env: ExternalEnvironment, 
         area_env: Optional[AreaEnvironment] = None,
     ) -> AreaState:
         """ext_envとarea_envに応じて温度と消費電力を更新する
+        actionがNoneの場合は、各設備の現在の設定のまま更新する
 
         2.6節の2,3に対応
         """
+        profiler = profiling.active
+
         self.people = area_env.people if area_env else 0
 
         beta = area_env.calc_beta() if area_env else 0
         self.power_consumption = 0.
 
         for fid, facility in enumerate(self.facilities):
+            if profiler:
+                start = perf_counter()
+
             state, effect = facility.update(
-                action=action.facilities[fid],
+                action=action.facilities[fid] if action else None,
                 ext_env=ext_env,
                 area_temperature=self.temperature)
 
+            if profiler:
+                profiler.lap(f"facility_update.{type(facility).__name__}", start)
+
             beta += effect.heat * 60
             self.power_consumption += effect.power
 
+        if profiler:
+            start = perf_counter()
+
         if self.simulate_temperature:
             assert area_env
             
@@ -60,6 +74,9 @@ class Area:
         else:
             self.temperature = ext_env.temperature
 
+        if profiler:
+            profiler.lap("thermal", start)
+
         return self.get_state()
     
 
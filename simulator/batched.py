@@ -0,0 +1,620 @@
+from __future__ import annotations
+from datetime import datetime
+from time import perf_counter
+from typing import Callable, Optional, Union
+
+import numpy as np
+
+from simulator import profiling
+from simulator.area import ALPHA, Area
+from simulator.bfs import BuildingFacilitySimulator
+from simulator.building import BuildingAction, BuildingState
+from simulator.facility import HVAC, PVStation, ElectricStorage
+from simulator.facility.electric_storage import CODE_TO_ES_MODE, ES_MODE_TO_CODE
+from simulator.facility.hvac import HVACMode, HVACStateInternal
+from simulator.interfaces.config import SimulatorConfig
+from simulator.layout import BuildingLayout
+from simulator.reward import CalcReward, VectorizedReward, is_vectorized_reward
+from simulator.rollout import BatchedStepResult, BatchPolicy, StepResult, Trajectory
+
+
+# 環境変数の時系列を、各ビルのenv_tableからまとめて読み込むステップ数
+ENV_CHUNK_STEPS = 1440
+
+HVAC_OFF = HVACMode.Off.value
+HVAC_COOL = HVACMode.Cool.value
+HVAC_HEAT = HVACMode.Heat.value
+
+
+class BatchedBuildingFacilitySimulator:
+    """同じ構成(エリアと設備の並び)を持つN個のビルを、まとめて1ステップずつ進めるシミュレータ
+
+    各ビルのエリア・設備の状態をstruct-of-arraysのndarrayとして保持し、
+    Area.update / HVAC.update / ElectricStorage.update / PVStation.update と同じ計算をベクトル化して行う。
+    環境変数の時系列は、元になったBuildingFacilitySimulatorのenv_tableを、それらのenv_stepを進めながら使う。
+    (バッチで進めている間は、元のシミュレータを個別に進めてはいけない)
+    """
+
+    def __init__(self, bfs_list: list[BuildingFacilitySimulator]):
+        assert len(bfs_list) > 0, "At least one simulator is required."
+
+        self.bfs_list: list[BuildingFacilitySimulator] = bfs_list
+        self.areas: list[Area] = bfs_list[0].areas
+
+        structure = BatchedBuildingFacilitySimulator.get_structure(self.areas)
+        for bfs in bfs_list[1:]:
+            assert BatchedBuildingFacilitySimulator.get_structure(bfs.areas) == structure, \
+                "All buildings must have the same areas and facilities to be simulated in a batch."
+
+        self.num_buildings: int = len(bfs_list)
+        self.cur_steps: int = bfs_list[0].cur_steps
+
+        self._init_indices()
+        self._load_from_simulators()
+
+        self._env_chunk: Optional[dict[str, np.ndarray]] = None
+        self._env_pos: int = 0
+
+        self.state: np.ndarray = np.stack([bfs.get_state().to_ndarray() for bfs in bfs_list]).astype(self.layout.dtype)
+
+        # 全ビルが同じVectorizedRewardを使う場合は、全ビル分の報酬を一度に計算する
+        calc_reward = bfs_list[0].calc_reward
+        self._batch_reward: Optional[VectorizedReward] = calc_reward if is_vectorized_reward(calc_reward) and all(
+            bfs.calc_reward is calc_reward for bfs in bfs_list) else None
+
+        # 直前のstepの、ビルごとの結果 (get_last_resultで必要になった時点で作る、seekやfast_forwardの後はNone)
+        self._last_results: Optional[list[Optional[StepResult]]] = None
+        self._last_action: Optional[np.ndarray] = None
+        self._last_rewards: Optional[np.ndarray] = None
+
+
+    @staticmethod
+    def from_configs(
+            configs: list[SimulatorConfig],
+            calc_reward: Union[CalcReward, VectorizedReward]
+    ) -> BatchedBuildingFacilitySimulator:
+        return BatchedBuildingFacilitySimulator([
+            BuildingFacilitySimulator(config=config, calc_reward=calc_reward) for config in configs
+        ])
+
+
+    @staticmethod
+    def get_structure(areas: list[Area]) -> tuple[tuple[type, ...], ...]:
+        """エリアごとの設備の型 (これが同じビル同士であれば、まとめて進められる)
+        """
+        return tuple(tuple(type(facility) for facility in area.facilities) for area in areas)
+
+
+    def _init_indices(self):
+        """エリア・設備ごとの、state/actionのndarray上の位置と、SoA上の位置の対応を作る
+        """
+        self.layout: BuildingLayout = self.bfs_list[0].layout
+        layout = self.layout
+        for facility_layout in layout.facility_layouts:
+            assert facility_layout.facility_type in (HVAC, ElectricStorage, PVStation), \
+                f"Batched simulation of {facility_layout.facility_type} is not supported."
+
+        hvacs = layout.get_facility_layouts(HVAC)
+        ess = layout.get_facility_layouts(ElectricStorage)
+        pvs = layout.get_facility_layouts(PVStation)
+
+        # (facility_type, unit_idx, area_idx) をエリア内の設備の順番ごとにまとめたもの
+        # 熱量と電力の足し合わせる順番をArea.updateと揃えるために使う
+        self.facility_slots: list[list[tuple[type, np.ndarray, np.ndarray]]] = []
+
+        max_slots = max((len(area.facilities) for area in self.areas), default=0)
+        for facility_idx in range(max_slots):
+            slot = []
+            for facility_type, units in ((HVAC, hvacs), (ElectricStorage, ess), (PVStation, pvs)):
+                unit_idx = [i for i, f in enumerate(units) if f.facility_idx == facility_idx]
+                if unit_idx:
+                    area_idx = [units[i].area_idx for i in unit_idx]
+                    slot.append((facility_type, np.array(unit_idx), np.array(area_idx)))
+            self.facility_slots.append(slot)
+
+        self.hvac_area_idx = np.array([f.area_idx for f in hvacs], dtype=np.int64)
+        self.hvac_action_cols = np.array(
+            [(f.action_offset, f.action_offset + 1) for f in hvacs], dtype=np.int64).reshape(-1, 2)
+        self.es_action_cols = np.array([f.action_offset for f in ess], dtype=np.int64)
+        self.es_state_cols = np.array([f.state_offset for f in ess], dtype=np.int64)
+
+        self.area_power_cols = np.array([a.power_consumption_col for a in layout.area_layouts], dtype=np.int64)
+        self.area_temp_cols = np.array([a.temperature_col for a in layout.area_layouts], dtype=np.int64)
+        self.area_people_cols = np.array([a.people_col for a in layout.area_layouts], dtype=np.int64)
+        self.building_cols = np.array([
+            layout.power_balance_col, 
+            layout.electric_price_unit_col, 
+            layout.solar_radiation_col, 
+            layout.temperature_col
+        ])
+
+        self.state_dim: int = layout.state_shape[0]
+        self.action_dim: int = layout.action_shape[0]
+
+
+    def _load_from_simulators(self):
+        """各シミュレータのArea/Facilityオブジェクトから、SoAの状態を読み込む
+        """
+        def facilities_of(bfs: BuildingFacilitySimulator, facility_type: type) -> list:
+            return [f for area in bfs.areas for f in area.facilities if type(f) is facility_type]
+
+        def collect(getter: Callable[[Area], float], dtype=np.float64) -> np.ndarray:
+            return np.array([[getter(area) for area in bfs.areas] for bfs in self.bfs_list], dtype=dtype)
+
+        self.temperature = collect(lambda area: area.temperature)
+        self.power_consumption = collect(lambda area: area.power_consumption)
+        self.people = collect(lambda area: area.people, dtype=np.int64)
+        self.capacity = collect(lambda area: area.capacity)
+        self.simulate_temperature = collect(lambda area: area.simulate_temperature, dtype=bool)
+
+        def per_facility(facility_type: type, getter: Callable, dtype=np.float64) -> np.ndarray:
+            facilities = [facilities_of(bfs, facility_type) for bfs in self.bfs_list]
+            return np.array(
+                [[getter(f) for f in fs] for fs in facilities], dtype=dtype
+            ).reshape(self.num_buildings, len(facilities[0]))
+
+        self.hvac_cool_max_power = per_facility(HVAC, lambda f: f.cool_max_power)
+        self.hvac_heat_max_power = per_facility(HVAC, lambda f: f.heat_max_power)
+        self.hvac_cool_cop = per_facility(HVAC, lambda f: f.cool_cop)
+        self.hvac_heat_cop = per_facility(HVAC, lambda f: f.heat_cop)
+        self.hvac_mode = per_facility(HVAC, lambda f: f.state.mode.value, dtype=np.int8)
+        self.hvac_stand_by = per_facility(HVAC, lambda f: f.state.stand_by, dtype=bool)
+        self.hvac_status = per_facility(HVAC, lambda f: f.status, dtype=bool)
+        self.hvac_set_temperature = per_facility(HVAC, lambda f: f.set_temperature)
+
+        self.es_charge_power = per_facility(ElectricStorage, lambda f: f.charge_power)
+        self.es_discharge_power = per_facility(ElectricStorage, lambda f: f.discharge_power)
+        self.es_capacity = per_facility(ElectricStorage, lambda f: f.capacity)
+        self.es_charge_ratio = per_facility(ElectricStorage, lambda f: f.charge_ratio)
+        self.es_mode = per_facility(ElectricStorage, lambda f: ES_MODE_TO_CODE[f.mode], dtype=np.int8)
+
+        self.pv_max_power = per_facility(PVStation, lambda f: f.max_power)
+
+
+    def has_finished(self) -> bool:
+        return any(bfs.has_finished() for bfs in self.bfs_list)
+
+
+    def seek(self, target: Union[datetime, int]):
+        """全ビルの環境変数の時系列上の位置を移動する (BuildingFacilitySimulator.seekを参照)
+        """
+        for bfs in self.bfs_list:
+            bfs.seek(target)
+
+        self.cur_steps = self.bfs_list[0].cur_steps
+        self._prefetch_env()
+        self.state = self._encode_state()
+        self._last_results = None
+
+
+    def reset(self, start: Union[datetime, int] = 0):
+        """全ビルを初期状態に戻し、startから始め直す (BuildingFacilitySimulator.resetを参照)
+        """
+        for bfs in self.bfs_list:
+            bfs.reset(start)
+
+        self._load_from_simulators()
+        self.seek(start)
+
+
+    def get_state_shape(self) -> tuple[int]:
+        return (self.state_dim,)
+
+
+    def get_action_shape(self) -> tuple[int]:
+        return (self.action_dim,)
+
+
+    def get_state_array(self) -> np.ndarray:
+        """(N, state_dim)の、現在の状態を返す
+        """
+        return self.state
+
+
+    def step(self, action: np.ndarray) -> Optional[BatchedStepResult]:
+        """全ビルのシミュレーションを1サイクル分進める
+
+        actionは(N, action_dim)で、BuildingFacilitySimulator.stepと同様に、最後まで進んでいた場合はNoneを返す
+        """
+        assert action.shape == (self.num_buildings, self.action_dim), \
+            f"Shape mismatch on batched action. ({(self.num_buildings, self.action_dim)} != {action.shape})"
+
+        if self.has_finished():
+            return None
+
+        profiler = profiling.active
+        if profiler:
+            start = perf_counter()
+
+        self._update_settings(action)
+
+        if profiler:
+            profiler.lap("action_decode", start)
+
+        self._advance()
+
+        if profiler:
+            start = perf_counter()
+
+        self.state = self._encode_state()
+        self.state.flags.writeable = False
+
+        if profiler:
+            start = profiler.lap("state_encode", start)
+
+        self._last_results = [None] * self.num_buildings
+        self._last_action = action
+        self._last_rewards = None
+        self._last_rewards = self._calc_rewards(action)
+
+        if profiler:
+            profiler.lap("reward", start)
+
+        return BatchedStepResult(
+            steps=self.cur_steps,
+            state_array=self.state,
+            reward=self._last_rewards,
+            action_array=action
+        )
+
+
+    def fast_forward(self, until: Union[datetime, int], action: Optional[np.ndarray] = None) -> int:
+        """報酬や状態のndarrayを作らずに、全ビルのシミュレーションをuntilまで進める
+
+        actionを渡した場合は最初にそれで設備の設定を更新し(全ビル共通の(action_dim,)でもよい)、
+        省略した場合は直前の設定のまま進める。進めたstep数を返す。
+        """
+        steps = self.bfs_list[0]._to_steps(until) if isinstance(until, datetime) else until
+
+        if action is not None:
+            self._update_settings(np.broadcast_to(action, (self.num_buildings, self.action_dim)))
+
+        start_steps = self.cur_steps
+        while self.cur_steps < steps and not self.has_finished():
+            self._advance()
+
+        self.state = self._encode_state()
+        self._last_results = None
+
+        return self.cur_steps - start_steps
+
+
+    def _advance(self):
+        """現在の設備の設定のまま、環境変数を1step分進めて各エリアと設備の状態を更新する
+
+        計測を有効にした場合は、BuildingFacilitySimulator.stepと同じフェーズ名で記録する
+        """
+        profiler = profiling.active
+        if profiler:
+            start = perf_counter()
+
+        if self._env_chunk is None or self._env_pos == ENV_CHUNK_STEPS:
+            self._prefetch_env()
+
+        ext_temp = self._env_chunk['temperature'][self._env_pos]
+        solar = self._env_chunk['solar_radiation'][self._env_pos]
+        people = self._env_chunk['people'][self._env_pos]
+        heat_source = self._env_chunk['heat_source'][self._env_pos]
+
+        area_temp = self.temperature
+        beta = heat_source * 60 / 1000
+        power = np.zeros_like(area_temp)
+
+        if profiler:
+            start = profiler.lap("env_fetch", start)
+
+        hvac_power, hvac_heat = self._update_hvac(area_temp[:, self.hvac_area_idx], ext_temp)
+
+        if profiler:
+            start = profiler.lap("facility_update.HVAC", start)
+
+        es_power = self._update_es()
+
+        if profiler:
+            start = profiler.lap("facility_update.ElectricStorage", start)
+
+        pv_power = -self.pv_max_power * solar[:, np.newaxis] / 1000
+
+        if profiler:
+            start = profiler.lap("facility_update.PVStation", start)
+
+        effects = {
+            HVAC: (hvac_power, hvac_heat),
+            ElectricStorage: (es_power, None),
+            PVStation: (pv_power, None),
+        }
+        for slot in self.facility_slots:
+            for facility_type, unit_idx, area_idx in slot:
+                facility_power, facility_heat = effects[facility_type]
+                if facility_heat is not None:
+                    beta[:, area_idx] += facility_heat[:, unit_idx] * 60
+                power[:, area_idx] += facility_power[:, unit_idx]
+
+        temp_dif = area_temp - ext_temp[:, np.newaxis]
+        simulated_temp = area_temp + (-ALPHA * temp_dif + beta / (self.capacity * 1.189))
+
+        self.temperature = np.where(
+            self.simulate_temperature, simulated_temp, np.broadcast_to(ext_temp[:, np.newaxis], area_temp.shape))
+        self.power_consumption = power
+        self.people = people
+
+        if profiler:
+            profiler.lap("thermal", start)
+
+        self.cur_steps += 1
+        self._env_pos += 1
+        for bfs in self.bfs_list:
+            bfs.env_step += 1
+            bfs.cur_steps += 1
+
+
+    def rollout(self, policy: BatchPolicy, n_steps: int, out: Optional[Trajectory] = None) -> Trajectory:
+        """policyに従ってn_steps分(途中で終了した場合はそこまで)全ビルのシミュレーションを進め、その軌跡を返す
+
+        policyには(N, state_dim)の状態がまとめて渡される。
+        outを渡した場合はそこに書き込み、書き込んだ範囲のviewを返す。
+        全ビルが同じVectorizedRewardを使う場合は、報酬を最後にまとめて計算する。
+        """
+        if out is None:
+            out = Trajectory.allocate(
+                n_steps, 
+                (self.num_buildings, self.state_dim), 
+                (self.num_buildings, self.action_dim), 
+                (self.num_buildings, 1))
+
+        vectorized = self._batch_reward is not None
+        states, actions, rewards, next_states = out
+
+        for i in range(n_steps):
+            if self.has_finished():
+                n_steps = i
+                break
+
+            states[i] = self.state
+            action = policy(states[i])
+
+            if vectorized:
+                self._update_settings(action)
+                self._advance()
+                self.state = self._encode_state()
+                self._last_results = None
+            else:
+                rewards[i] = self.step(action).reward
+
+            actions[i] = action
+            next_states[i] = self.state
+
+        out = out.head(n_steps)
+        if vectorized:
+            out.rewards[:] = self._batch_reward(out.next_states, out.actions, self.layout.index)
+
+        return out
+
+
+    def _prefetch_env(self):
+        """各ビルのenv_tableから、ENV_CHUNK_STEPSステップ分の環境変数を(steps, N, ...)のndarrayにまとめる
+
+        stepの後の状態で使う外部環境のために1行多く読み込み、時系列の最後を超えた分は最後の行で埋める
+        (BuildingFacilitySimulator.get_stateと同じく、最後まで進んだ場合は直前の外部環境を使う)
+        """
+        num_areas = len(self.areas)
+        chunk = {
+            'solar_radiation': np.zeros((ENV_CHUNK_STEPS + 1, self.num_buildings)),
+            'temperature': np.zeros((ENV_CHUNK_STEPS + 1, self.num_buildings)),
+            'electric_price_unit': np.zeros((ENV_CHUNK_STEPS + 1, self.num_buildings)),
+            'people': np.zeros((ENV_CHUNK_STEPS + 1, self.num_buildings, num_areas), dtype=np.int64),
+            'heat_source': np.zeros((ENV_CHUNK_STEPS + 1, self.num_buildings, num_areas)),
+        }
+
+        for bid, bfs in enumerate(self.bfs_list):
+            table = bfs.env_table
+            rows = np.minimum(np.arange(bfs.env_step, bfs.env_step + ENV_CHUNK_STEPS + 1), len(table) - 1)
+
+            external = table.external[rows]
+            for name in ('solar_radiation', 'temperature', 'electric_price_unit'):
+                chunk[name][:, bid] = external[name]
+
+            for area_idx, area_env in enumerate(table.areas):
+                if area_env is not None:
+                    area_env = area_env[rows]
+                    chunk['people'][:, bid, area_idx] = area_env['people']
+                    chunk['heat_source'][:, bid, area_idx] = area_env['heat_source']
+
+        self._env_chunk = chunk
+        self._env_pos = 0
+
+
+    def _update_settings(self, action: np.ndarray):
+        """HVACAction.from_ndarray, ESAction.from_ndarrayと同じ変換で、設備の設定を更新する
+        """
+        self.hvac_status = action[:, self.hvac_action_cols[:, 0]] > 0.
+        self.hvac_set_temperature = np.trunc(action[:, self.hvac_action_cols[:, 1]] * 7.5 + 22.5).astype(np.float64)
+
+        es_src = np.trunc(action[:, self.es_action_cols])
+        self.es_mode = np.where(es_src > 1 / 3, 1, np.where(es_src > -1 / 3, 0, -1)).astype(np.int8)
+
+
+    def _update_hvac(self, area_temp: np.ndarray, ext_temp: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """HVACStateInternal.updateとHVAC.updateをベクトル化したもの
+        """
+        set_temp = self.hvac_set_temperature
+        is_on = self.hvac_status
+        was_off = self.hvac_mode == HVAC_OFF
+
+        # 初期値 (mode == Off からの起動)
+        init_mode = np.where(set_temp > area_temp, HVAC_HEAT, HVAC_COOL)
+        init_deficit = np.where(init_mode == HVAC_HEAT, set_temp - area_temp, area_temp - set_temp)
+        init_stand_by = init_deficit < HVACStateInternal.STAND_BY_GUARD_TEMPERATURE
+
+        # 状態遷移
+        deficit = np.where(self.hvac_mode == HVAC_HEAT, set_temp - area_temp, area_temp - set_temp)
+        switched_mode = np.where(self.hvac_mode == HVAC_HEAT, HVAC_COOL, HVAC_HEAT)
+        trans_mode = np.where(
+            deficit < -HVACStateInternal.MODE_GUARD_TEMPERATURE, switched_mode, self.hvac_mode)
+        trans_stand_by = np.where(
+            self.hvac_stand_by,
+            ~(deficit >= HVACStateInternal.STAND_BY_GUARD_TEMPERATURE),
+            deficit <= -HVACStateInternal.STAND_BY_GUARD_TEMPERATURE)
+
+        self.hvac_mode = np.where(
+            is_on, np.where(was_off, init_mode, trans_mode), HVAC_OFF).astype(np.int8)
+        self.hvac_stand_by = np.where(
+            is_on, np.where(was_off, init_stand_by, trans_stand_by), self.hvac_stand_by)
+
+        is_running = (self.hvac_mode != HVAC_OFF) & ~self.hvac_stand_by
+        is_cool = self.hvac_mode == HVAC_COOL
+
+        ext_temp = ext_temp[:, np.newaxis]
+        outside_deficit = np.where(is_cool, ext_temp - area_temp, area_temp - ext_temp)
+        cop = np.where(is_cool, -self.hvac_cool_cop, self.hvac_heat_cop)
+        max_power = np.where(is_cool, self.hvac_cool_max_power, self.hvac_heat_max_power)
+
+        heat_coef = np.where(
+            outside_deficit >= HVAC.EFFICIENCY_THRESH_TEMPERATURE,
+            1.,
+            2 - np.maximum(0, outside_deficit / HVAC.EFFICIENCY_THRESH_TEMPERATURE))
+
+        power = np.where(is_running, max_power, 0.)
+        heat = np.where(is_running, heat_coef * cop * max_power, 0.)
+
+        return power, heat
+
+
+    def _update_es(self) -> np.ndarray:
+        """ElectricStorage.updateをベクトル化したもの
+        """
+        is_charging = (self.es_mode == 1) & (self.es_charge_ratio < 0.98)
+        is_discharging = ~is_charging & (self.es_mode == -1) & (self.es_charge_ratio > 0.03)
+
+        delta = (self.es_charge_power / 60) / self.es_capacity
+        charge_ratio = np.where(
+            is_charging, self.es_charge_ratio + delta,
+            np.where(is_discharging, self.es_charge_ratio - delta, self.es_charge_ratio))
+
+        self.es_charge_ratio = np.minimum(np.maximum(charge_ratio, 0), 1)
+
+        return np.where(is_charging, self.es_charge_power, np.where(is_discharging, -self.es_discharge_power, 0.))
+
+
+    def _encode_state(self) -> np.ndarray:
+        """BuildingState.to_ndarrayと同じ並びで、(N, state_dim)の状態を作る
+        """
+        state = np.empty((self.num_buildings, self.state_dim), dtype=self.layout.dtype)
+
+        state[:, self.es_state_cols] = self.es_charge_ratio
+        state[:, self.area_power_cols] = self.power_consumption
+        state[:, self.area_temp_cols] = self.temperature
+        state[:, self.area_people_cols] = self.people
+
+        power_balance = 0
+        for area_idx in range(len(self.areas)):
+            power_balance = power_balance + self.power_consumption[:, area_idx]
+
+        # BuildingFacilitySimulator.get_stateと同様に、次のステップの外部環境を使う
+        state[:, self.building_cols[0]] = power_balance
+        state[:, self.building_cols[1]] = self._env_chunk['electric_price_unit'][self._env_pos]
+        state[:, self.building_cols[2]] = self._env_chunk['solar_radiation'][self._env_pos]
+        state[:, self.building_cols[3]] = self._env_chunk['temperature'][self._env_pos]
+
+        return state
+
+
+    def _calc_rewards(self, action: np.ndarray) -> np.ndarray:
+        if self._batch_reward is not None:
+            return self._batch_reward(self.state, action, self.layout.index)
+
+        return np.stack([self.get_last_result(bid).reward for bid in range(self.num_buildings)])
+
+
+    def get_last_result(self, building_id: int) -> Optional[StepResult]:
+        """直前のstepの、building_id番目のビルの結果を返す
+
+        結果はビルごとに最初に呼ばれた時点で一度だけ作り、状態とactionのオブジェクトは報酬の計算に必要な場合を除いて参照された時に作る
+        """
+        if self._last_results is None:
+            return None
+
+        if (result := self._last_results[building_id]) is not None:
+            return result
+
+        bfs = self.bfs_list[building_id]
+        action = self._last_action[building_id]
+        state_array = self.state[building_id]
+        state_array.flags.writeable = False
+
+        if self._last_rewards is not None:
+            reward = self._last_rewards[building_id]
+        elif is_vectorized_reward(bfs.calc_reward):
+            reward = bfs.calc_reward(state_array, action, self.layout.index)
+        else:
+            state = self.layout.decode_state(state_array)
+            building_action = BuildingAction.from_ndarray(action, bfs.areas)
+            result = StepResult(
+                steps=self.cur_steps,
+                state_array=state_array,
+                reward=bfs.calc_reward(state, building_action),
+                action_array=action,
+                state=state,
+                action=building_action
+            )
+            self._last_results[building_id] = result
+
+            return result
+
+        # 状態やactionのオブジェクトは、参照された時にstate_arrayとactionから作る
+        result = StepResult(
+            steps=self.cur_steps,
+            state_array=state_array,
+            reward=reward,
+            action_array=action,
+            create_state=lambda: self.layout.decode_state(state_array),
+            create_action=lambda: BuildingAction.from_ndarray(action, bfs.areas)
+        )
+        self._last_results[building_id] = result
+
+        return result
+
+
+    def get_state(self, building_id: int) -> BuildingState:
+        """building_id番目のビルの状態を、BuildingStateとして返す
+        """
+        if self._last_results is not None and self._last_results[building_id] is not None:
+            return self._last_results[building_id].state
+
+        return self.layout.decode_state(self.state[building_id])
+
+
+    def sync_to_simulators(self, building_ids: Optional[list[int]] = None):
+        """SoAの状態を、元のBuildingFacilitySimulatorのArea/Facilityオブジェクトに書き戻す
+        """
+        if building_ids is None:
+            building_ids = range(self.num_buildings)
+
+        for bid in building_ids:
+            bfs = self.bfs_list[bid]
+            hvac_idx = es_idx = 0
+
+            for area_idx, area in enumerate(bfs.areas):
+                area.temperature = float(self.temperature[bid, area_idx])
+                area.power_consumption = float(self.power_consumption[bid, area_idx])
+                area.people = int(self.people[bid, area_idx])
+
+                for facility in area.facilities:
+                    if isinstance(facility, HVAC):
+                        facility.state.mode = HVACMode(int(self.hvac_mode[bid, hvac_idx]))
+                        facility.state.stand_by = bool(self.hvac_stand_by[bid, hvac_idx])
+                        facility.status = bool(self.hvac_status[bid, hvac_idx])
+                        facility.set_temperature = int(self.hvac_set_temperature[bid, hvac_idx])
+                        hvac_idx += 1
+
+                    elif isinstance(facility, ElectricStorage):
+                        facility.charge_ratio = float(self.es_charge_ratio[bid, es_idx])
+                        facility.mode = CODE_TO_ES_MODE[int(self.es_mode[bid, es_idx])]
+                        es_idx += 1
+
+            bfs.last_result = self.get_last_result(bid)
+
+
+    def print_cur_state(self, building_id: int):
+        self.sync_to_simulators([building_id])
+        self.bfs_list[building_id].print_cur_state()
@@ -1,15 +1,22 @@
 from __future__ import annotations
 from datetime import timedelta, datetime
 from itertools import chain, count
-from typing import Callable, Iterator, Optional, Type, TypeVar
+from time import perf_counter
+from typing import Callable, Iterator, Optional, Type, TypeVar, Union
 
 import numpy as np
 
+from simulator import profiling
 from simulator.area import Area
 from simulator.building import BuildingAction, BuildingState
-from simulator.environment import AreaEnvironment, BuildingEnvironment, ExternalEnvironment
+from simulator.environment import (
+    AreaEnvironment, BuildingEnvironment, BuildingEnvironmentRow, EnvironmentTable, 
+    ExternalEnvironment, ExternalEnvironmentRow)
 from simulator.interfaces.config import AreaAttributes, SimulatorConfig
 from simulator.interfaces.model import RlModel
+from simulator.layout import BuildingLayout
+from simulator.reward import CalcReward, VectorizedReward, is_vectorized_reward
+from simulator.rollout import BatchPolicy, StepResult, Trajectory
 
 
 class BuildingFacilitySimulator:
@@ -17,17 +24,31 @@ class BuildingFacilitySimulator:
     """
 
     # TODO: モデルが複数になると報酬が複数になりそう
-    def __init__(self, config: SimulatorConfig, calc_reward: Callable[[BuildingState, BuildingAction], np.ndarray]):
+    def __init__(
+            self, 
+            config: SimulatorConfig, 
+            calc_reward: Union[CalcReward, VectorizedReward],
+            state_dtype: type = np.float64):
+        """calc_rewardには、simulator.reward.vectorized_rewardを付けた関数を渡すこともできる
+        """
         self.areas: list[Area] = list(map(AreaAttributes.to_area, config.building_attributes.areas))
+        self._init_layout(state_dtype)
 
-        self.env_iter: Iterator[BuildingEnvironment] = config.get_env_iter()
-        self.prev_env: Optional[BuildingEnvironment] = None
-        self.next_env: Optional[BuildingEnvironment] = next(self.env_iter, None)
+        self.env_table: EnvironmentTable = config.get_env_table()
+        # 次のstepで使う環境変数の、env_table上の位置
+        self.env_step: int = 0
 
-        self.calc_reward: Callable[[BuildingState, BuildingAction], float] = calc_reward
+        self.calc_reward: Union[CalcReward, VectorizedReward] = calc_reward
         
         self.start_time: datetime = config.start_time
         self.cur_steps: int = 0
+        self.last_result: Optional[StepResult] = None
+
+
+    def _init_layout(self, state_dtype: type):
+        self.layout: BuildingLayout = BuildingLayout(self.areas, dtype=state_dtype)
+        self._snapshot_buffer: np.ndarray = np.zeros(self.layout.snapshot_shape, dtype=np.float64)
+        self._initial_snapshot: bytes = self._write_snapshot(steps=0)
 
 
     M = TypeVar('M', bound=RlModel)
@@ -40,59 +61,260 @@ class BuildingFacilitySimulator:
         )
 
 
-    def _next_step(self) -> Optional[BuildingEnvironment]:
-        if self.next_env:
-            self.prev_env = self.next_env
-            self.next_env = next(self.env_iter, None)
-            return self.prev_env
-        else:
+    @property
+    def prev_env(self) -> Optional[BuildingEnvironmentRow]:
+        return self.env_table[self.env_step - 1] if self.env_step > 0 else None
+
+
+    @property
+    def next_env(self) -> Optional[BuildingEnvironmentRow]:
+        return self.env_table[self.env_step] if not self.has_finished() else None
+
+
+    def _next_step(self) -> Optional[BuildingEnvironmentRow]:
+        if self.has_finished():
             return None
 
+        self.env_step += 1
+        return self.env_table[self.env_step - 1]
+
+
+    def _get_cur_external(self) -> ExternalEnvironmentRow:
+        """get_stateで使う外部環境 (次のstepのもの、最後まで進んだ場合は直前のもの)
+        """
+        return self.env_table.external_at(min(self.env_step, len(self.env_table) - 1))
+
 
     def has_finished(self) -> bool:
-        return not bool(self.next_env)
+        return self.env_step >= len(self.env_table)
+
+
+    def seek(self, target: Union[datetime, int]):
+        """環境変数の時系列上の位置を、target(時刻またはstart_timeからのstep数)に移動する
+        エリアや設備の状態はそのまま引き継ぐ
+        """
+        steps = self._to_steps(target) if isinstance(target, datetime) else target
+
+        if not 0 <= steps <= len(self.env_table):
+            raise ValueError(f'Cannot seek to step {steps} (must be in [0, {len(self.env_table)}]).')
+
+        self.env_step = steps
+        self.cur_steps = steps
+        self.last_result = None
+
+
+    def reset(self, start: Union[datetime, int] = 0):
+        """エリアや設備の状態を初期状態に戻し、start(時刻またはstart_timeからのstep数)から始め直す
+        """
+        self.restore(self._initial_snapshot)
+        self.seek(start)
+
 
+    def snapshot(self) -> bytes:
+        """現在のstep数と、エリア・設備の内部状態を、固定長のバイト列として返す
+        """
+        return self._write_snapshot(self.cur_steps)
+
+
+    def restore(self, snapshot: bytes):
+        """snapshotで保存した時点の状態に戻す
+        """
+        self.seek(self._read_snapshot(snapshot))
+
+
+    def _read_snapshot(self, snapshot: bytes) -> int:
+        """エリア・設備の内部状態をsnapshotの時点に戻し、snapshotのstep数を返す (時系列上の位置は変えない)
+        """
+        src = np.frombuffer(snapshot, dtype=np.float64)
+        if src.shape != self.layout.snapshot_shape:
+            raise ValueError(
+                f'Snapshot size mismatch ({src.shape} != {self.layout.snapshot_shape}). Maybe taken from another building?')
+
+        self.layout.read_snapshot(self.areas, src)
+        return int(src[0])
+
+
+    def _write_snapshot(self, steps: int) -> bytes:
+        self._snapshot_buffer[0] = steps
+        self.layout.write_snapshot(self.areas, self._snapshot_buffer)
+
+        return self._snapshot_buffer.tobytes()
 
-    def step(self, action: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+
+    def _to_steps(self, dt: datetime) -> int:
+        steps, remainder = divmod(dt - self.start_time, timedelta(minutes=1))
+
+        if remainder:
+            raise ValueError(f'{dt} is not aligned to the simulation steps starting from {self.start_time}.')
+
+        return steps
+
+
+    def step(self, action: np.ndarray) -> Optional[StepResult]:
         """2.6節のシミュレーションを1サイクル分進めるメソッド
         while not bfs.has_finished():
             for i in range(10):
                 action = compute_action()
-                (state, reward) = bfs.step(action)
+                result = bfs.step(action)
             
             update_model()
 
         みたいにすると、10stepごとにモデルの更新を行える
-        """
 
-        action: BuildingAction = BuildingAction.from_ndarray(action, self.areas)
+        返り値はself.last_resultにも保持され、次のstepまではget_stateもその状態を返す
+        (最後まで進んでいた場合はNoneを返す)
+        simulator.profilingで計測を有効にした場合は、各フェーズの時間を記録する
+        """
+        profiler = profiling.active
+        if profiler:
+            start = perf_counter()
 
         if (cur_env := self._next_step()) is None:
-            return (None, None)
+            return None
 
-        for area_id, area, area_env in zip(count(), self.areas, cur_env.areas):
-            area.update(action.areas[area_id], cur_env.external, area_env)
+        if profiler:
+            start = profiler.lap("env_fetch", start)
 
-        state = self.get_state()
+        self.layout.decode_action(action, self.areas)
 
-        self.cur_steps += 1
-        self.last_state = state
+        if profiler:
+            profiler.lap("action_decode", start)
 
-        return (
-            state.to_ndarray(),
-            self.calc_reward(state, action)
-        )
+        # エリアと設備の更新は、Area.updateの中で計測する
+        self._advance(cur_env)
+
+        if profiler:
+            start = perf_counter()
+
+        # StepResultのstate_arrayは以降のstepで上書きされないように、新しいバッファに書き込む
+        state_array = self.layout.encode_state(
+            self.areas, self._get_cur_external(), out=self.layout.new_state_buffer())
+        state_array.flags.writeable = False
+
+        if profiler:
+            start = profiler.lap("state_encode", start)
+
+        if is_vectorized_reward(self.calc_reward):
+            reward = self.calc_reward(state_array, action, self.layout.index)
+            # 状態やactionのオブジェクトは、参照された時にstate_arrayとactionから作る
+            areas, layout = self.areas, self.layout
+            self.last_result = StepResult(
+                steps=self.cur_steps,
+                state_array=state_array,
+                reward=reward,
+                action_array=action,
+                create_state=lambda: layout.decode_state(state_array),
+                create_action=lambda: BuildingAction.from_ndarray(action, areas)
+            )
+        else:
+            state = BuildingState.create([area.get_state() for area in self.areas], self._get_cur_external())
+            building_action = BuildingAction.from_ndarray(action, self.areas)
+
+            if profiler:
+                # 設備への設定 (action_decode) とは別に、報酬の計算に渡すオブジェクトを作る時間
+                start = profiler.lap("action_object", start)
+
+            reward = self.calc_reward(state, building_action)
+            self.last_result = StepResult(
+                steps=self.cur_steps,
+                state_array=state_array,
+                reward=reward,
+                action_array=action,
+                state=state,
+                action=building_action
+            )
+
+        if profiler:
+            profiler.lap("reward", start)
+
+        return self.last_result
 
     
-    def step_with_model(self, model: RlModel, train_model: bool = True) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
-        state = self.get_state().to_ndarray()
+    def step_with_model(self, model: RlModel, train_model: bool = True) -> Optional[StepResult]:
+        state = self.get_state_array()
         action = model.select_action(state)
-        next_state, reward = self.step(action)
+        result = self.step(action)
 
-        if next_state is not None and reward is not None and train_model:
-            model.add_to_buffer(state, action, next_state, reward)
+        if result is not None and train_model:
+            model.add_to_buffer(state, action, result.state_array, result.reward)
 
-        return next_state, action, reward
+        return result
+
+    
+    def fast_forward(
+            self, 
+            until: Union[datetime, int], 
+            action: Optional[np.ndarray] = None, 
+            on_step: Optional[Callable[[BuildingFacilitySimulator], None]] = None) -> int:
+        """報酬や状態を計算せずに、シミュレーションをuntil(時刻またはstart_timeからのstep数)まで進める
+
+        actionを渡した場合は最初にそれで設備の設定を更新し、省略した場合は直前の設定のまま進める。
+        on_stepを渡した場合は、各stepの後に呼び出す。進めたstep数を返す。
+        """
+        steps = self._to_steps(until) if isinstance(until, datetime) else until
+
+        if action is not None:
+            self.layout.decode_action(action, self.areas)
+
+        start_steps = self.cur_steps
+        while self.cur_steps < steps and (cur_env := self._next_step()) is not None:
+            self._advance(cur_env)
+
+            if on_step:
+                on_step(self)
+
+        return self.cur_steps - start_steps
+
+
+    def _advance(self, cur_env: BuildingEnvironmentRow):
+        """現在の設備の設定のまま、各エリアをcur_envで1step分更新する
+        """
+        for area, area_env in zip(self.areas, cur_env.areas):
+            area.update(None, cur_env.external, area_env)
+
+        self.cur_steps += 1
+        self.last_result = None
+
+
+    def rollout(self, policy: BatchPolicy, n_steps: int, out: Optional[Trajectory] = None) -> Trajectory:
+        """policyに従ってn_steps分(途中で終了した場合はそこまで)シミュレーションを進め、その軌跡を返す
+
+        policyにはバッチサイズ1の(1, state_dim)の状態が渡される。
+        outを渡した場合はそこに書き込み、書き込んだ範囲のviewを返す。
+        calc_rewardがVectorizedRewardの場合は、状態のオブジェクトを作らずに進め、報酬を最後にまとめて計算する。
+        """
+        if out is None:
+            out = Trajectory.allocate(n_steps, self.get_state_shape(), self.get_action_shape())
+
+        vectorized = is_vectorized_reward(self.calc_reward)
+        states, actions, rewards, next_states = out
+        state = self.get_state_array()
+
+        for i in range(n_steps):
+            if self.has_finished():
+                n_steps = i
+                break
+
+            states[i] = state
+            action = policy(states[i:i + 1])[0]
+
+            if vectorized:
+                self.layout.decode_action(action, self.areas)
+                self._advance(self._next_step())
+                state = self.get_state_array()
+            else:
+                result = self.step(action)
+                state = result.state_array
+                rewards[i] = result.reward
+
+            actions[i] = action
+            next_states[i] = state
+
+        out = out.head(n_steps)
+        if vectorized:
+            out.rewards[:] = self.calc_reward(out.next_states, out.actions, self.layout.index)
+
+        return out
 
     
     def get_current_datetime(self):
@@ -100,24 +322,28 @@ class BuildingFacilitySimulator:
 
 
     def get_state(self) -> BuildingState:
+        if self.last_result is not None and self.last_result.steps == self.cur_steps:
+            return self.last_result.state
+
         area_states = [area.get_state() for area in self.areas]
 
-        cur_env = self.next_env or self.prev_env
+        return BuildingState.create(area_states, self._get_cur_external())
+
+
+    def get_state_array(self) -> np.ndarray:
+        """get_state().to_ndarray()と同じ値を、BuildingStateを作らずに返す
 
-        return BuildingState.create(area_states, cur_env.external)
+        layoutのバッファに書き込むため、次の呼び出しで上書きされる (stepの返すstate_arrayは上書きされない)
+        """
+        return self.layout.encode_state(self.areas, self._get_cur_external())
 
 
     def get_state_shape(self) -> tuple[int]:
-        return (BuildingState.NDARRAY_ELEMS + sum(a.get_state_shape()[0] for a in self.areas),)
+        return self.layout.state_shape
 
     
     def get_action_shape(self) -> tuple[int]:
-        size = 0
-        for area in self.areas:
-            for facility in area.facilities:
-                size += facility.ACTION_TYPE.NDARRAY_SHAPE[0]
-        
-        return (size,)
+        return self.layout.action_shape
 
 
     def print_cur_state(self):
@@ -125,30 +351,40 @@ class BuildingFacilitySimulator:
         if self.prev_env:
             print(self.prev_env.external)
 
-        for aid, (area, st) in enumerate(zip(self.areas, self.last_state.areas)):
+        state = self.get_state()
+        for aid, (area, st) in enumerate(zip(self.areas, state.areas)):
             print(f"area {aid}: temp={area.temperature:.2f}, power={st.power_consumption:.2f}, {area.facilities[0]}")
 
-        print(f"total power consumption: {self.last_state.power_balance:.2f}", flush=True)
+        print(f"total power consumption: {state.power_balance:.2f}", flush=True)
     
 
     # TODO: __init__とのコードのダブりをどうにかする
     @staticmethod
     def _from_models(
         areas: list[Area], 
-        envs: list[BuildingEnvironment], 
-        calc_reward: Callable[[BuildingState, BuildingAction], np.ndarray],
-        start_time: datetime
+        env_table: EnvironmentTable, 
+        calc_reward: Union[CalcReward, VectorizedReward],
+        start_time: datetime,
+        state_dtype: type = np.float64,
+        snapshot: Optional[bytes] = None
     ) -> BuildingFacilitySimulator:
+        """snapshotを渡した場合は、areasの内部状態をその時点に戻してから、env_tableの先頭から始める
+        """
         bfs = BuildingFacilitySimulator.__new__(BuildingFacilitySimulator)
         bfs.areas = areas
+        bfs._init_layout(state_dtype)
+
+        if snapshot is not None:
+            bfs._read_snapshot(snapshot)
+            bfs._initial_snapshot = bfs._write_snapshot(steps=0)
 
-        bfs.env_iter = iter(envs)
-        bfs.prev_env = None
-        bfs.next_env = next(bfs.env_iter, None)
+        bfs.env_table = env_table
+        bfs.env_step = 0
 
         bfs.calc_reward = calc_reward
 
         bfs.start_time = start_time
         bfs.cur_steps = 0
+        bfs.last_result = None
 
         return bfs
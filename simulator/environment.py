@@ -1,5 +1,8 @@
-from typing import Optional, Type, TypeVar
+from __future__ import annotations
+import hashlib
+from typing import NamedTuple, Optional, Type, TypeVar
 
+import numpy as np
 from pydantic import BaseModel
 
 
@@ -32,3 +35,89 @@ class AreaEnvironment(BaseModel):
 class BuildingEnvironment(BaseModel):
     external: ExternalEnvironment
     areas: list[Optional[AreaEnvironment]]
+
+
+class ExternalEnvironmentRow(NamedTuple):
+    """EnvironmentTableから読み出した、ExternalEnvironmentと同じ属性を持つ軽量なオブジェクト
+    """
+
+    solar_radiation:     float # [W/m^2]
+    temperature:         float # [℃]
+    electric_price_unit: float # [¥/kWh]
+
+
+class AreaEnvironmentRow(NamedTuple):
+    """EnvironmentTableから読み出した、AreaEnvironmentと同じ属性を持つ軽量なオブジェクト
+    """
+
+    people: int
+    heat_source: float # [W]
+
+    calc_beta = AreaEnvironment.calc_beta
+
+
+class BuildingEnvironmentRow(NamedTuple):
+    external: ExternalEnvironmentRow
+    areas: list[Optional[AreaEnvironmentRow]]
+
+
+class EnvironmentTable:
+    """BuildingEnvironmentの時系列を、列ごとのndarray(structured array)として保持するもの
+
+    externalはExternalEnvironmentの、areasの各要素はAreaEnvironmentのフィールドを列に持つ。
+    環境変数の与えられていないエリアはNoneとなる。
+    """
+
+    def __init__(self, external: np.ndarray, areas: list[Optional[np.ndarray]]):
+        length = min([len(external)] + [len(area) for area in areas if area is not None])
+
+        self.external: np.ndarray = external[:length]
+        self.areas: list[Optional[np.ndarray]] = [None if area is None else area[:length] for area in areas]
+
+
+    def __len__(self) -> int:
+        return len(self.external)
+
+
+    def __getitem__(self, step: int) -> BuildingEnvironmentRow:
+        return BuildingEnvironmentRow(
+            external=self.external_at(step),
+            areas=[None if area is None else AreaEnvironmentRow._make(area[step].item()) for area in self.areas]
+        )
+
+
+    def external_at(self, step: int) -> ExternalEnvironmentRow:
+        return ExternalEnvironmentRow._make(self.external[step].item())
+
+
+    def get_model(self, step: int) -> BuildingEnvironment:
+        """step番目の環境変数を、pydanticのBuildingEnvironmentとして返す (デバッグ用)
+        """
+        row = self[step]
+        return BuildingEnvironment(
+            external=ExternalEnvironment(**row.external._asdict()),
+            areas=[None if area is None else AreaEnvironment(**area._asdict()) for area in row.areas]
+        )
+
+
+    def digest(self) -> str:
+        """列の型と中身から計算したハッシュ値を返す (ノード間で、同じ時系列かどうかを判定するのに使う)
+        """
+        digest = hashlib.sha1()
+        for columns in [self.external] + self.areas:
+            if columns is None:
+                digest.update(b'none')
+            else:
+                digest.update(str(columns.dtype.descr).encode())
+                digest.update(np.ascontiguousarray(columns).data)
+
+        return digest.hexdigest()
+
+
+    def slice(self, start: int, stop: int) -> EnvironmentTable:
+        """[start, stop)の範囲の時系列を、コピーせずに切り出す
+        """
+        return EnvironmentTable(
+            external=self.external[start:stop],
+            areas=[None if area is None else area[start:stop] for area in self.areas]
+        )
@@ -1,7 +1,7 @@
 from __future__ import annotations
 from dataclasses import dataclass
 import enum
-from typing import Type
+from typing import ClassVar, Optional, Type
 
 import numpy as np
 
@@ -23,6 +23,11 @@ class ESMode(enum.Enum):
             return ESMode.Discharge
 
 
+# ESModeをndarrayで保持するための整数表現
+ES_MODE_TO_CODE = {ESMode.Discharge: -1, ESMode.Standby: 0, ESMode.Charge: 1}
+CODE_TO_ES_MODE = {code: mode for mode, code in ES_MODE_TO_CODE.items()}
+
+
 @dataclass
 class ESState(FacilityState):
     NDARRAY_SHAPE = (1,)
@@ -49,6 +54,7 @@ class ESAction(FacilityAction):
 class ElectricStorage(Facility):
     STATE_TYPE = ESState
     ACTION_TYPE = ESAction
+    SNAPSHOT_SIZE: ClassVar[int] = 2
 
     # static settings
     charge_power: float # [kW]
@@ -66,8 +72,13 @@ class ElectricStorage(Facility):
         self.mode = action.mode
 
 
-    def update(self, action: ESAction, **_) -> tuple[ESState, FacilityEffect]:
-        self.update_setting(action)
+    def update_setting_from_ndarray(self, src: np.ndarray, offset: int):
+        self.mode = ESMode.from_int(int(src[offset]))
+
+
+    def update(self, action: Optional[ESAction], **_) -> tuple[ESState, FacilityEffect]:
+        if action is not None:
+            self.update_setting(action)
 
         if self.mode == ESMode.Charge and self.charge_ratio < 0.98:
             # status = charge
@@ -94,5 +105,19 @@ class ElectricStorage(Facility):
         return ESState(charge_ratio=self.charge_ratio)
 
 
+    def write_state(self, out: np.ndarray, offset: int):
+        out[offset] = self.charge_ratio
+
+
+    def write_snapshot(self, out: np.ndarray, offset: int):
+        out[offset] = self.charge_ratio
+        out[offset + 1] = ES_MODE_TO_CODE[self.mode]
+
+
+    def read_snapshot(self, src: np.ndarray, offset: int):
+        self.charge_ratio = float(src[offset])
+        self.mode = CODE_TO_ES_MODE[int(src[offset + 1])]
+
+
     def __str__(self) -> str:
         return f"ES(charge_ratio={self.charge_ratio:.3f}, mode={self.mode})"
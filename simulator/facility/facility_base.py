@@ -1,7 +1,7 @@
 from __future__ import annotations
 from abc import ABC, abstractclassmethod, abstractmethod
 from dataclasses import dataclass
-from typing import NamedTuple, Type, TypeVar
+from typing import ClassVar, NamedTuple, Optional, Type, TypeVar
 
 import numpy as np
 from pydantic import BaseModel
@@ -23,19 +23,55 @@ class Facility(ABC, BaseModel):
     """設備を表す抽象クラス
     """
 
+    # snapshotで保存する内部状態・設定の要素数
+    SNAPSHOT_SIZE: ClassVar[int] = 0
+
     @abstractmethod
     def update(
         self, 
-        action: FacilityAction,
+        action: Optional[FacilityAction],
         ext_env: ExternalEnvironment,
         area_temperature: float,
     ) -> tuple[FacilityState, FacilityEffect]:
 
         """環境変数に応じて設備の状態を更新し、エリアへの影響を返す
+        actionがNoneの場合は、現在の設定のまま更新する
         """
         
         raise NotImplementedError()
 
+
+    def update_setting(self, action: FacilityAction):
+        """AIからの指示で設定を更新する (指示を受け付けない設備では何もしない)
+        """
+        pass
+
+
+    def update_setting_from_ndarray(self, src: np.ndarray, offset: int):
+        """src[offset:]から、FacilityActionを経由せずに設定を更新する
+        """
+        size = self.ACTION_TYPE.NDARRAY_SHAPE[0]
+        self.update_setting(self.ACTION_TYPE.from_ndarray(src[offset:offset + size]))
+
+
+    def write_state(self, out: np.ndarray, offset: int):
+        """out[offset:]に、FacilityStateを経由せずに現在の状態を書き込む
+        """
+        size = self.STATE_TYPE.NDARRAY_SHAPE[0]
+        out[offset:offset + size] = self.get_state().to_ndarray()
+
+
+    def write_snapshot(self, out: np.ndarray, offset: int):
+        """out[offset:offset + SNAPSHOT_SIZE]に、内部状態と設定を書き込む
+        """
+        pass
+
+
+    def read_snapshot(self, src: np.ndarray, offset: int):
+        """write_snapshotで書き込んだ内容から、内部状態と設定を復元する
+        """
+        pass
+
     @abstractmethod
     def get_state(self) -> FacilityState:
 
@@ -1,7 +1,7 @@
 from __future__ import annotations
 from dataclasses import dataclass
 import enum
-from typing import ClassVar
+from typing import ClassVar, Optional
 
 import numpy as np
 
@@ -92,15 +92,30 @@ class HVACAction(FacilityAction):
     @classmethod
     def from_ndarray(cls, src: np.ndarray) -> HVACAction:
         return cls(
-            status=(src[0] > 0.), 
-            set_temperature=int(src[1] * 7.5 + 22.5)
+            status=HVACAction.to_status(src[0]), 
+            set_temperature=HVACAction.to_set_temperature(src[1])
         )
 
+    @staticmethod
+    def to_status(src: float) -> bool:
+        return src > 0.
+
+    @staticmethod
+    def to_set_temperature(src: float) -> int:
+        return int(src * 7.5 + 22.5)
+
+    @staticmethod
+    def from_set_temperature(set_temperature: float) -> float:
+        """to_set_temperatureでset_temperatureになる、ndarray上の値を返す
+        """
+        return (set_temperature + 0.5 - 22.5) / 7.5
+
 
 @FacilityFactory.register("HVAC")
 class HVAC(Facility):
     STATE_TYPE = EmptyFacilityState
     ACTION_TYPE = HVACAction
+    SNAPSHOT_SIZE: ClassVar[int] = 4
 
     EFFICIENCY_THRESH_TEMPERATURE: ClassVar[int] = 10
 
@@ -123,10 +138,16 @@ class HVAC(Facility):
         self.set_temperature = action.set_temperature
 
 
-    def update(self, action: HVACAction, ext_env: ExternalEnvironment, 
+    def update_setting_from_ndarray(self, src: np.ndarray, offset: int):
+        self.status = HVACAction.to_status(src[offset])
+        self.set_temperature = HVACAction.to_set_temperature(src[offset + 1])
+
+
+    def update(self, action: Optional[HVACAction], ext_env: ExternalEnvironment, 
             area_temperature: float, **_) -> tuple[FacilityState, FacilityEffect]:
 
-        self.update_setting(action)
+        if action is not None:
+            self.update_setting(action)
 
         self.state.update(self.status, area_temperature, self.set_temperature)
 
@@ -161,5 +182,20 @@ class HVAC(Facility):
     def get_state(self) -> EmptyFacilityState:
         return EmptyFacilityState()
 
+
+    def write_snapshot(self, out: np.ndarray, offset: int):
+        out[offset] = self.state.mode.value
+        out[offset + 1] = self.state.stand_by
+        out[offset + 2] = self.status
+        out[offset + 3] = self.set_temperature
+
+
+    def read_snapshot(self, src: np.ndarray, offset: int):
+        self.state.mode = HVACMode(int(src[offset]))
+        self.state.stand_by = bool(src[offset + 1])
+        self.status = bool(src[offset + 2])
+        # HVACAction.to_set_temperatureと同じく、整数で持つ
+        self.set_temperature = int(round(src[offset + 3]))
+
     def __str__(self) -> str:
         return f"HVAC(mode={self.state.mode}, stand_by={self.state.stand_by}, temp_setting={self.set_temperature:.1f})"
\ No newline at end of file
@@ -1,16 +1,17 @@
 from __future__ import annotations
-from csv import DictReader
-from itertools import repeat
 from typing import Iterator, Iterator, Type, TypeVar, Union
 from datetime import datetime
 from pathlib import Path
 from typing import Any, Optional
+
+import numpy as np
 from pydantic import BaseModel, Field, FilePath, validator
 
 from simulator.area import Area
-from simulator.environment import AreaEnvironment, BuildingEnvironment, ExternalEnvironment
+from simulator.environment import AreaEnvironment, BuildingEnvironment, EnvironmentTable, ExternalEnvironment
 from simulator.facility.facility_base import Facility
 from simulator.facility.factory import FacilityFactory
+from simulator.interfaces.timeseries import load_csv_columns, models_to_columns
 
 
 def check_at_least_one(target: dict[str, Any], field1: str, field2: str):
@@ -18,23 +19,6 @@ def check_at_least_one(target: dict[str, Any], field1: str, field2: str):
         raise ValueError(f'Either one of {field1} and {field2} is required.')
 
 
-M = TypeVar('M', bound=BaseModel)
-class CsvModelIterator(Iterator[M]):
-    def __init__(self, csv_path: Path, ModelType: Type[M]):
-        self.file = csv_path.open()
-        self.ModelType = ModelType
-        self.header = self.file.readline().strip('\n').split(',')
-    
-    def __iter__(self) -> CsvModelIterator:
-        return self
-    
-    def __next__(self) -> M:
-        row = self.file.readline().split(',')
-        return self.ModelType.parse_obj(
-            {key: value for key, value in zip(self.header, row)}
-        )
-
-
 class FacilityAttributes(BaseModel):
     facility_type: str = Field(alias="type")
     parameters: dict[str, Union[int, float, str]]
@@ -88,20 +72,26 @@ class SimulatorConfig(BaseModel):
         return v
 
     
-    def get_env_iter(self) -> Iterator[BuildingEnvironment]:
+    def get_env_table(self) -> EnvironmentTable:
+        """環境変数の時系列を、CSVから一括で(キャッシュがあればそこから)読み込む
+        """
         if self.external_enviroment_time_series:
-            ext_env_iter = self.external_enviroment_time_series
+            external = models_to_columns(self.external_enviroment_time_series, ExternalEnvironment)
         else:
-            ext_env_iter = CsvModelIterator(self.external_environment_csv_path, ExternalEnvironment)
+            external = load_csv_columns(self.external_environment_csv_path, ExternalEnvironment)
         
-        def get_area_env_from_area_attr(area_attr: AreaAttributes) -> Iterator[tuple[Optional[AreaEnvironment], ...]]:
+        def get_area_env_from_area_attr(area_attr: AreaAttributes) -> Optional[np.ndarray]:
             if area_attr.area_environment_time_series:
-                return area_attr.area_environment_time_series
+                return models_to_columns(area_attr.area_environment_time_series, AreaEnvironment)
             elif area_attr.area_environment_csv_path:
-                return CsvModelIterator(area_attr.area_environment_csv_path, AreaEnvironment)
-            return repeat(None)
-        
-        area_envs_iter = zip(*map(get_area_env_from_area_attr, self.building_attributes.areas))
+                return load_csv_columns(area_attr.area_environment_csv_path, AreaEnvironment)
+            return None
         
-        return map(
-            lambda ext_areas: BuildingEnvironment(external=ext_areas[0], areas=list(ext_areas[1])), zip(ext_env_iter, area_envs_iter))
+        return EnvironmentTable(
+            external=external, 
+            areas=list(map(get_area_env_from_area_attr, self.building_attributes.areas)))
+
+
+    def get_env_iter(self) -> Iterator[BuildingEnvironment]:
+        env_table = self.get_env_table()
+        return map(env_table.get_model, range(len(env_table)))
@@ -1,8 +1,23 @@
 from abc import ABC, abstractmethod
+from typing import Protocol
 
 import numpy as np
 
 
+# clientのモデルのうち、global共有する部分のパラメータ (パラメータ名 -> ndarray)
+ModelCheckpoint = dict[str, np.ndarray]
+
+
+class CheckpointAggregator(Protocol):
+    """clientのcheckpointを1つずつ受け取り、globalモデルにまとめるもの (サーバはラウンドごとに1つ作る)
+    """
+    def add(self, checkpoint: ModelCheckpoint, num_samples: int = 1):
+        ...
+
+    def result(self) -> ModelCheckpoint:
+        ...
+
+
 class RlModel(ABC):
     @abstractmethod
     def __init__(self, state_shape: tuple[int], action_shape: tuple[int], **kwargs):
@@ -16,7 +31,26 @@ class RlModel(ABC):
     def add_to_buffer(self, state: np.ndarray, action: np.ndarray, next_state: np.ndarray, reward: np.ndarray):
         pass
 
-    # clientのモデルのうち、global共有したい部分だけを抜き出す
-    # @abstractmethod
-    # def get_checkpoint(self) -> RlModel:
-    #     pass
+    def select_actions(self, states: np.ndarray) -> np.ndarray:
+        """(バッチサイズ, state_dim)の状態に対する行動を、まとめて返す
+        """
+        return np.stack([self.select_action(state) for state in states])
+
+    def add_batch_to_buffer(
+            self, states: np.ndarray, actions: np.ndarray, next_states: np.ndarray, rewards: np.ndarray):
+        """rolloutなどで得た複数stepの遷移を、まとめてバッファに追加する
+        """
+        for transition in zip(states, actions, next_states, rewards):
+            self.add_to_buffer(*transition)
+
+    @abstractmethod
+    def get_checkpoint(self) -> ModelCheckpoint:
+        """clientのモデルのうち、global共有したい部分だけを抜き出す (replay bufferなどは含めない)
+        """
+        pass
+
+    @abstractmethod
+    def load_checkpoint(self, checkpoint: ModelCheckpoint):
+        """get_checkpointで抜き出したパラメータを読み込む
+        """
+        pass
@@ -0,0 +1,106 @@
+from __future__ import annotations
+import hashlib
+import os
+from pathlib import Path
+from typing import Type, TypeVar
+
+import numpy as np
+from pydantic import BaseModel
+
+
+M = TypeVar('M', bound=BaseModel)
+
+# pydanticのフィールドの型から、ndarrayの列の型への対応
+FIELD_TYPE_TO_DTYPE = {
+    int: np.int64,
+    float: np.float64,
+}
+
+DIGEST_CHUNK_SIZE = 1 << 20
+
+
+def get_columns_dtype(ModelType: Type[M]) -> np.dtype:
+    """ModelTypeのフィールドを列に持つ、structured arrayのdtypeを返す
+    """
+    return np.dtype([
+        (name, FIELD_TYPE_TO_DTYPE[field.outer_type_]) for name, field in ModelType.__fields__.items()
+    ])
+
+
+def file_digest(path: Path) -> str:
+    """ファイルの中身のハッシュ値を返す (キャッシュや、ノード間でのデータセットの同定に使う)
+    """
+    digest = hashlib.sha1()
+    with path.open('rb') as f:
+        while chunk := f.read(DIGEST_CHUNK_SIZE):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def get_cache_path(csv_path: Path, digest: str) -> Path:
+    return csv_path.with_name(f"{csv_path.name}.{digest[:16]}.npy")
+
+
+def models_to_columns(models: list[M], ModelType: Type[M]) -> np.ndarray:
+    """pydanticモデルのリストを、列ごとのstructured arrayに変換する
+    """
+    dtype = get_columns_dtype(ModelType)
+    return np.array([tuple(getattr(model, name) for name in dtype.names) for model in models], dtype=dtype)
+
+
+def load_csv_columns(csv_path: Path, ModelType: Type[M], use_cache: bool = True) -> np.ndarray:
+    """ModelTypeの各フィールドを列として持つCSVを、structured arrayとして一括で読み込む
+
+    読み込んだ結果は、CSVの中身のハッシュ値をキーとして同じディレクトリに.npyとして保存し、
+    次回以降はそれをメモリマップして返す
+    """
+    dtype = get_columns_dtype(ModelType)
+
+    if use_cache:
+        cache_path = get_cache_path(csv_path, file_digest(csv_path))
+        try:
+            columns = np.load(cache_path, mmap_mode='r')
+            if columns.dtype == dtype:
+                return columns
+        except FileNotFoundError:
+            # まだ保存されていないか、CSVが書き換えられて他のプロセスが消した
+            pass
+
+    with csv_path.open() as f:
+        header = f.readline().strip().split(',')
+        missing = set(dtype.names) - set(header)
+        if missing:
+            raise ValueError(f'{csv_path} does not have the columns required by {ModelType.__name__}: {missing}')
+
+        usecols = [i for i, name in enumerate(header) if name in dtype.names]
+        raw = np.loadtxt(
+            f, delimiter=',', ndmin=1, usecols=usecols,
+            dtype=[(header[i], dtype.fields[header[i]][0]) for i in usecols])
+
+    columns = np.empty(len(raw), dtype=dtype)
+    for name in dtype.names:
+        columns[name] = raw[name]
+
+    if use_cache:
+        _write_cache(csv_path, cache_path, columns)
+
+    return columns
+
+
+def _write_cache(csv_path: Path, cache_path: Path, columns: np.ndarray):
+    try:
+        # 中身の変わる前のCSVのキャッシュを消す (同じハッシュ値のキャッシュは、他のプロセスが読み込んでいるかもしれないので残す)
+        for old_cache_path in csv_path.parent.glob(f"{csv_path.name}.*.npy"):
+            if old_cache_path != cache_path:
+                # 他のプロセスが先に消していてもよい
+                old_cache_path.unlink(missing_ok=True)
+
+        # 書き込み途中のファイルが読まれないように置き換える
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+        with tmp_path.open('wb') as f:
+            np.save(f, columns)
+        os.replace(tmp_path, cache_path)
+
+    except OSError as e:
+        print(f"Failed to write cache for {csv_path}: {e}", flush=True)
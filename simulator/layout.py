@@ -0,0 +1,252 @@
+from __future__ import annotations
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from simulator.area import Area, AreaState
+from simulator.building import BuildingState
+from simulator.environment import ExternalEnvironment
+from simulator.facility import ElectricStorage, HVAC
+from simulator.facility.electric_storage import ESState
+from simulator.facility.facility_base import EmptyFacilityState, Facility, FacilityState
+
+
+class FacilityLayout(NamedTuple):
+    """1つの設備の、state/actionのndarray上の位置
+    """
+    area_idx: int
+    facility_idx: int
+    facility_type: type[Facility]
+    state_offset: int
+    state_size: int
+    action_offset: int
+    action_size: int
+    snapshot_offset: int
+    snapshot_size: int
+
+
+class AreaLayout(NamedTuple):
+    """1つのエリアの、stateのndarray上の位置
+    """
+    facilities: list[FacilityLayout]
+    # ndarrayに書き込む/から読み出す必要がある設備だけを、(エリア内の設備番号, offset)で持つ
+    state_writers: list[tuple[int, int]]
+    action_readers: list[tuple[int, int]]
+    snapshot_writers: list[tuple[int, int]]
+    power_consumption_col: int
+    temperature_col: int
+    people_col: int
+    # snapshot上の、temperature, power_consumption, peopleの先頭位置
+    snapshot_offset: int
+
+
+class LayoutIndex(NamedTuple):
+    """state/actionのndarray上の、名前付きの列番号
+
+    states[..., index.area_temperature] のように、複数step・複数ビル分をまとめたndarrayにも使える。
+    配列の列番号は、エリアや設備の並び順になっている。
+    """
+    # state
+    area_power_consumption: np.ndarray
+    area_temperature: np.ndarray
+    area_people: np.ndarray
+    es_charge_ratio: np.ndarray
+    power_balance: int
+    electric_price_unit: int
+    solar_radiation: int
+    temperature: int
+
+    # action (from_ndarrayで変換する前の値)
+    hvac_status: np.ndarray
+    hvac_set_temperature: np.ndarray
+    es_mode: np.ndarray
+
+
+class BuildingLayout:
+    """BuildingState.to_ndarray / BuildingAction.from_ndarray と同じ並びを、areasから一度だけ計算したもの
+
+    stateは事前に確保したバッファに直接書き込み、actionはFacilityActionを作らずに設備の設定へ直接反映する。
+    また、エリアと設備の内部状態を固定長のndarray(snapshot)に読み書きする。
+    """
+
+    # snapshotの先頭に確保しておく要素数 (BuildingFacilitySimulatorがstep数の保存に使う)
+    SNAPSHOT_HEADER_SIZE = 1
+    AREA_SNAPSHOT_SIZE = 3
+
+    def __init__(self, areas: list[Area], dtype: type = np.float64):
+        self.dtype: np.dtype = np.dtype(dtype)
+        self.area_layouts: list[AreaLayout] = []
+        self.facility_layouts: list[FacilityLayout] = []
+
+        state_cursor = 0
+        action_cursor = 0
+        snapshot_cursor = BuildingLayout.SNAPSHOT_HEADER_SIZE
+        for area_idx, area in enumerate(areas):
+            area_snapshot_offset = snapshot_cursor
+            snapshot_cursor += BuildingLayout.AREA_SNAPSHOT_SIZE
+
+            facility_layouts = []
+            for facility_idx, facility in enumerate(area.facilities):
+                facility_layouts.append(FacilityLayout(
+                    area_idx=area_idx,
+                    facility_idx=facility_idx,
+                    facility_type=type(facility),
+                    state_offset=state_cursor,
+                    state_size=facility.STATE_TYPE.NDARRAY_SHAPE[0],
+                    action_offset=action_cursor,
+                    action_size=facility.ACTION_TYPE.NDARRAY_SHAPE[0],
+                    snapshot_offset=snapshot_cursor,
+                    snapshot_size=facility.SNAPSHOT_SIZE,
+                ))
+                state_cursor += facility.STATE_TYPE.NDARRAY_SHAPE[0]
+                action_cursor += facility.ACTION_TYPE.NDARRAY_SHAPE[0]
+                snapshot_cursor += facility.SNAPSHOT_SIZE
+
+            self.area_layouts.append(AreaLayout(
+                facilities=facility_layouts,
+                state_writers=[(f.facility_idx, f.state_offset) for f in facility_layouts if f.state_size > 0],
+                action_readers=[(f.facility_idx, f.action_offset) for f in facility_layouts if f.action_size > 0],
+                snapshot_writers=[
+                    (f.facility_idx, f.snapshot_offset) for f in facility_layouts if f.snapshot_size > 0],
+                power_consumption_col=state_cursor,
+                temperature_col=state_cursor + 1,
+                people_col=state_cursor + 2,
+                snapshot_offset=area_snapshot_offset,
+            ))
+            self.facility_layouts.extend(facility_layouts)
+            state_cursor += AreaState.NDARRAY_ELEMS
+
+        self.power_balance_col: int = state_cursor
+        self.electric_price_unit_col: int = state_cursor + 1
+        self.solar_radiation_col: int = state_cursor + 2
+        self.temperature_col: int = state_cursor + 3
+
+        self.state_shape: tuple[int] = (state_cursor + BuildingState.NDARRAY_ELEMS,)
+        self.action_shape: tuple[int] = (action_cursor,)
+        self.snapshot_shape: tuple[int] = (snapshot_cursor,)
+
+        self.state_buffer: np.ndarray = self.new_state_buffer()
+        self.index: LayoutIndex = self._create_index()
+
+
+    def _create_index(self) -> LayoutIndex:
+        hvacs = self.get_facility_layouts(HVAC)
+        ess = self.get_facility_layouts(ElectricStorage)
+
+        return LayoutIndex(
+            area_power_consumption=np.array([a.power_consumption_col for a in self.area_layouts], dtype=np.intp),
+            area_temperature=np.array([a.temperature_col for a in self.area_layouts], dtype=np.intp),
+            area_people=np.array([a.people_col for a in self.area_layouts], dtype=np.intp),
+            es_charge_ratio=np.array([f.state_offset for f in ess], dtype=np.intp),
+            power_balance=self.power_balance_col,
+            electric_price_unit=self.electric_price_unit_col,
+            solar_radiation=self.solar_radiation_col,
+            temperature=self.temperature_col,
+            hvac_status=np.array([f.action_offset for f in hvacs], dtype=np.intp),
+            hvac_set_temperature=np.array([f.action_offset + 1 for f in hvacs], dtype=np.intp),
+            es_mode=np.array([f.action_offset for f in ess], dtype=np.intp),
+        )
+
+
+    def new_state_buffer(self, batch_size: Optional[int] = None) -> np.ndarray:
+        shape = self.state_shape if batch_size is None else (batch_size, *self.state_shape)
+        return np.zeros(shape, dtype=self.dtype)
+
+
+    def get_facility_layouts(self, facility_type: type[Facility]) -> list[FacilityLayout]:
+        return [f for f in self.facility_layouts if issubclass(f.facility_type, facility_type)]
+
+
+    def encode_state(
+            self, areas: list[Area], ext_env: ExternalEnvironment, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """BuildingState.create(...).to_ndarray() と同じ値を、outに書き込んで返す
+
+        outを省略した場合はself.state_bufferに書き込むため、次の呼び出しで上書きされる
+        """
+        if out is None:
+            out = self.state_buffer
+
+        power_balance = 0
+        for area, area_layout in zip(areas, self.area_layouts):
+            for facility_idx, offset in area_layout.state_writers:
+                area.facilities[facility_idx].write_state(out, offset)
+
+            out[area_layout.power_consumption_col] = area.power_consumption
+            out[area_layout.temperature_col] = area.temperature
+            out[area_layout.people_col] = area.people
+            power_balance += area.power_consumption
+
+        out[self.power_balance_col] = power_balance
+        out[self.electric_price_unit_col] = ext_env.electric_price_unit
+        out[self.solar_radiation_col] = ext_env.solar_radiation
+        out[self.temperature_col] = ext_env.temperature
+
+        return out
+
+
+    def decode_state(self, src: np.ndarray) -> BuildingState:
+        """encode_stateで書き込んだ(state_dim,)の状態から、BuildingStateを作る
+        """
+        assert src.shape == self.state_shape, \
+            f"Shape mismatch on decoding state. ({self.state_shape} != {src.shape})"
+
+        def facility_state(facility_layout: FacilityLayout) -> FacilityState:
+            if issubclass(facility_layout.facility_type, ElectricStorage):
+                return ESState(charge_ratio=float(src[facility_layout.state_offset]))
+
+            return EmptyFacilityState()
+
+        return BuildingState(
+            areas=[
+                AreaState(
+                    power_consumption=float(src[area_layout.power_consumption_col]),
+                    temperature=float(src[area_layout.temperature_col]),
+                    people=int(src[area_layout.people_col]),
+                    facilities=list(map(facility_state, area_layout.facilities))
+                ) for area_layout in self.area_layouts
+            ],
+            power_balance=float(src[self.power_balance_col]),
+            electric_price_unit=float(src[self.electric_price_unit_col]),
+            solar_radiation=float(src[self.solar_radiation_col]),
+            temperature=float(src[self.temperature_col])
+        )
+
+
+    def decode_action(self, src: np.ndarray, areas: list[Area]):
+        """BuildingAction.from_ndarrayを経由せずに、各設備の設定を更新する
+        """
+        assert src.shape == self.action_shape, \
+            f"Shape mismatch on decoding action. ({self.action_shape} != {src.shape})"
+
+        for area, area_layout in zip(areas, self.area_layouts):
+            for facility_idx, offset in area_layout.action_readers:
+                area.facilities[facility_idx].update_setting_from_ndarray(src, offset)
+
+
+    def write_snapshot(self, areas: list[Area], out: np.ndarray):
+        """エリアと設備の内部状態を、out(float64, snapshot_shape)に書き込む
+        """
+        for area, area_layout in zip(areas, self.area_layouts):
+            offset = area_layout.snapshot_offset
+            out[offset] = area.temperature
+            out[offset + 1] = area.power_consumption
+            out[offset + 2] = area.people
+
+            for facility_idx, facility_offset in area_layout.snapshot_writers:
+                area.facilities[facility_idx].write_snapshot(out, facility_offset)
+
+
+    def read_snapshot(self, areas: list[Area], src: np.ndarray):
+        """write_snapshotで書き込んだ内容から、エリアと設備の内部状態を復元する
+        """
+        assert src.shape == self.snapshot_shape, \
+            f"Shape mismatch on reading snapshot. ({self.snapshot_shape} != {src.shape})"
+
+        for area, area_layout in zip(areas, self.area_layouts):
+            offset = area_layout.snapshot_offset
+            area.temperature = float(src[offset])
+            area.power_consumption = float(src[offset + 1])
+            area.people = int(src[offset + 2])
+
+            for facility_idx, facility_offset in area_layout.snapshot_writers:
+                area.facilities[facility_idx].read_snapshot(src, facility_offset)
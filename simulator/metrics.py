@@ -0,0 +1,215 @@
+from __future__ import annotations
+from queue import Queue
+import threading
+from time import perf_counter
+from typing import Any, Iterable, Optional, Protocol
+
+import numpy as np
+
+
+class ScalarWriter(Protocol):
+    """SummaryWriterなど、add_scalarでスカラーを書き込めるもの
+    """
+    def add_scalar(self, tag: str, scalar_value: float, global_step: int):
+        ...
+
+
+AGGREGATIONS = {
+    'mean': np.mean,
+    'min': np.min,
+    'max': np.max,
+}
+
+
+class MetricsLogger:
+    """スカラーを配列にためておき、バックグラウンドのスレッドでまとめてwriterに書き込むもの
+
+    downsampleを2以上にした場合は、タグごとにdownsample個の値をaggregationsで集約し、窓の最後のstepで書き込む。
+    集約したタグは、meanは元のタグのまま、それ以外は"{tag}/min"のようになる。
+    (downsample個に満たない、途中までの窓はflushでは書き込まず、closeでその時点までの値を集約して書き込む)
+    集約した値はbatch_size個たまった時か、前回送ってからflush_interval秒経った後に追加された時に、まとめて書き込みのスレッドに送る。
+    スレッドはdaemonなので、書き込み終えるには最後にcloseを呼ぶ必要がある。
+    writerが例外を投げた場合、そのまとまりは書き込まずにスレッドは動き続け、次のflush(close)で例外を投げ直す。
+    add_scalarはSummaryWriterと同じ引数で呼べるので、そのまま置き換えて使える。
+    """
+
+    def __init__(
+            self,
+            writer: ScalarWriter,
+            downsample: int = 1,
+            aggregations: Iterable[str] = ('mean',),
+            batch_size: int = 1024,
+            flush_interval: float = 10.):
+        if downsample < 1:
+            raise ValueError(f'downsample must be positive (got {downsample}).')
+
+        aggregations = tuple(aggregations)
+        if unknown := set(aggregations) - set(AGGREGATIONS):
+            raise ValueError(f'Unknown aggregations: {unknown} (must be in {list(AGGREGATIONS)}).')
+
+        self.writer: ScalarWriter = writer
+        self.downsample: int = downsample
+        # 間引かない場合は、値をそのまま書き込む
+        self.aggregations: tuple[str, ...] = aggregations if downsample > 1 else ('mean',)
+        self.batch_size: int = batch_size
+        self.flush_interval: float = flush_interval
+
+        self._windows: dict[str, np.ndarray] = {}
+        self._window_sizes: dict[str, int] = {}
+        # 窓に最後に入れた値のstep (closeで途中までの窓を書き込む時に使う)
+        self._window_steps: dict[str, int] = {}
+
+        self._pending_tags: list[str] = []
+        self._pending_values: list[float] = []
+        self._pending_steps: list[int] = []
+        self._last_sent: float = perf_counter()
+        self._closed: bool = False
+        # 書き込みのスレッドで起きた例外 (flushで投げ直す)
+        self._error: Optional[BaseException] = None
+
+        self._queue: Queue[Optional[tuple[list[str], list[float], list[int]]]] = Queue()
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+
+    def add_scalar(self, tag: str, scalar_value: float, global_step: int):
+        if self.downsample == 1:
+            self._emit(tag, scalar_value, global_step)
+            return
+
+        if (window := self._windows.get(tag)) is None:
+            window = self._windows[tag] = np.empty(self.downsample)
+            self._window_sizes[tag] = 0
+
+        size = self._window_sizes[tag]
+        window[size] = scalar_value
+        size += 1
+
+        if size == self.downsample:
+            self._emit_window(tag, window, global_step)
+            size = 0
+
+        self._window_sizes[tag] = size
+        self._window_steps[tag] = global_step
+
+
+    def add_scalars(self, tag: str, values: np.ndarray, steps: np.ndarray):
+        """時系列の値をまとめて追加する (add_scalarを順に呼んだ場合と同じ結果になる)
+        """
+        values = np.asarray(values, dtype=np.float64)
+        steps = np.asarray(steps)
+        start = 0
+
+        # 途中までたまっている窓を、先に埋める
+        while start < len(values) and self._window_sizes.get(tag, 0) > 0:
+            self.add_scalar(tag, values[start], steps[start])
+            start += 1
+
+        stop = start + (len(values) - start) // self.downsample * self.downsample
+        if stop > start:
+            windows = values[start:stop].reshape(-1, self.downsample)
+            window_steps = steps[start + self.downsample - 1:stop:self.downsample].tolist()
+
+            for aggregation in self.aggregations:
+                self._emit_many(
+                    self._to_tag(tag, aggregation), AGGREGATIONS[aggregation](windows, axis=1).tolist(), window_steps)
+
+        for value, step in zip(values[stop:], steps[stop:]):
+            self.add_scalar(tag, value, step)
+
+
+    def flush(self):
+        """ここまでに集約した値を全てwriterに書き込むまで待つ
+        """
+        self._send_pending()
+        self._queue.join()
+
+        if (error := self._error) is not None:
+            self._error = None
+            raise error
+
+        if hasattr(self.writer, 'flush'):
+            self.writer.flush()
+
+
+    def close(self):
+        """途中までの窓も書き込んでから、書き込みのスレッドとwriterを閉じる
+        """
+        if self._closed:
+            return
+        self._closed = True
+
+        for tag, size in self._window_sizes.items():
+            if size > 0:
+                self._emit_window(tag, self._windows[tag][:size], self._window_steps[tag])
+                self._window_sizes[tag] = 0
+
+        try:
+            self.flush()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+
+            if hasattr(self.writer, 'close'):
+                self.writer.close()
+
+
+    def __enter__(self) -> MetricsLogger:
+        return self
+
+
+    def __exit__(self, *args: Any):
+        self.close()
+
+
+    @staticmethod
+    def _to_tag(tag: str, aggregation: str) -> str:
+        return tag if aggregation == 'mean' else f"{tag}/{aggregation}"
+
+
+    def _emit_window(self, tag: str, window: np.ndarray, step: int):
+        for aggregation in self.aggregations:
+            self._emit(self._to_tag(tag, aggregation), AGGREGATIONS[aggregation](window), step)
+
+
+    def _emit(self, tag: str, value: float, step: int):
+        self._pending_tags.append(tag)
+        self._pending_values.append(float(value))
+        self._pending_steps.append(int(step))
+        self._send_if_due()
+
+
+    def _emit_many(self, tag: str, values: list[float], steps: list[int]):
+        self._pending_tags.extend([tag] * len(values))
+        self._pending_values.extend(values)
+        self._pending_steps.extend(steps)
+        self._send_if_due()
+
+
+    def _send_if_due(self):
+        if len(self._pending_tags) >= self.batch_size or perf_counter() - self._last_sent >= self.flush_interval:
+            self._send_pending()
+
+
+    def _send_pending(self):
+        self._last_sent = perf_counter()
+        if not self._pending_tags:
+            return
+
+        self._queue.put((self._pending_tags, self._pending_values, self._pending_steps))
+        self._pending_tags, self._pending_values, self._pending_steps = [], [], []
+
+
+    def _write_loop(self):
+        while (item := self._queue.get()) is not None:
+            try:
+                for tag, value, step in zip(*item):
+                    self.writer.add_scalar(tag, value, step)
+            except Exception as e:
+                # スレッドが止まるとflushのjoinが返らなくなるので、例外は残しておいて次のまとまりに進む
+                if self._error is None:
+                    self._error = e
+            finally:
+                self._queue.task_done()
+
+        self._queue.task_done()
@@ -0,0 +1,32 @@
+from typing import Callable, Optional
+
+import numpy as np
+
+from simulator.facility import HVAC
+from simulator.facility.hvac import HVACAction
+from simulator.layout import BuildingLayout
+
+
+def hold_last_action(layout: BuildingLayout) -> Optional[np.ndarray]:
+    """設備の設定を更新せず、直前の行動のまま運転を続ける
+    """
+    return None
+
+
+def thermostat_action(layout: BuildingLayout, set_temperature: float = 25) -> np.ndarray:
+    """全てのHVACをset_temperatureで運転し、蓄電池は待機させる行動を返す
+    """
+    action = np.zeros(layout.action_shape)
+    for hvac in layout.get_facility_layouts(HVAC):
+        action[hvac.action_offset] = 1.
+        action[hvac.action_offset + 1] = HVACAction.from_set_temperature(set_temperature)
+
+    return action
+
+
+# 学習を行わない区間(ウォームアップなど)をfast_forwardで進める際に使う、組み込みの方策
+# レイアウトから行動を作る (Noneの場合は直前の設定のまま)
+WARMUP_POLICIES: dict[str, Callable[[BuildingLayout], Optional[np.ndarray]]] = {
+    "hold": hold_last_action,
+    "thermostat": thermostat_action,
+}
@@ -0,0 +1,92 @@
+from __future__ import annotations
+from collections import defaultdict
+from contextlib import contextmanager
+import json
+from pathlib import Path
+from time import perf_counter
+from typing import Iterator, Optional
+
+
+class Profiler:
+    """シミュレーションの各フェーズの、累積時間と呼び出し回数を集計するオブジェクト
+
+    with profile() as profiler:
+        bfs.step(action)
+    print(profiler.to_json(indent=4))
+
+    のように使う。計測箇所は、有効なProfilerがない場合はactiveの確認だけで済むようにしてある。
+    """
+
+    def __init__(self):
+        self.total_time: defaultdict[str, float] = defaultdict(float)
+        self.calls: defaultdict[str, int] = defaultdict(int)
+
+
+    def lap(self, phase: str, start: float) -> float:
+        """startからの経過時間をphaseに加算し、現在時刻を返す (続けて次のフェーズの開始時刻として使える)
+        """
+        now = perf_counter()
+        self.total_time[phase] += now - start
+        self.calls[phase] += 1
+
+        return now
+
+
+    @contextmanager
+    def measure(self, phase: str) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.lap(phase, start)
+
+
+    def reset(self):
+        self.total_time.clear()
+        self.calls.clear()
+
+
+    def to_dict(self) -> dict[str, dict[str, float]]:
+        return {
+            phase: dict(
+                total_sec=total_time,
+                calls=self.calls[phase],
+                mean_usec=total_time / self.calls[phase] * 1e6,
+            ) for phase, total_time in sorted(self.total_time.items(), key=lambda item: -item[1])
+        }
+
+
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.to_dict(), **kwargs)
+
+
+    def write_json(self, path: Path):
+        Path(path).write_text(self.to_json(indent=4))
+
+
+# 計測箇所から参照される、現在有効なProfiler (Noneの場合は計測しない)
+active: Optional[Profiler] = None
+
+
+def enable(profiler: Optional[Profiler] = None) -> Profiler:
+    global active
+    active = profiler if profiler is not None else Profiler()
+
+    return active
+
+
+def disable():
+    global active
+    active = None
+
+
+@contextmanager
+def profile(profiler: Optional[Profiler] = None) -> Iterator[Profiler]:
+    """withの中でだけ、profilerで計測する
+    """
+    global active
+    prev = active
+    try:
+        yield enable(profiler)
+    finally:
+        active = prev
@@ -0,0 +1,122 @@
+from __future__ import annotations
+import io
+from typing import Optional
+
+import numpy as np
+
+from simulator.layout import BuildingLayout
+
+
+class TrajectoryRecorder:
+    """stepごとの結果を、名前付きの列を持つ構造化ndarrayに追記していくもの
+
+    列は step, area_temperature, area_power_consumption, area_people, facility_state, power_balance, action, reward で、
+    エリアや設備ごとの値は(step数, エリア数)のように2次元になる。
+    記録しなかったactionとreward(fast_forwardしたstepなど)はNaNになる。
+    pickleすると、全stepの記録が1つの連続したndarrayになる (protocol 5なら、out-of-bandのバッファとしてコピーせずに送れる)。
+    """
+
+    INITIAL_CAPACITY = 1024
+
+
+    def __init__(
+            self,
+            layout: BuildingLayout,
+            reward_dim: int = 1,
+            capacity: int = INITIAL_CAPACITY,
+            dtype: type = np.float32):
+        self.index = layout.index
+        self.facility_state_cols = np.array([
+            col for f in layout.facility_layouts for col in range(f.state_offset, f.state_offset + f.state_size)
+        ], dtype=np.intp)
+
+        num_areas = len(layout.area_layouts)
+        self.dtype: np.dtype = np.dtype([
+            ('step', np.int64),
+            ('area_temperature', dtype, (num_areas,)),
+            ('area_power_consumption', dtype, (num_areas,)),
+            ('area_people', np.int32, (num_areas,)),
+            ('facility_state', dtype, (len(self.facility_state_cols),)),
+            ('power_balance', dtype),
+            ('action', dtype, layout.action_shape),
+            ('reward', dtype, (reward_dim,)),
+        ])
+
+        self._records: np.ndarray = np.empty(max(capacity, 1), dtype=self.dtype)
+        self._size: int = 0
+
+
+    def __len__(self) -> int:
+        return self._size
+
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        """記録済みの範囲の、nameの列を返す
+        """
+        return self._records[name][:self._size]
+
+
+    @property
+    def records(self) -> np.ndarray:
+        return self._records[:self._size]
+
+
+    def record(
+            self,
+            steps: int,
+            state: np.ndarray,
+            action: Optional[np.ndarray] = None,
+            reward: Optional[np.ndarray] = None):
+        """stateのndarray(とactionとreward)から、1step分の記録を追加する
+        """
+        if self._size == len(self._records):
+            self._grow()
+
+        i = self._size
+        records = self._records
+        records['step'][i] = steps
+        records['area_temperature'][i] = state[self.index.area_temperature]
+        records['area_power_consumption'][i] = state[self.index.area_power_consumption]
+        records['area_people'][i] = state[self.index.area_people]
+        records['facility_state'][i] = state[self.facility_state_cols]
+        records['power_balance'][i] = state[self.index.power_balance]
+        records['action'][i] = action if action is not None else np.nan
+        records['reward'][i] = reward if reward is not None else np.nan
+
+        self._size += 1
+
+
+    def _grow(self):
+        records = np.empty(len(self._records) * 2, dtype=self.dtype)
+        records[:self._size] = self._records[:self._size]
+        self._records = records
+
+
+    def to_bytes(self) -> bytes:
+        with io.BytesIO() as f:
+            np.save(f, self.records, allow_pickle=False)
+            return f.getvalue()
+
+
+    def load_bytes(self, blob: bytes):
+        """to_bytesで書き出した記録で、置き換える
+        """
+        records = np.load(io.BytesIO(blob), allow_pickle=False)
+        assert records.dtype == self.dtype, \
+            f"Dtype mismatch on loading trajectory. ({self.dtype} != {records.dtype})"
+
+        self._records = records
+        self._size = len(records)
+
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state['_records'] = self.records
+        del state['_size']
+
+        return state
+
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._size = len(self._records)
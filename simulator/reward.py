@@ -0,0 +1,32 @@
+from __future__ import annotations
+from typing import Callable, Union
+
+import numpy as np
+
+from simulator.building import BuildingAction, BuildingState
+from simulator.layout import LayoutIndex
+
+
+# BuildingState/BuildingActionのオブジェクトから、1step分の報酬を計算する関数
+CalcReward = Callable[[BuildingState, BuildingAction], np.ndarray]
+
+# stepの後のstateと、そのstepのactionのndarrayから、報酬をまとめて計算する関数
+# (..., state_dim), (..., action_dim)を受け取り、(..., 報酬の次元)を返す (先頭の次元はstep数やビル数など任意)
+VectorizedReward = Callable[[np.ndarray, np.ndarray, LayoutIndex], np.ndarray]
+
+
+def vectorized_reward(func: VectorizedReward) -> VectorizedReward:
+    """funcをVectorizedRewardとして扱うよう、シミュレータに伝えるためのデコレータ
+
+    @vectorized_reward
+    def calc_reward(states: np.ndarray, actions: np.ndarray, index: LayoutIndex) -> np.ndarray:
+        return -states[..., index.power_balance, None]
+
+    のようにして、calc_rewardの代わりにシミュレータに渡す
+    """
+    func.is_vectorized_reward = True
+    return func
+
+
+def is_vectorized_reward(func: Union[CalcReward, VectorizedReward]) -> bool:
+    return getattr(func, 'is_vectorized_reward', False)
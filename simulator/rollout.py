@@ -0,0 +1,113 @@
+from __future__ import annotations
+from typing import Callable, NamedTuple, Optional
+
+import numpy as np
+
+from simulator.building import BuildingAction, BuildingState
+
+
+# (バッチサイズ, state_dim)の状態を受け取り、(バッチサイズ, action_dim)の行動を返す方策
+BatchPolicy = Callable[[np.ndarray], np.ndarray]
+
+
+class StepResult:
+    """1step分の結果
+
+    stepごとに一度だけ作られ、報酬の計算やログの書き込みなど、そのstepの結果を使う処理の間で共有される。
+    state_arrayは書き込み不可のndarrayで、以降のstepで上書きされることはない。
+    stateとactionのオブジェクトは、渡されなかった場合はcreate_state/create_actionで最初に参照された時に作り、以降は使い回す。
+    """
+
+    __slots__ = ('steps', 'state_array', 'reward', 'action_array', '_state', '_action', '_create_state', '_create_action')
+
+    def __init__(
+            self,
+            steps: int,
+            state_array: np.ndarray,
+            reward: np.ndarray,
+            action_array: np.ndarray,
+            state: Optional[BuildingState] = None,
+            action: Optional[BuildingAction] = None,
+            create_state: Optional[Callable[[], BuildingState]] = None,
+            create_action: Optional[Callable[[], BuildingAction]] = None):
+        assert state is not None or create_state is not None, "Either state or create_state must be given."
+        assert action is not None or create_action is not None, "Either action or create_action must be given."
+
+        # step後のstart_timeからのstep数
+        self.steps: int = steps
+        self.state_array: np.ndarray = state_array
+        self.reward: np.ndarray = reward
+        # stepに渡されたactionのndarray
+        self.action_array: np.ndarray = action_array
+        self._state: Optional[BuildingState] = state
+        self._action: Optional[BuildingAction] = action
+        self._create_state: Optional[Callable[[], BuildingState]] = create_state
+        self._create_action: Optional[Callable[[], BuildingAction]] = create_action
+
+
+    @property
+    def state(self) -> BuildingState:
+        if self._state is None:
+            self._state = self._create_state()
+            self._create_state = None
+
+        return self._state
+
+
+    @property
+    def action(self) -> BuildingAction:
+        if self._action is None:
+            self._action = self._create_action()
+            self._create_action = None
+
+        return self._action
+
+
+class BatchedStepResult(NamedTuple):
+    """BatchedBuildingFacilitySimulatorの、全ビルの1step分の結果
+
+    各ndarrayの先頭の次元はビルで、StepResultと同じくstate_arrayは書き込み不可、以降のstepで上書きされることはない。
+    ビルごとの状態やactionのオブジェクトは、必要な場合にBatchedBuildingFacilitySimulator.get_last_resultで作る。
+    """
+
+    # step後のstart_timeからのstep数
+    steps: int
+    # (N, state_dim)
+    state_array: np.ndarray
+    # (N, 報酬の次元)
+    reward: np.ndarray
+    # stepに渡された(N, action_dim)のaction
+    action_array: np.ndarray
+
+
+class Trajectory(NamedTuple):
+    """rolloutで得られる軌跡を、stepごとに並べたndarrayとして保持するもの
+
+    各ndarrayの先頭の次元はstep数で、BatchedBuildingFacilitySimulatorの場合はその次にビルの次元が入る
+    """
+
+    states: np.ndarray
+    actions: np.ndarray
+    rewards: np.ndarray
+    next_states: np.ndarray
+
+
+    @staticmethod
+    def allocate(
+            n_steps: int, 
+            state_shape: tuple[int, ...], 
+            action_shape: tuple[int, ...], 
+            reward_shape: tuple[int, ...] = (1,), 
+            dtype: type = np.float64) -> Trajectory:
+        return Trajectory(
+            states=np.zeros((n_steps, *state_shape), dtype=dtype),
+            actions=np.zeros((n_steps, *action_shape), dtype=dtype),
+            rewards=np.zeros((n_steps, *reward_shape), dtype=dtype),
+            next_states=np.zeros((n_steps, *state_shape), dtype=dtype),
+        )
+
+
+    def head(self, n_steps: int) -> Trajectory:
+        """先頭のn_steps分のviewを返す
+        """
+        return Trajectory(*(arr[:n_steps] for arr in self))